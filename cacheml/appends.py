@@ -0,0 +1,165 @@
+"""Incremental caching of functions over append-only files.
+
+For a LocalFile argument, a normal cached function is keyed on the modification time
+and size of the file, so appending a line to a log means parsing all of it again. An
+AppendFunc instead keys the entry on the path (and the other arguments), and records
+in the entry's metadata how many bytes of the file were parsed, along with a hash of
+those bytes. On the next call:
+
+ * if the file has the same modification time and size, the cached result is used,
+ * if the file has grown and the parsed prefix is unchanged, only the new complete
+   lines are parsed. The function is called on a temporary file holding the header
+   (the first header_lines lines of the file) and the new lines, and that result
+   is appended to the cached one. The entry is then updated,
+ * otherwise (e.g. the file was truncated or rewritten), the whole file is parsed.
+
+Writers must append complete lines. Checking the prefix reads it, which is much
+faster than parsing it, but is not free for very large files.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+from os.path import splitext
+import time
+import tempfile
+
+from joblib import hashing
+
+try:
+    from .local_stats import hash_file, file_hasher, format_hash
+    from .partitions import concat_results
+except ImportError:
+    from local_stats import hash_file, file_hasher, format_hash
+    from partitions import concat_results
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+def _has_default_index(df):
+    # a DataFrame loaded from the cache may have an equivalent Index rather than
+    # a RangeIndex
+    return df.index.equals(pd.RangeIndex(len(df)))
+
+
+def append_results(previous, tail):
+    """Append the result for the new lines to the previous result. DataFrames
+    that both have the default index (0 to n-1, e.g. from read_csv()) get a new
+    default index, so that the result is the same as parsing the whole file.
+    Otherwise, the results are concatenated as in partitions.concat_results().
+    """
+    if pd is not None and isinstance(previous, pd.DataFrame) and isinstance(tail, pd.DataFrame) \
+       and _has_default_index(previous) and _has_default_index(tail):
+        return pd.concat([previous, tail], ignore_index=True)
+    return concat_results([previous, tail])
+
+
+class AppendFunc:
+    """Caches the result of a function whose first argument is an append-only
+    LocalFile, updating it as the file grows. This is returned by
+    Cache.cache_appends(). The other arguments are part of the key, as usual.
+    """
+    def __init__(self, cached_func, header_lines=1, combine=None):
+        self.cached_func = cached_func
+        self.header_lines = header_lines
+        self.combine = combine if combine is not None else append_results
+
+    @property
+    def func(self):
+        return self.cached_func.func
+
+    @property
+    def store_backend(self):
+        return self.cached_func.store_backend
+
+    def _entry(self, path, args, kwargs):
+        # the key is based on the path rather than the stats of the file
+        func_id, args_hash = self.cached_func._get_output_identifiers(path, *args, **kwargs)
+        return [func_id, hashing.hash(('append', args_hash))]
+
+    def _header_size(self, path):
+        with open(path, 'rb') as f:
+            for _ in range(self.header_lines):
+                f.readline()
+            return f.tell()
+
+    def _tail_end(self, path, offset, size):
+        """Return the offset just after the last complete line in [offset, size)."""
+        with open(path, 'rb') as f:
+            end = size
+            while end>offset:
+                start = max(offset, end-65536)
+                f.seek(start)
+                i = f.read(end-start).rfind(b'\n')
+                if i>=0:
+                    return start + i + 1
+                end = start
+        return offset
+
+    def _call_on_tail(self, f, state, end, hasher, args, kwargs):
+        with open(f.path, 'rb') as src, \
+             tempfile.NamedTemporaryFile(suffix=splitext(f.path)[1], delete=False) as dst:
+            dst.write(src.read(state['header_size']))
+            src.seek(state['offset'])
+            tail = src.read(end-state['offset'])
+            dst.write(tail)
+        hasher.update(tail)
+        try:
+            return self.func(type(f)(dst.name), *args, **kwargs)
+        finally:
+            os.remove(dst.name)
+
+    def _store(self, entry, result, state, duration):
+        # With persist_in_background, the result is written later. The state must
+        # not be written before it, or a crash in between would leave it pointing
+        # past rows that were never persisted, so it is written along with it.
+        self.store_backend.dump_item(entry, result, verbose=self.cached_func._verbose,
+                                     metadata={'duration':duration, 'append':state})
+
+    def _get_state(self, entry):
+        if not (self.cached_func._check_previous_func_code(stacklevel=4) and
+                self.store_backend.contains_item(entry)):
+            return None
+        return self.store_backend.get_metadata(entry).get('append', None)
+
+    def __call__(self, f, *args, **kwargs):
+        start_time = time.time()
+        entry = self._entry(f.path, args, kwargs)
+        fstats = os.stat(f.path)
+        state = self._get_state(entry)
+        if state is not None and state['mtime']==fstats.st_mtime and state['size']==fstats.st_size:
+            return self.store_backend.load_item(entry, verbose=self.cached_func._verbose)
+        hasher = file_hasher(f.path, state['offset']) \
+                 if state is not None and fstats.st_size>=state['offset'] else None
+        if hasher is not None and format_hash(hasher)==state['prefix_hash']:
+            previous = self.store_backend.load_item(entry, verbose=self.cached_func._verbose)
+            end = self._tail_end(f.path, state['offset'], fstats.st_size)
+            if end==state['offset']:
+                # no new complete lines yet: remember the stats, so that we do not
+                # check the prefix again until the file changes
+                self.store_backend.store_metadata(entry, {'duration':time.time()-start_time,
+                    'append':dict(state, mtime=fstats.st_mtime, size=fstats.st_size)})
+                return previous
+            tail_result = self._call_on_tail(f, state, end, hasher, args, kwargs)
+            result = self.combine(previous, tail_result)
+            # the hasher now covers the new lines as well
+            new_state = dict(state, offset=end, prefix_hash=format_hash(hasher))
+        else:
+            result = self.func(f, *args, **kwargs)
+            if os.stat(f.path).st_size!=fstats.st_size:
+                return result # the file grew while we were parsing it
+            end = fstats.st_size
+            new_state = {'offset':end, 'header_size':self._header_size(f.path),
+                         'prefix_hash':hash_file(f.path, end)}
+        new_state.update(mtime=fstats.st_mtime, size=fstats.st_size)
+        self._store(entry, result, new_state, time.time()-start_time)
+        return result
+
+    def clear(self, warn=True):
+        """Remove the cached results."""
+        self.cached_func.clear(warn=warn)
+
+    def __repr__(self):
+        return f'AppendFunc({self.cached_func})'
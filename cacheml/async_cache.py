@@ -0,0 +1,105 @@
+"""Caching of coroutine functions.
+
+Cache.acache() wraps an async def function in an AsyncCachedFunc. Calling it:
+
+ * validates any S3File arguments with the asynchronous S3FileSystem of the running
+   event loop (see s3_stats.avalidate_s3_files()), so that hashing the arguments
+   makes no blocking requests. The hashing itself (which stats LocalFile arguments,
+   and reads them for content fingerprints) runs in the loop's default executor,
+ * checks for and loads a cached result, and stores a new one, in the loop's
+   default executor. Reading, decrypting and writing entries are blocking file
+   operations, so this keeps the loop responsive. The executor is a shared pool,
+   so many concurrent calls do not mean a thread per call,
+ * awaits the function itself on the loop, on a cache miss.
+
+The entries are the same as those of Cache.cache() for the same function.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+
+from joblib.func_inspect import filter_args
+
+try:
+    from .local_stats import local_validation_scope
+    from .s3_stats import s3_validation_scope, avalidate_s3_files
+except ImportError:
+    from local_stats import local_validation_scope
+    from s3_stats import s3_validation_scope, avalidate_s3_files
+
+
+class AsyncCachedFunc:
+    """The coroutine function wrapper returned by Cache.acache(). This wraps
+    the CachedFunc for the same function, which it uses for the identifiers and the
+    store backend.
+    """
+    def __init__(self, cached_func):
+        self.cached_func = cached_func
+        # concurrent calls would otherwise write and read the code file at the same time
+        self._code_lock = threading.Lock()
+        functools.update_wrapper(self, cached_func.func)
+
+    @property
+    def func(self):
+        return self.cached_func.func
+
+    @property
+    def store_backend(self):
+        return self.cached_func.store_backend
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+    async def _get_output_identifiers(self, args, kwargs):
+        with local_validation_scope(), s3_validation_scope():
+            await avalidate_s3_files(self.cached_func._s3_file_arguments(args, kwargs))
+            # The S3 stats are now known, so this does not make requests, but it
+            # may still stat or read local files. It runs in a copy of our context,
+            # so that it uses the validation scopes.
+            context = contextvars.copy_context()
+            return await self._run(context.run, functools.partial(
+                self.cached_func._get_output_identifiers, *args, **kwargs))
+
+    def _load(self, entry):
+        """Return (True, result) if the result is in the cache, (False, None) otherwise."""
+        cached_func = self.cached_func
+        with self._code_lock:
+            unchanged = cached_func._check_previous_func_code(stacklevel=4)
+        if not (unchanged and self.store_backend.contains_item(entry)):
+            return (False, None)
+        try:
+            return (True, self.store_backend.load_item(entry, verbose=cached_func._verbose))
+        except Exception as e:
+            cached_func.warn(f"Exception while loading results for {entry}: {e}")
+            return (False, None)
+
+    def _store(self, entry, result, duration, args, kwargs):
+        cached_func = self.cached_func
+        self.store_backend.dump_item(entry, result, verbose=cached_func._verbose)
+        argument_dict = filter_args(cached_func.func, cached_func.ignore, args, kwargs)
+        self.store_backend.store_metadata(entry, {
+            'duration':duration,
+            'input_args':dict((k, repr(v)) for (k, v) in argument_dict.items())
+        })
+
+    async def __call__(self, *args, **kwargs):
+        start_time = time.time()
+        entry = list(await self._get_output_identifiers(args, kwargs))
+        (found, result) = await self._run(self._load, entry)
+        if found:
+            return result
+        result = await self.func(*args, **kwargs)
+        await self._run(self._store, entry, result, time.time()-start_time, args, kwargs)
+        return result
+
+    def clear(self, warn=True):
+        """Remove the cached results."""
+        self.cached_func.clear(warn=warn)
+
+    def __repr__(self):
+        return f'AsyncCachedFunc({self.cached_func})'
@@ -7,22 +7,85 @@ Caching functions and decorators
 
 import time
 import os
+import io
+import logging
 from os.path import exists, abspath, expanduser, join, exists
 import shutil
 from typing import Optional
 import json
 import binascii
+import sys
+import warnings
+import threading
+import glob
+import asyncio
+import datetime
+import sqlite3
 
-from joblib.memory import Memory
-from s3fs import S3FileSystem
-from joblib._store_backends import FileSystemStoreBackend, concurrency_safe_rename, concurrency_safe_write
+from joblib.memory import Memory, MemorizedFunc, NotMemorizedFunc, _FUNCTION_HASHES, \
+    _build_func_identifier
+from joblib._store_backends import FileSystemStoreBackend, concurrency_safe_rename, concurrency_safe_write, \
+    CacheItemInfo
+from joblib.disk import mkdirp, memstr_to_bytes
 from joblib.memory import register_store_backend
+from joblib import numpy_pickle
+import functools
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
 
 try:
-    from .crypto import get_new_key, encrypted_file_open
+    from .crypto import get_new_key, encrypted_file_open, DEFAULT_FORMAT
+    from .serialize import dump_oob, load_oob, load_oob_mmap, is_oob_file
+    from .columnar import to_arrow_table, dump_arrow, load_arrow, load_arrow_mmap, \
+        is_arrow_file, select_columns, ColumnNotFoundError, HAVE_ARROW
+    from .compression import compressed_writer, decompressed_reader, is_compressed_file, \
+        check_codec, arrow_compression, DecompressedReader
+    from .memory_tier import MemoryTier
+    from .persist_queue import PersistQueue, DEFAULT_QUEUE_LIMIT
+    from .locks import EntryLock, DEFAULT_LOCK_TIMEOUT, DEFAULT_STALE_AFTER
+    from .rotation import rotate_cache_key
+    from .manifest import Manifest
+    from .eviction import get_policy, entries_to_evict, LRUPolicy, EVICTION_SLACK
+    from .metrics import CacheMetrics, MeteredReader, PrometheusTextfileExporter, JSONExporter, \
+        PHASE_HASH, PHASE_LOOKUP, PHASE_READ, PHASE_DECRYPT, PHASE_DESERIALIZE, PHASE_COMPUTE, \
+        PHASE_WRITE
+    from .profile import Profile, profile_span, is_profiling, PHASE_STAT, PHASE_CALL
+    from .s3_pool import get_s3_filesystem, get_async_s3_filesystem
+    from .local_stats import get_local_stats, local_validation_scope, configure_local_validation
+    from .partitions import PartitionedFunc
+    from .appends import AppendFunc
+    from .s3_stats import get_s3_stats, validate_s3_files, s3_validation_scope, \
+        configure_s3_validation, list_s3_prefix, record_listing, stats_from_info, aget_s3_stats, \
+        DEFAULT_TTL
+    from .async_cache import AsyncCachedFunc
 except ImportError:
     # when running locally
-    from crypto import get_new_key, encrypted_file_open
+    from crypto import get_new_key, encrypted_file_open, DEFAULT_FORMAT
+    from serialize import dump_oob, load_oob, load_oob_mmap, is_oob_file
+    from columnar import to_arrow_table, dump_arrow, load_arrow, load_arrow_mmap, \
+        is_arrow_file, select_columns, ColumnNotFoundError, HAVE_ARROW
+    from compression import compressed_writer, decompressed_reader, is_compressed_file, \
+        check_codec, arrow_compression, DecompressedReader
+    from memory_tier import MemoryTier
+    from persist_queue import PersistQueue, DEFAULT_QUEUE_LIMIT
+    from locks import EntryLock, DEFAULT_LOCK_TIMEOUT, DEFAULT_STALE_AFTER
+    from rotation import rotate_cache_key
+    from manifest import Manifest
+    from eviction import get_policy, entries_to_evict, LRUPolicy, EVICTION_SLACK
+    from metrics import CacheMetrics, MeteredReader, PrometheusTextfileExporter, JSONExporter, \
+        PHASE_HASH, PHASE_LOOKUP, PHASE_READ, PHASE_DECRYPT, PHASE_DESERIALIZE, PHASE_COMPUTE, \
+        PHASE_WRITE
+    from profile import Profile, profile_span, is_profiling, PHASE_STAT, PHASE_CALL
+    from s3_pool import get_s3_filesystem, get_async_s3_filesystem
+    from local_stats import get_local_stats, local_validation_scope, configure_local_validation
+    from partitions import PartitionedFunc
+    from appends import AppendFunc
+    from s3_stats import get_s3_stats, validate_s3_files, s3_validation_scope, \
+        configure_s3_validation, list_s3_prefix, record_listing, stats_from_info, aget_s3_stats, \
+        DEFAULT_TTL
+    from async_cache import AsyncCachedFunc
+
+logger = logging.getLogger(__name__)
 
 
 class CommandError(Exception):
@@ -68,14 +131,17 @@ class CachedFile:
 
 
 class LocalFile(CachedFile):
+    """A local file. The stats are the modification time and size, or a
+    fingerprint of the content and the size (see local_stats.py).
+    """
     __slots__ = ('path', 'stats')
     def __init__(self, path):
         self.path = abspath(expanduser(path))
         self._refresh_stats()
 
     def _refresh_stats(self):
-        fstats = os.stat(self.path)
-        self.stats = (fstats.st_mtime, fstats.st_size)
+        with profile_span(PHASE_STAT, path=self.path):
+            self.stats = get_local_stats(self.path)
 
     def __hash__(self):
         self._refresh_stats()
@@ -100,52 +166,725 @@ class LocalFile(CachedFile):
         return f'LocalFile({self.path}, {self.stats})'
 
 
+class LocalDirectory(CachedFile):
+    """The files in a local directory that match a glob pattern, e.g. the
+    partitions of a dataset. The pattern may use '**' to match files in
+    subdirectories. The stats are the relative path and stats of each
+    file, so adding, removing or changing any file changes the cache key.
+    To cache a result per file, see Cache.cache_partitions().
+    """
+    __slots__ = ('path', 'pattern', 'stats')
+    def __init__(self, path, pattern='*'):
+        self.path = abspath(expanduser(path))
+        self.pattern = pattern
+        self._refresh_stats()
+
+    def _refresh_stats(self):
+        if not os.path.isdir(self.path):
+            raise FileNotFoundError(f"Directory {self.path} not found")
+        names = sorted(os.path.relpath(p, self.path)
+                       for p in glob.glob(join(self.path, self.pattern), recursive=True)
+                       if os.path.isfile(p))
+        self.stats = tuple((name, get_local_stats(join(self.path, name))) for name in names)
+
+    def files(self):
+        """Return a LocalFile for each file, sorted by path."""
+        self._refresh_stats()
+        files = []
+        for (name, stats) in self.stats:
+            f = LocalFile.__new__(LocalFile)
+            f.__setstate__((join(self.path, name), stats[0], stats[1]))
+            files.append(f)
+        return files
+
+    def __hash__(self):
+        self._refresh_stats()
+        return hash((self.path, self.pattern, self.stats))
+
+    def __getstate__(self):
+        self._refresh_stats()
+        return (self.path, self.pattern, self.stats)
+
+    def __setstate__(self, newstate):
+        (self.path, self.pattern, self.stats) = newstate
+
+    def __repr__(self):
+        return f'LocalDirectory({self.path}, {self.pattern}, {len(self.stats)} files)'
+
+
 class S3File(CachedFile):
-    __slots__ = ('fs', 'path', 'stats')
+    """A file in S3. Any s3_options are passed to S3FileSystem (e.g. profile
+    or endpoint_url). They are part of the pickled state, so use a profile or the
+    environment for credentials rather than passing them here.
 
+    The S3FileSystem comes from a process-wide pool (see s3_pool.py), so creating
+    or unpickling many S3Files does not create many clients. The stats are
+    validated as described in s3_stats.py.
 
-    def __init__(self, path):
-        self.fs = S3FileSystem()
+    From asyncio code, use S3File.acreate() and open_async(), which use the
+    asynchronous S3FileSystem of the running event loop.
+    """
+    __slots__ = ('path', 'stats', 's3_options')
+
+    def __init__(self, path, **s3_options):
         self.path = path
+        self.s3_options = s3_options
         self._refresh_stats()
-        print(self)
+        #print(self)
+
+    @property
+    def fs(self):
+        return get_s3_filesystem(**self.s3_options)
 
     def _refresh_stats(self):
-        info = self.fs.info(self.path)
-        self.stats = (info['LastModified'], info['size'])
+        self.stats = get_s3_stats(self.fs, self.s3_options, self.path)
+
+    @classmethod
+    async def acreate(cls, path, **s3_options):
+        """Create an S3File without blocking the event loop."""
+        f = cls.__new__(cls)
+        f.path = path
+        f.s3_options = s3_options
+        fs = await get_async_s3_filesystem(**s3_options)
+        f.stats = await aget_s3_stats(fs, s3_options, path)
+        return f
+
+    async def open_async(self, mode='rb'):
+        """Return an asynchronous file object (see s3fs's open_async())."""
+        fs = await get_async_s3_filesystem(**self.s3_options)
+        return await fs.open_async(self.path, mode)
+
+    @classmethod
+    def list(cls, prefix, suffix='', **s3_options):
+        """Return S3Files for the objects directly under prefix whose names end with
+        suffix, sorted by path. The stats all come from a single listing.
+        """
+        return cls._list(prefix, suffix, False, s3_options)
+
+    @classmethod
+    def _list(cls, prefix, suffix, recursive, s3_options):
+        fs = get_s3_filesystem(**s3_options)
+        infos = [info for info in list_s3_prefix(fs, prefix, recursive=recursive)
+                 if info['name'].endswith(suffix)]
+        record_listing(s3_options, infos)
+        files = []
+        for info in sorted(infos, key=lambda i:i['name']):
+            f = cls.__new__(cls)
+            f.path = 's3://' + info['name']
+            f.s3_options = s3_options
+            f.stats = stats_from_info(info)
+            files.append(f)
+        return files
 
     def __hash__(self):
         self._refresh_stats()
         hv = hash((self.path, self.stats[0], self.stats[1]),)
-        print(f"hash for {self} is {hv}")
+        logger.debug("Hashed %s", self.path, extra={'path':self.path, 'stats':self.stats})
         return hv
 
     def __getstate__(self):
         self._refresh_stats()
+        if self.s3_options:
+            return (self.path, self.stats[0], self.stats[1], self.s3_options)
+        # same state as before we supported options, to keep the cache keys
         return (self.path, self.stats[0], self.stats[1])
 
     def __setstate__(self, newstate):
         self.path = newstate[0]
         self.stats = (newstate[1], newstate[2])
-        self.fs = S3FileSystem()
+        self.s3_options = newstate[3] if len(newstate)>3 else {}
 
     def open(self, mode):
-        print(f"opening {self.path}")
+        logger.debug("Opening %s", self.path, extra={'path':self.path, 'mode':mode})
         return self.fs.open(self.path, mode)
 
     def __repr__(self):
         return f'S3File({self.path}, {self.stats})'
 
+
+class S3Prefix(CachedFile):
+    """The S3 objects under a prefix whose names end with suffix, e.g. the
+    partitions of a dataset. Only the objects directly under the prefix are
+    included, unless recursive is True. The stats are the relative path and
+    stats of each object, from a single listing. To cache a result per
+    object, see Cache.cache_partitions().
+    """
+    __slots__ = ('prefix', 'suffix', 'recursive', 'stats', 's3_options')
+
+    def __init__(self, prefix, suffix='', recursive=False, **s3_options):
+        self.prefix = prefix.rstrip('/')
+        self.suffix = suffix
+        self.recursive = recursive
+        self.s3_options = s3_options
+        self._refresh_stats()
+
+    def _refresh_stats(self):
+        self.files()
+
+    def files(self):
+        """Return an S3File for each object, sorted by path. The stats of the files
+        come from the listing, so using them does not make more requests.
+        """
+        files = S3File._list(self.prefix, self.suffix, self.recursive, self.s3_options)
+        start = len(self.prefix.replace('s3://', '', 1)) + len('s3://') + 1
+        self.stats = tuple((f.path[start:], f.stats) for f in files)
+        return files
+
+    def __hash__(self):
+        self._refresh_stats()
+        return hash((self.prefix, self.suffix, self.recursive, self.stats))
+
+    def __getstate__(self):
+        self._refresh_stats()
+        return (self.prefix, self.suffix, self.recursive, self.stats, self.s3_options)
+
+    def __setstate__(self, newstate):
+        (self.prefix, self.suffix, self.recursive, self.stats, self.s3_options) = newstate
+
+    def __repr__(self):
+        return f'S3Prefix({self.prefix}, {self.suffix}, {len(self.stats)} objects)'
+
 WRITE_ID=0
 
-class EncryptedStoreBackend(FileSystemStoreBackend):
+# Layouts for the entry (output.pkl) files. LAYOUT_JOBLIB is a standard joblib pickle.
+# LAYOUT_OOB writes large buffers out-of-band, see serialize.py.
+LAYOUT_JOBLIB='joblib'
+LAYOUT_OOB='oob'
+DEFAULT_LAYOUT=LAYOUT_OOB
+
+# Formats for DataFrame and Series results. DATAFRAME_ARROW stores them as Arrow
+# files (see columnar.py), so that a subset of the columns can be loaded.
+# DATAFRAME_PICKLE uses the entry layout, like any other result.
+DATAFRAME_ARROW='arrow'
+DATAFRAME_PICKLE='pickle'
+DEFAULT_DATAFRAME_FORMAT=DATAFRAME_ARROW if HAVE_ARROW else DATAFRAME_PICKLE
+
+class CacheMLStoreBackend(FileSystemStoreBackend):
+    """Store backend for unencrypted caches. This adds support for the out-of-band
+    entry layout, which is used for new entries if the 'layout' backend option is
+    LAYOUT_OOB, and for storing DataFrames in Arrow format, if the 'dataframe_format'
+    option is DATAFRAME_ARROW. Entries in any of these formats can always be read.
+
+    If the 'compression' option is set to a codec from compression.py, new entries
+    are compressed, at the level given by the 'compression_level' option (None
+    for the codec's default). In the encrypted subclass, the data is compressed
+    before it is encrypted.
+
+    If the 'memory_limit' option is set (in bytes), results are also kept in an
+    in-memory LRU tier (see memory_tier.py). This is not used with mmap_mode.
+
+    If the 'persist_in_background' option is True, new entries are written by a
+    background thread (see persist_queue.py), with up to 'persist_queue_limit'
+    bytes of pending entries. Use flush() to wait for them to be written.
+
+    If the 'single_flight' option is True, entry_lock() returns a lock for each
+    entry (see locks.py), with the 'lock_timeout' and 'lock_stale_after' options
+    (in seconds), so that concurrent misses compute an entry only once.
+
+    If the 'manifest' option is True, the entries are recorded in a manifest
+    database next to the cache location (see manifest.py), and get_items() (used
+    to enforce the size limit) queries it instead of walking the cache directory.
+    Use rebuild_manifest() if the manifest is lost or out of date.
+
+    With the manifest, the entries to remove when the cache is over its size limit
+    are chosen by the 'eviction_policy' option (see eviction.py, this enables the
+    manifest, default LRU), pinned entries are never removed, and if the
+    'bytes_limit' option is set, entries are removed after each write that takes
+    the cache over that limit.
+
+    If the 'metrics' option is True, the hits, misses, bytes read and written,
+    evictions and latency of each phase are recorded for each function (see
+    metrics.py), and exported every 'metrics_export_interval' seconds if set.
+    """
+    # can the entry files be memory-mapped?
+    _can_mmap = True
+    # the phase of reading the entry files, see metrics.py
+    _read_phase = PHASE_READ
+
+    def __init__(self, *args, **kwargs):
+        self._layout = DEFAULT_LAYOUT
+        self._dataframe_format = DEFAULT_DATAFRAME_FORMAT
+        self._compression = None
+        self._compression_level = None
+        self._memory = None
+        self._persist_queue = None
+        self._single_flight = False
+        self.lock_timeout = DEFAULT_LOCK_TIMEOUT
+        self._lock_stale_after = DEFAULT_STALE_AFTER
+        self._manifest = None
+        self._eviction_policy = None
+        self._bytes_limit = None
+        self._metrics = None
+        super().__init__(*args, **kwargs)
+
+    def configure(self, location, verbose=1, backend_options=None):
+        if backend_options is None:
+            backend_options = {}
+        self._layout = backend_options.pop('layout', DEFAULT_LAYOUT)
+        self._dataframe_format = backend_options.pop('dataframe_format', DEFAULT_DATAFRAME_FORMAT)
+        if self._dataframe_format==DATAFRAME_ARROW and not HAVE_ARROW:
+            raise CacheConfigError("dataframe_format 'arrow' requires pyarrow, which is not installed")
+        self._compression = backend_options.pop('compression', None)
+        self._compression_level = backend_options.pop('compression_level', None)
+        if self._compression is not None:
+            try:
+                check_codec(self._compression)
+            except ValueError as e:
+                raise CacheConfigError(str(e)) from e
+        memory_limit = backend_options.pop('memory_limit', None)
+        persist_in_background = backend_options.pop('persist_in_background', False)
+        persist_queue_limit = backend_options.pop('persist_queue_limit', None)
+        self._single_flight = backend_options.pop('single_flight', False)
+        self.lock_timeout = backend_options.pop('lock_timeout', DEFAULT_LOCK_TIMEOUT)
+        self._lock_stale_after = backend_options.pop('lock_stale_after', DEFAULT_STALE_AFTER)
+        use_manifest = backend_options.pop('manifest', False)
+        eviction_policy = backend_options.pop('eviction_policy', None)
+        self._bytes_limit = backend_options.pop('bytes_limit', None)
+        use_metrics = backend_options.pop('metrics', False)
+        metrics_export_interval = backend_options.pop('metrics_export_interval', None)
+        if eviction_policy is not None:
+            try:
+                self._eviction_policy = get_policy(eviction_policy)
+            except ValueError as e:
+                raise CacheConfigError(str(e)) from e
+            use_manifest = True
+        super().configure(location=location, verbose=verbose, backend_options=backend_options)
+        if use_manifest:
+            # outside the location, so that clearing the cache does not remove it
+            self._manifest = Manifest(self.location.rstrip(os.sep) + '.manifest.db')
+            if self._eviction_policy is None:
+                self._eviction_policy = LRUPolicy()
+        if memory_limit is not None and self.mmap_mode is None:
+            self._memory = MemoryTier(memory_limit)
+        if persist_in_background:
+            self._persist_queue = PersistQueue(persist_queue_limit if persist_queue_limit is not None
+                                               else DEFAULT_QUEUE_LIMIT)
+        if use_metrics:
+            self._metrics = CacheMetrics(metrics_export_interval)
+
+    @property
+    def memory_tier(self):
+        """The MemoryTier, or None if it is not enabled."""
+        return self._memory
+
+    def flush(self, timeout=None):
+        """Wait until the entries being persisted in the background are written.
+        Returns False if the timeout (in seconds) expired first.
+        """
+        if self._persist_queue is None:
+            return True
+        return self._persist_queue.flush(timeout)
+
+    @property
+    def manifest(self):
+        """The Manifest, or None if it is not enabled."""
+        return self._manifest
+
+    @property
+    def metrics(self):
+        """The CacheMetrics, or None if they are not enabled."""
+        return self._metrics
+
+    def _timer(self, path, phase):
+        if self._metrics is None:
+            return nullcontext()
+        return self._metrics.timer(path[0], phase)
+
+    def _count(self, path, counter, value=1):
+        if self._metrics is not None:
+            self._metrics.count(path[0], counter, value)
+
+    def _disable_manifest(self, e):
+        # e.g. the database is on a read-only filesystem
+        warnings.warn(f"Unable to use cache manifest {self._manifest.db_path}, disabling it: {e}")
+        self._manifest = None
+
+    def _update_manifest(self, method, *args):
+        """Call a method of the manifest. If the database cannot be used, we warn and
+        go back to walking the cache directory.
+        """
+        if self._manifest is None:
+            return None
+        try:
+            return getattr(self._manifest, method)(*args)
+        except sqlite3.Error as e:
+            self._disable_manifest(e)
+            return None
+
+    def _record_entry(self, path, duration=None):
+        if self._manifest is None:
+            return
+        item_path = os.path.join(self.location, *path)
+        try:
+            # skip the temporary files of concurrent writes
+            size = sum(os.path.getsize(os.path.join(item_path, name)) for name in os.listdir(item_path)
+                       if '-pid-' not in name)
+        except OSError:
+            return # being removed
+        self._update_manifest('record_entry', os.path.join(*path), size, duration)
+        self._evict_after_write(path)
+
+    def _evict_after_write(self, path):
+        if self._bytes_limit is None:
+            return
+        total = self._update_manifest('total_size')
+        if total is not None and total>self._bytes_limit:
+            self.reduce_store_size(int(self._bytes_limit*(1-EVICTION_SLACK)), keep=os.path.join(*path))
+
+    def pin(self, path, pinned=True):
+        """Pin (or unpin) the entry at the path, given as a list of strings, or all
+        the entries of a function if the path only has its id. Pinned entries are
+        never evicted. Returns the number of entries.
+        """
+        if self._manifest is None:
+            raise CacheConfigError("Pinning entries requires the cache manifest")
+        return self._update_manifest('pin', os.path.join(*path), pinned) or 0
+
+    def get_items(self):
+        """Return a CacheItemInfo for each entry. With a manifest, this is a query
+        rather than a walk of the cache directory. The size of an entry is that of
+        its files, as in the joblib version.
+        """
+        if self._manifest is not None:
+            try:
+                return [self._item_info(e) for e in self._manifest.entries()]
+            except sqlite3.Error as e:
+                self._disable_manifest(e)
+        return super().get_items()
+
+    def _item_info(self, entry):
+        return CacheItemInfo(os.path.join(self.location, entry['path']), entry['size'],
+                             datetime.datetime.fromtimestamp(entry['last_access']))
+
+    def _get_items_to_delete(self, bytes_limit, keep=None):
+        """With a manifest, the items are chosen by the eviction policy, and pinned
+        entries (and keep, the path of the entry just written) are never deleted.
+        """
+        if self._manifest is None:
+            return super()._get_items_to_delete(bytes_limit)
+        if isinstance(bytes_limit, str):
+            bytes_limit = memstr_to_bytes(bytes_limit)
+        try:
+            victims = entries_to_evict(self._manifest, self._eviction_policy, bytes_limit, keep)
+        except sqlite3.Error as e:
+            self._disable_manifest(e)
+            return super()._get_items_to_delete(bytes_limit)
+        return [self._item_info(e) for e in victims]
+
+    def reduce_store_size(self, bytes_limit, keep=None):
+        """Same as the joblib version, but the entries are chosen as described in
+        _get_items_to_delete().
+        """
+        for item in self._get_items_to_delete(bytes_limit, keep):
+            if self.verbose > 10:
+                print('Deleting item {0}'.format(item))
+            try:
+                # this may run in the persist_in_background thread, so it must not flush
+                self._clear_location(item.path)
+            except OSError:
+                # another process may be removing it as well
+                continue
+            self._count([os.path.dirname(os.path.relpath(item.path, self.location))], 'evictions')
+
+    def _scan_entries(self):
+        """Return the entries in the cache directory, as dicts with the manifest's
+        columns. The last access times come from the file system and the durations
+        from the entries' metadata. The hit counts are not known.
+        """
+        entries = []
+        for item in FileSystemStoreBackend.get_items(self):
+            path = os.path.relpath(item.path, self.location)
+            try:
+                created = os.path.getmtime(os.path.join(item.path, 'output.pkl'))
+            except OSError:
+                continue # not completely written, or being removed
+            (func_id, args_id) = os.path.split(path)
+            entries.append({'path':path, 'func_id':func_id, 'args_id':args_id, 'size':item.size,
+                            'created':created, 'last_access':max(created, item.last_access.timestamp()),
+                            'hits':None,
+                            'duration':self.get_metadata(path.split(os.sep)).get('duration', None),
+                            'pinned':0, 'inflation':0.0})
+        return entries
+
+    def list_entries(self):
+        """Return the entries as dicts with the columns of the manifest (see
+        manifest.COLUMNS). Without a manifest, the cache directory is scanned,
+        and the hits are None.
+        """
+        if self._manifest is not None:
+            try:
+                return self._manifest.entries()
+            except sqlite3.Error as e:
+                self._disable_manifest(e)
+        return self._scan_entries()
+
+    def rebuild_manifest(self):
+        """Rebuild the manifest from the entries in the cache directory, and
+        return the number of entries. The hit counts are lost.
+        """
+        assert self._manifest is not None, "The manifest is not enabled"
+        self.flush()
+        entries = self._scan_entries()
+        self._manifest.rebuild(entries)
+        return len(entries)
+
+    def verify_entries(self):
+        """Load each entry in the cache directory, and return a list of (path, error)
+        for those that cannot be loaded, e.g. truncated files or entries encrypted
+        with another key. This does not count as hits.
+        """
+        self.flush()
+        errors = []
+        for item in FileSystemStoreBackend.get_items(self):
+            path = os.path.relpath(item.path, self.location)
+            try:
+                self._load_entry(os.path.join(item.path, 'output.pkl'), None)
+            except FileNotFoundError:
+                pass # removed in the meantime
+            except Exception as e:
+                errors.append((path, e))
+        return errors
+
+    def store_metadata(self, path, metadata):
+        super().store_metadata(path, metadata)
+        self._record_entry(path, metadata.get('duration', None))
+
+    def store_cached_func_code(self, path, func_code=None):
+        """Same as the joblib version, but the code file is written atomically, so
+        that other processes checking the code never see a partial (for encrypted
+        caches, undecryptable) file.
+        """
+        func_path = os.path.join(self.location, *path)
+        if not self._item_exists(func_path):
+            self.create_location(func_path)
+        if func_code is not None:
+            def write_func(to_write, dest_filename):
+                with self._open_item(dest_filename, 'wb') as f:
+                    f.write(to_write)
+            self._concurrency_safe_write(func_code.encode('utf-8'),
+                                         os.path.join(func_path, 'func_code.py'), write_func)
+
+    def entry_lock(self, path):
+        """Return an EntryLock for the entry, or None if single_flight is not enabled."""
+        if not self._single_flight:
+            return None
+        # next to the entry directory, so that it is not counted as an entry
+        return EntryLock(os.path.join(self.location, *path) + '.lock',
+                         stale_after=self._lock_stale_after)
+
+    def release_after_persist(self, lock):
+        """Release the lock once the entries dumped so far are written, so that
+        waiters in other processes find the entry.
+        """
+        if self._persist_queue is None:
+            lock.release()
+        else:
+            self._persist_queue.after_pending(lock.release)
+
+    def _get_pending(self, path):
+        """Return (True, item) if the item is waiting to be persisted, (False, None) otherwise."""
+        if self._persist_queue is None:
+            return (False, None)
+        return self._persist_queue.get(os.path.join(*path))
+
+    def contains_item(self, path):
+        with self._timer(path, PHASE_LOOKUP):
+            return self._get_pending(path)[0] or super().contains_item(path)
+
+    def clear_location(self, location):
+        # otherwise, a pending write could recreate the entry afterwards
+        self.flush()
+        self._clear_location(location)
+
+    def _clear_location(self, location):
+        """Remove the location from the local cache directory, the memory tier and
+        the manifest.
+        """
+        if self._memory is not None:
+            self._memory.discard_prefix(os.path.relpath(location, self.location))
+        super().clear_location(location)
+        self._update_manifest('remove', os.path.relpath(location, self.location))
+
+    @contextmanager
+    def _open_entry(self, filename, mode, compress=True):
+        """Open an entry (output.pkl) file. When writing, the data is compressed if
+        we have a codec and compress is True. When reading, compressed entries are
+        detected and decompressed.
+        """
+        with self._open_item(filename, mode) as f:
+            if mode.startswith('r') and is_compressed_file(f):
+                with decompressed_reader(f) as reader:
+                    yield reader
+            elif mode.startswith('w') and compress and self._compression is not None:
+                with compressed_writer(f, self._compression, self._compression_level) as writer:
+                    yield writer
+            else:
+                yield f
+
+    def load_item(self, path, verbose=1, msg=None, columns=None):
+        """Load an item from the store given its path as a list of
+        strings. Same as the joblib version, but handles all the formats.
+        If columns is specified and the item is a DataFrame, only those
+        columns are returned (and, for Arrow entries, only those are read).
+        """
+        (found, result) = self._get_pending(path)
+        if not found and self._memory is not None:
+            (found, result) = self._memory.get(os.path.join(*path))
+        if found:
+            self._record_hit(path)
+            return select_columns(result, columns)
+        full_path = os.path.join(self.location, *path)
+        if verbose > 1:
+            if verbose < 10:
+                print('{0}...'.format(msg))
+            else:
+                print('{0} from {1}'.format(msg, full_path))
+        filename = os.path.join(full_path, 'output.pkl')
+        if not self._item_exists(filename):
+            raise KeyError("Non-existing item (may have been "
+                           "cleared).\nFile %s does not exist" % filename)
+        result = self._load_entry(filename, columns, func_id=path[0])
+        # only once the entry was loaded, so that missing or damaged ones do not count
+        self._record_hit(path)
+        if self._memory is not None and columns is None:
+            self._memory.put(os.path.join(*path), result)
+        return result
+
+    def _record_hit(self, path):
+        self._update_manifest('record_hit', os.path.join(*path))
+        self._count(path, 'hits')
+
+    def _load_entry(self, filename, columns, func_id=None):
+        """Load the entry file. If func_id is given and the metrics are enabled, we
+        record the time spent reading the file and deserializing the result.
+        """
+        if func_id is None or self._metrics is None:
+            return self._deserialize_entry(filename, columns)
+        readers = []
+        start = time.perf_counter()
+        result = self._deserialize_entry(filename, columns, readers.append)
+        total = time.perf_counter() - start
+        if len(readers)>0:
+            read_seconds = readers[0].seconds
+            self._metrics.record_reads(func_id, readers[0])
+        else:
+            # memory-mapped, the reads happen when the result is used
+            read_seconds = 0.0
+            self._metrics.count(func_id, 'bytes_read', os.path.getsize(filename))
+        # the reads are interleaved with the deserialization, we record them as
+        # if they came first
+        self._metrics.record_span(func_id, self._read_phase, start, read_seconds)
+        self._metrics.record_span(func_id, PHASE_DESERIALIZE, start+read_seconds, total-read_seconds)
+        return result
+
+    def _deserialize_entry(self, filename, columns, add_reader=None):
+        mmap_mode = self.mmap_mode if self._can_mmap else None
+        with self._open_entry(filename, "rb") as f:
+            if mmap_mode is not None and isinstance(f.raw, DecompressedReader):
+                mmap_mode = None
+            if add_reader is not None and mmap_mode is None:
+                reader = MeteredReader(f)
+                add_reader(reader)
+                f = io.BufferedReader(reader)
+            if is_arrow_file(f):
+                if mmap_mode is None:
+                    return load_arrow(f, columns)
+                else:
+                    return load_arrow_mmap(filename, columns)
+            elif is_oob_file(f):
+                if mmap_mode is None:
+                    return select_columns(load_oob(f), columns)
+            elif mmap_mode is None:
+                return select_columns(numpy_pickle.load(f), columns)
+            else:
+                return select_columns(numpy_pickle.load(filename, mmap_mode=mmap_mode), columns)
+        return select_columns(load_oob_mmap(filename, mmap_mode), columns)
+
+    def dump_item(self, path, item, verbose=1, metadata=None):
+        """Dump an item in the store at the path given as a list of
+        strings. With persist_in_background, this only queues the item.
+        If metadata is provided, it is stored once the item has been written,
+        so that it never describes an item that is not on disk.
+        """
+        if self._persist_queue is not None:
+            self._persist_queue.submit(os.path.join(*path), item,
+                                       functools.partial(self._dump_item, path, item, verbose, metadata))
+        else:
+            self._dump_item(path, item, verbose, metadata)
+
+    def _dump_item(self, path, item, verbose, metadata=None):
+        with self._timer(path, PHASE_WRITE):
+            written = self._write_item(path, item, verbose)
+        if written and metadata is not None:
+            self.store_metadata(path, metadata)
+
+    def get_metadata(self, path):
+        # the metadata of a pending item may be written along with it
+        if self._get_pending(path)[0]:
+            self.flush()
+        return super().get_metadata(path)
+
+    def _write_item(self, path, item, verbose):
+        """Write the item, returning False if it could not be persisted."""
+        arrow_codec = arrow_compression(self._compression)
+        table = to_arrow_table(item) if self._dataframe_format==DATAFRAME_ARROW and \
+                                        arrow_codec is not None else None
+        assert self._layout in (LAYOUT_JOBLIB, LAYOUT_OOB), f"Invalid layout {self._layout}"
+        try:
+            item_path = os.path.join(self.location, *path)
+            if not self._item_exists(item_path):
+                self.create_location(item_path)
+            filename = os.path.join(item_path, 'output.pkl')
+            if verbose > 10:
+                print('Persisting in %s' % item_path)
+
+            def write_func(to_write, dest_filename):
+                if table is not None:
+                    # Arrow files need random access, so Arrow does the compression
+                    with self._open_entry(dest_filename, "wb", compress=False) as f:
+                        dump_arrow(table, f, arrow_codec,
+                                   self._compression_level if self._compression is not None else None)
+                else:
+                    with self._open_entry(dest_filename, "wb") as f:
+                        if self._layout==LAYOUT_OOB:
+                            dump_oob(to_write, f)
+                        else:
+                            numpy_pickle.dump(to_write, f, compress=self.compress)
+
+            self._concurrency_safe_write(item, filename, write_func)
+            if self._metrics is not None:
+                self._count(path, 'bytes_written', os.path.getsize(filename))
+            self._record_entry(path)
+            if self._memory is not None:
+                self._memory.put(os.path.join(*path), item)
+            return True
+        except Exception as e:
+            # Like joblib, a failure to persist should not lose the caller's result
+            warnings.warn(f"Unable to persist cache entry {item_path}: {e}", stacklevel=2)
+            return False
+
+register_store_backend('cacheml', CacheMLStoreBackend)
+
+
+class EncryptedStoreBackend(CacheMLStoreBackend):
+    # memory mapping would see the ciphertext
+    _can_mmap = False
+    _read_phase = PHASE_DECRYPT
+
     def __init__(self, *args, **kwargs):
         self._key = None
+        self._read_ahead = 0
+        self._decrypt_ahead = False
+        self._write_behind = 0
+        self._file_format = DEFAULT_FORMAT
         super().__init__(*args, **kwargs)
 
     def _open_item(self, f, mode):
         assert self._key is not None
-        return encrypted_file_open(f, mode, self._key)
+        return encrypted_file_open(f, mode, self._key, read_ahead=self._read_ahead,
+                                   decrypt_ahead=self._decrypt_ahead,
+                                   write_behind=self._write_behind,
+                                   file_format=self._file_format)
 
     def _move_item(self, src, dest):
         concurrency_safe_rename(src, dest)
@@ -153,11 +892,42 @@ class EncryptedStoreBackend(FileSystemStoreBackend):
 
     def configure(self, location, verbose=1, backend_options=None):
         assert isinstance(backend_options, dict), f"Got {repr(backend_options)} for backend_options"
-        print(f"configure({location}, verbose={verbose}, backend_options={backend_options})")
+        logger.debug("Configuring encrypted cache in %s", location,
+                     extra={'location':location,
+                            'backend_options':{k:v for (k, v) in backend_options.items() if k!='key'}})
         self._key = backend_options['key']
         del backend_options['key']
+        # optional pipelining of reads and writes, see crypto.EncryptedReader and
+        # crypto.EncryptedWriter. These only apply to FORMAT_CTR files, FORMAT_GCM
+        # files are always decrypted and encrypted by the crypto thread pool.
+        self._read_ahead = backend_options.pop('read_ahead', 0)
+        self._decrypt_ahead = backend_options.pop('decrypt_ahead', False)
+        self._write_behind = backend_options.pop('write_behind', 0)
+        # format for new entries. Existing entries in either format can always be read.
+        self._file_format = backend_options.pop('file_format', DEFAULT_FORMAT)
         super().configure(location=location, verbose=verbose, backend_options=backend_options)
 
+    def rotate_key(self, new_key, workers=None, remove_damaged=False):
+        """Re-encrypt all the files of the cache with new_key, and use it from now
+        on (see rotation.py). Returns (number of files rotated, number already
+        encrypted with new_key, list of damaged files that were removed, list of
+        (filename, error) for the files that could not be rotated). The damaged
+        files are only removed if remove_damaged is set, otherwise they are errors.
+        If there are errors, the old key is kept, and the rotation can be resumed by
+        calling this again. Raises a CacheConfigError if our key does not match the
+        files of the cache.
+        """
+        self.flush()
+        try:
+            (rotated, skipped, removed, errors) = rotate_cache_key(self.location, self._key, new_key,
+                                                                   workers=workers,
+                                                                   remove_damaged=remove_damaged)
+        except ValueError as e:
+            raise CacheConfigError(str(e)) from e
+        if len(errors)==0:
+            self._key = new_key
+        return (rotated, skipped, removed, errors)
+
     # def _item_exists(self, location): # XXX
     #     r = super()._item_exists(location)
     #     print(f"_item_exists({location}) => {r}")
@@ -174,7 +944,8 @@ class EncryptedStoreBackend(FileSystemStoreBackend):
                                                         filename, write_func)
             #print(f"  CSW({write_id:3d}): finished write, temp file is {temporary_filename}")
         except Exception as e:
-            print(f"ERROR: ({write_id:03d}) concurrency_safe_write got an error: {e}", file=sys.stderr)
+            logger.error("Unable to write cache file %s: %s", filename, e,
+                         extra={'filename':filename, 'write_id':write_id})
             raise
         self._move_item(temporary_filename, filename)
         #print(f"  CWS({write_id:3d}): moved item from {temporary_filename} to {filename}")
@@ -188,10 +959,320 @@ class EncryptedStoreBackend(FileSystemStoreBackend):
 register_store_backend('encrypted', EncryptedStoreBackend)
 
 
+class S3StoreBackend(CacheMLStoreBackend):
+    """Store backend that keeps the cache in an S3 bucket, so that it can be shared
+    by many machines. The local cache location is used as a first level (L1) cache:
+    each file is written locally and then uploaded to S3 (write-through). When a
+    file is not present locally, it is downloaded from S3 (read-through), so entries
+    computed on one machine are promoted to the L1 of the others on their first use.
+
+    The backend options are 's3_url' (s3://bucket/prefix) and, optionally,
+    's3_options', a dict of keyword arguments for S3FileSystem (e.g. credentials or
+    an endpoint_url for an S3-compatible server).
+
+    Reducing the store size (the 'max_size_in_mb' setting) only removes entries from
+    the L1 (see _clear_location()). Clearing a function or the whole cache also
+    removes them from S3.
+    """
+    def __init__(self, *args, **kwargs):
+        self._s3_url = None
+        self._s3_options = None
+        super().__init__(*args, **kwargs)
+
+    def configure(self, location, verbose=1, backend_options=None):
+        assert isinstance(backend_options, dict), f"Got {repr(backend_options)} for backend_options"
+        s3_url = backend_options.pop('s3_url')
+        if not s3_url.startswith('s3://'):
+            raise CacheConfigError(f"Invalid S3 cache URL '{s3_url}', should be of the form s3://bucket/prefix")
+        self._s3_url = s3_url.rstrip('/')
+        s3_options = dict(backend_options.pop('s3_options', None) or {})
+        # other machines write to the bucket, so we cannot use cached listings
+        s3_options.setdefault('use_listings_cache', False)
+        self._s3_options = s3_options
+        super().configure(location=location, verbose=verbose, backend_options=backend_options)
+
+    @property
+    def _fs(self):
+        # from the pool, so that worker processes get their own client
+        return get_s3_filesystem(**self._s3_options)
+
+    def _s3_path(self, local_path):
+        relative = os.path.relpath(local_path, self.location)
+        if relative=='.':
+            return self._s3_url
+        return self._s3_url + '/' + '/'.join(relative.split(os.sep))
+
+    def _upload(self, local_path):
+        try:
+            self._fs.put_file(local_path, self._s3_path(local_path))
+        except Exception as e:
+            # the file is still in the L1, so just warn
+            warnings.warn(f"Unable to upload cache file {local_path} to {self._s3_path(local_path)}: {e}",
+                          stacklevel=3)
+
+    def _fetch(self, local_path):
+        """Make sure that the file is in the L1, downloading it from S3 if needed.
+        Returns False if it is not in S3 either.
+        """
+        if os.path.exists(local_path):
+            return True
+        mkdirp(os.path.dirname(local_path))
+        temporary_path = '{}.s3-thread-{}-pid-{}'.format(local_path, threading.get_ident(),
+                                                         os.getpid())
+        try:
+            self._fs.get_file(self._s3_path(local_path), temporary_path)
+        except FileNotFoundError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return False
+        concurrency_safe_rename(temporary_path, local_path)
+        if os.path.basename(local_path) in ('output.pkl', 'metadata.json'):
+            # an entry computed by another machine is now in the L1
+            path = os.path.relpath(os.path.dirname(local_path), self.location).split(os.sep)
+            self._record_entry(path, CacheMLStoreBackend.get_metadata(self, path).get('duration', None)
+                                     if self._manifest is not None else None)
+        return True
+
+    def _move_item(self, src, dest):
+        super()._move_item(src, dest)
+        self._upload(dest)
+
+    def contains_item(self, path):
+        with self._timer(path, PHASE_LOOKUP):
+            if self._get_pending(path)[0]:
+                return True
+            filename = os.path.join(self.location, *path, 'output.pkl')
+            if self._fetch(filename):
+                self._fetch(os.path.join(self.location, *path, 'metadata.json'))
+                return True
+            return False
+
+    def load_item(self, path, verbose=1, msg=None, columns=None):
+        if not self._get_pending(path)[0]:
+            self._fetch(os.path.join(self.location, *path, 'output.pkl'))
+        return super().load_item(path, verbose=verbose, msg=msg, columns=columns)
+
+    def get_metadata(self, path):
+        self._fetch(os.path.join(self.location, *path, 'metadata.json'))
+        return super().get_metadata(path)
+
+    def get_cached_func_code(self, path):
+        self._fetch(os.path.join(self.location, *path, 'func_code.py'))
+        return super().get_cached_func_code(path)
+
+    def clear_location(self, location):
+        super().clear_location(location)
+        s3_path = self._s3_path(location)
+        try:
+            if self._fs.exists(s3_path):
+                self._fs.rm(s3_path, recursive=True)
+        except FileNotFoundError:
+            pass # another machine removed it
+
+register_store_backend('s3', S3StoreBackend)
+
+
+class EncryptedS3StoreBackend(S3StoreBackend, EncryptedStoreBackend):
+    """S3 store backend for encrypted caches. The files are encrypted before they
+    are written to the L1, so S3 only ever sees the encrypted files.
+    """
+    def rotate_key(self, new_key, workers=None, remove_damaged=False):
+        raise CacheConfigError("Rotating the key of a cache in S3 is not supported")
+
+register_store_backend('encrypted_s3', EncryptedS3StoreBackend)
+
+
+def _find_s3_files(values, depth=2):
+    """Find the S3Files in the arguments, including in containers, down to
+    the given depth.
+    """
+    found = []
+    for v in values:
+        if isinstance(v, S3File):
+            found.append(v)
+        elif depth>0 and isinstance(v, (list, tuple, set, frozenset)):
+            found.extend(_find_s3_files(v, depth-1))
+        elif depth>0 and isinstance(v, dict):
+            found.extend(_find_s3_files(list(v.values()), depth-1))
+    return found
+
+
+# the first output identifiers computed in the current CachedFunc._cached_call(),
+# so that call() does not hash the arguments again on a miss
+_call_identifiers = ContextVar('cacheml_call_identifiers', default=None)
+
+
+class CachedFunc(MemorizedFunc):
+    """The function wrapper returned by Cache.cache(). In addition to the
+    MemorizedFunc methods, this can load a subset of the columns of a
+    cached DataFrame.
+    """
+    def _cached_call(self, args, kwargs, shelving=False):
+        # joblib gets the state of the arguments more than once per call, so
+        # we only stat each input file, and validate each S3File, once
+        with local_validation_scope(), s3_validation_scope(), self._profile_call():
+            token = _call_identifiers.set({})
+            try:
+                return super()._cached_call(args, kwargs, shelving=shelving)
+            finally:
+                _call_identifiers.reset(token)
+
+    def _get_output_identifiers(self, *args, **kwargs):
+        identifiers = super()._get_output_identifiers(*args, **kwargs)
+        call_state = _call_identifiers.get()
+        if call_state is not None and 'identifiers' not in call_state:
+            call_state['identifiers'] = (self, identifiers)
+        return identifiers
+
+    def _take_call_identifiers(self):
+        """Return the output identifiers computed by the current _cached_call() of
+        this function, or None. They are only returned once.
+        """
+        call_state = _call_identifiers.get()
+        if call_state is None:
+            return None
+        (func, identifiers) = call_state.get('identifiers', (None, None))
+        call_state['identifiers'] = (None, None)
+        return identifiers if func is self else None
+
+    def _profile_call(self):
+        if not is_profiling():
+            return nullcontext()
+        return profile_span(PHASE_CALL, function=_build_func_identifier(self.func))
+
+    def call(self, *args, **kwargs):
+        identifiers = self._take_call_identifiers()
+        with local_validation_scope(), s3_validation_scope():
+            if not getattr(self.store_backend, '_single_flight', False):
+                return self._compute(args, kwargs)
+            path = list(identifiers or self._get_output_identifiers(*args, **kwargs))
+            return self._call_single_flight(self.store_backend.entry_lock(path), path, args, kwargs)
+
+    @property
+    def _metrics(self):
+        return getattr(self.store_backend, 'metrics', None)
+
+    def _compute(self, args, kwargs):
+        """Call the function and persist the result (a miss)."""
+        metrics = self._metrics
+        if metrics is None:
+            return super().call(*args, **kwargs)
+        func_id = _build_func_identifier(self.func)
+        metrics.count(func_id, 'misses')
+        # the hashing and writing done by joblib's call are recorded separately
+        with metrics.timer(func_id, PHASE_COMPUTE, exclusive=True):
+            return super().call(*args, **kwargs)
+
+    def _call_single_flight(self, lock, path, args, kwargs):
+        if not lock.acquire(self.store_backend.lock_timeout):
+            self.warn(f"Timed out waiting for the lock on {lock.path}, computing the result")
+            return self._compute(args, kwargs)
+        try:
+            if lock.contended and self.store_backend.contains_item(path):
+                # another thread or process computed it while we were waiting
+                loaded = self._load_computed(path)
+                if loaded is not None:
+                    lock.release()
+                    return loaded
+            result = self._compute(args, kwargs)
+        except BaseException:
+            lock.release()
+            raise
+        self.store_backend.release_after_persist(lock)
+        return result
+
+    def pin(self, *args, **kwargs):
+        """Return the result for the arguments, computing it if needed, and pin its
+        entry so that it is never evicted. This requires the cache manifest.
+        """
+        if getattr(self.store_backend, 'manifest', None) is None:
+            raise CacheConfigError("Pinning entries requires the cache manifest")
+        result = self(*args, **kwargs)
+        # so that the entry is in the manifest
+        self.store_backend.flush()
+        self._pin(args, kwargs, True)
+        return result
+
+    def unpin(self, *args, **kwargs):
+        """Allow the entry for the arguments to be evicted again."""
+        self._pin(args, kwargs, False)
+
+    def _pin(self, args, kwargs, pinned):
+        with local_validation_scope():
+            path = list(self._get_output_identifiers(*args, **kwargs))
+        self.store_backend.pin(path, pinned)
+
+    def _load_computed(self, path):
+        try:
+            return (self.store_backend.load_item(path, verbose=self._verbose),
+                    self.store_backend.get_metadata(path))
+        except Exception as e:
+            self.warn(f"Exception while loading result computed concurrently, recomputing: {e}")
+            return None
+
+    def _s3_file_arguments(self, args, kwargs):
+        return _find_s3_files(args) + _find_s3_files(list(kwargs.values()))
+
+    def _get_argument_hash(self, *args, **kwargs):
+        metrics = self._metrics
+        if metrics is None:
+            return self._hash_arguments(args, kwargs)
+        with metrics.timer(_build_func_identifier(self.func), PHASE_HASH):
+            return self._hash_arguments(args, kwargs)
+
+    def _hash_arguments(self, args, kwargs):
+        # validate all the S3File arguments at once, rather than one at a time
+        # while hashing. Within the scope of a call, they are only validated once.
+        s3_files = self._s3_file_arguments(args, kwargs)
+        if len(s3_files)==0:
+            return super()._get_argument_hash(*args, **kwargs)
+        with s3_validation_scope():
+            with profile_span(PHASE_STAT, s3_files=len(s3_files)):
+                validate_s3_files(s3_files)
+            return super()._get_argument_hash(*args, **kwargs)
+
+    def _check_previous_func_code(self, stacklevel=2):
+        unchanged = super()._check_previous_func_code(stacklevel=stacklevel+1)
+        if unchanged:
+            # joblib only remembers the function's hash when it writes the code
+            # file. We also remember it when the code file matches, so that later
+            # calls do not have to read (and decrypt) the code file again.
+            try:
+                _FUNCTION_HASHES[self.func] = self._hash_func()
+            except TypeError:
+                pass # some callables are not hashable
+        return unchanged
+
+    def load_columns(self, columns, *args, **kwargs):
+        """Return only the specified columns of the function's result for
+        the given arguments. If the result is cached in Arrow format, only
+        those columns are read from the cache. Otherwise, the whole result is
+        loaded (or computed and cached) and then the columns are selected.
+        """
+        with local_validation_scope():
+            return self._load_columns(columns, args, kwargs)
+
+    def _load_columns(self, columns, args, kwargs):
+        func_id, args_id = self._get_output_identifiers(*args, **kwargs)
+        if self._check_previous_func_code(stacklevel=4) and \
+           self.store_backend.contains_item([func_id, args_id]):
+            try:
+                return self.store_backend.load_item([func_id, args_id], verbose=self._verbose,
+                                                    columns=columns)
+            except ColumnNotFoundError:
+                raise
+            except Exception as e:
+                self.warn(f"Exception while loading columns of cached result, recomputing: {e}")
+        (out, _) = self.call(*args, **kwargs)
+        return select_columns(out, columns)
+
+
 class Cache(Memory):
-    def __init__(self, encryption_key_name=None, verbose=1, _config_base_dir=None):
+    def __init__(self, encryption_key_name=None, verbose=1, _config_base_dir=None,
+                 memory_limit_in_mb:Optional[int]=None):
         """We read our parameters from the cache rather than from
-        passed in parameters"""
+        passed in parameters. The exception is memory_limit_in_mb, which
+        enables the in-memory tier and overrides the config file setting."""
         if _config_base_dir is None:
             _config_base_dir = abspath(expanduser('~'))
         config_dir = join(_config_base_dir, '.dml')
@@ -213,6 +1294,40 @@ class Cache(Memory):
                       else None
         if verbose>1:
             print(f"location={cache_dir}, bytes_limit={bytes_limit}, verbose={verbose}")
+        if memory_limit_in_mb is None:
+            memory_limit_in_mb = cfg_data.get('memory_limit_in_mb', None)
+        # validation of S3File and LocalFile arguments, see s3_stats.py and
+        # local_stats.py. These settings are process-wide, so each Cache sets all
+        # of them, including the defaults.
+        configure_s3_validation(ttl=cfg_data.get('s3_stats_ttl', DEFAULT_TTL),
+                                use_etag=cfg_data.get('s3_use_etag', False))
+        configure_local_validation(fingerprint=cfg_data.get('local_fingerprint', False),
+                                   index_path=cfg_data.get('fingerprint_index',
+                                                           join(config_dir, 'fingerprints.db')))
+        backend_options = {'layout':cfg_data.get('layout', DEFAULT_LAYOUT),
+                           'dataframe_format':cfg_data.get('dataframe_format', DEFAULT_DATAFRAME_FORMAT),
+                           # compression of the entries, see compression.py
+                           'compression':cfg_data.get('compression', None),
+                           'compression_level':cfg_data.get('compression_level', None),
+                           'memory_limit':1024*1024*memory_limit_in_mb if memory_limit_in_mb is not None
+                                          else None,
+                           # writing new entries in the background, see persist_queue.py
+                           'persist_in_background':cfg_data.get('persist_in_background', False),
+                           'persist_queue_limit':1024*1024*cfg_data['persist_queue_limit_in_mb']
+                                                 if cfg_data.get('persist_queue_limit_in_mb', None) is not None
+                                                 else None,
+                           # one computation per entry for concurrent misses, see locks.py
+                           'single_flight':cfg_data.get('single_flight', False),
+                           'lock_timeout':cfg_data.get('lock_timeout', DEFAULT_LOCK_TIMEOUT),
+                           'lock_stale_after':cfg_data.get('lock_stale_after', DEFAULT_STALE_AFTER),
+                           # database of the entries, see manifest.py
+                           'manifest':cfg_data.get('manifest', False),
+                           # choice of the entries to remove, see eviction.py
+                           'eviction_policy':cfg_data.get('eviction_policy', None),
+                           'bytes_limit':bytes_limit,
+                           # hit/miss and latency metrics, see metrics.py
+                           'metrics':cfg_data.get('metrics', False),
+                           'metrics_export_interval':cfg_data.get('metrics_export_interval', None)}
         if encryption_key_name is not None:
             cache_keys = cred_data['cache_keys']
             if encryption_key_name not in cache_keys:
@@ -220,10 +1335,144 @@ class Cache(Memory):
             key = cache_keys[encryption_key_name]
             if verbose>1:
                 print(f"Using encrypted backend, key {encryption_key_name}")
-            super().__init__(location=cache_dir, bytes_limit=bytes_limit, backend='encrypted',
-                             backend_options={'key':key}, verbose=verbose)
+            backend_options.update({'key':key,
+                                    'read_ahead':cfg_data.get('read_ahead', 0),
+                                    'decrypt_ahead':cfg_data.get('decrypt_ahead', False),
+                                    'write_behind':cfg_data.get('write_behind', 0),
+                                    'file_format':cfg_data.get('encryption_format', DEFAULT_FORMAT)})
+            backend = 'encrypted'
         else:
-            super().__init__(location=cache_dir, bytes_limit=bytes_limit, verbose=verbose)
+            backend = 'cacheml'
+        if cfg_data.get('s3_cache_url', None) is not None:
+            # shared cache in S3, with cache_dir as the local L1
+            backend_options['s3_url'] = cfg_data['s3_cache_url']
+            backend_options['s3_options'] = cfg_data.get('s3_options', None)
+            backend = 'encrypted_s3' if backend=='encrypted' else 's3'
+        super().__init__(location=cache_dir, bytes_limit=bytes_limit, backend=backend,
+                         backend_options=backend_options, verbose=verbose)
+        if self.metrics is not None:
+            if cfg_data.get('metrics_textfile', None) is not None:
+                self.metrics.add_exporter(PrometheusTextfileExporter(cfg_data['metrics_textfile']))
+            if cfg_data.get('metrics_json', None) is not None:
+                self.metrics.add_exporter(JSONExporter(cfg_data['metrics_json']))
+
+    @property
+    def metrics(self):
+        """The CacheMetrics of the cache (see metrics.py), or None if the "metrics"
+        setting is not enabled.
+        """
+        return getattr(self.store_backend, 'metrics', None)
+
+    @contextmanager
+    def profile(self, trace_memory=True):
+        """Profile the calls to the cached functions made in the with block, e.g.::
+
+            with cache.profile() as p:
+                df = read_commits(LocalFile('commits.csv.gz'))
+            print(p.table())
+
+        The Profile (see profile.py) has the time spent in each phase of each call,
+        the bytes and read calls, and, if trace_memory is True, the peak memory
+        (tracemalloc slows down the calls).
+        """
+        backend = self.store_backend
+        profile = Profile(backend.metrics, trace_memory=trace_memory)
+        # the backend and cached functions record their phases to the profile,
+        # which passes them on to the metrics
+        backend._metrics = profile
+        profile.start()
+        try:
+            yield profile
+        finally:
+            profile.stop()
+            backend._metrics = profile.metrics
+
+    def cache(self, func=None, ignore=None, verbose=None, mmap_mode=False):
+        """Same as Memory.cache(), but returns a CachedFunc, which adds
+        load_columns().
+        """
+        if func is None:
+            return functools.partial(self.cache, ignore=ignore,
+                                     verbose=verbose, mmap_mode=mmap_mode)
+        if self.store_backend is None:
+            return NotMemorizedFunc(func)
+        if verbose is None:
+            verbose = self._verbose
+        if mmap_mode is False:
+            mmap_mode = self.mmap_mode
+        if isinstance(func, MemorizedFunc):
+            func = func.func
+        return CachedFunc(func, location=self.store_backend,
+                          backend=self.backend,
+                          ignore=ignore, mmap_mode=mmap_mode,
+                          compress=self.compress,
+                          verbose=verbose, timestamp=self.timestamp)
+
+    def cache_partitions(self, func=None, combine=None, ignore=None, verbose=None,
+                         mmap_mode=False):
+        """Cache the results of func per partition of a dataset. The returned
+        PartitionedFunc takes a LocalDirectory or S3Prefix as its first argument,
+        and calls func(file, *args, **kwargs) for each of its files, caching each
+        result separately. The results are combined with combine(list_of_results),
+        which defaults to concatenating them (see partitions.concat_results()).
+        """
+        if func is None:
+            return functools.partial(self.cache_partitions, combine=combine, ignore=ignore,
+                                     verbose=verbose, mmap_mode=mmap_mode)
+        return PartitionedFunc(self.cache(func, ignore=ignore, verbose=verbose,
+                                          mmap_mode=mmap_mode),
+                               combine=combine)
+
+    def cache_appends(self, func=None, header_lines=1, combine=None, ignore=None,
+                      verbose=None):
+        """Cache the result of func on an append-only file (e.g. a log or CSV
+        file), updating it incrementally as the file grows. The returned AppendFunc
+        takes a LocalFile as its first argument. When only new lines were added,
+        func is called on a file with the first header_lines lines and the new lines,
+        and that result is combined with the cached one, using
+        combine(previous, new), which defaults to appending (see appends.py).
+        """
+        if func is None:
+            return functools.partial(self.cache_appends, header_lines=header_lines,
+                                     combine=combine, ignore=ignore, verbose=verbose)
+        return AppendFunc(self.cache(func, ignore=ignore, verbose=verbose),
+                          header_lines=header_lines, combine=combine)
+
+    def flush(self, timeout=None):
+        """Wait until any results being persisted in the background have been
+        written. Returns False if the timeout (in seconds) expired first.
+        """
+        if self.store_backend is None:
+            return True
+        return self.store_backend.flush(timeout)
 
+    def rebuild_manifest(self):
+        """Rebuild the manifest of the cache entries from the cache directory, e.g.
+        after it was lost or the cache was copied. Returns the number of entries.
+        """
+        if self.store_backend is None or self.store_backend.manifest is None:
+            raise CacheConfigError("The cache does not have a manifest, set 'manifest' to true in the configuration")
+        return self.store_backend.rebuild_manifest()
 
+    def rotate_key(self, new_key, workers=None, remove_damaged=False):
+        """Re-encrypt the entries of an encrypted cache with new_key (a key from
+        get_new_key()), in workers processes, and use new_key from now on. Entries
+        that cannot be decrypted are removed only if remove_damaged is set. See
+        EncryptedStoreBackend.rotate_key() for the return value.
+        """
+        if not isinstance(self.store_backend, EncryptedStoreBackend):
+            raise CacheConfigError("The cache is not encrypted, so it has no key to rotate")
+        return self.store_backend.rotate_key(new_key, workers=workers, remove_damaged=remove_damaged)
 
+    def acache(self, func=None, ignore=None, verbose=None):
+        """Same as cache(), for coroutine functions (async def). The returned
+        AsyncCachedFunc checks, loads and stores the results without blocking the
+        event loop (see async_cache.py).
+        """
+        if func is None:
+            return functools.partial(self.acache, ignore=ignore, verbose=verbose)
+        if not asyncio.iscoroutinefunction(func):
+            raise TypeError(f"acache() requires a coroutine function, got {func!r}")
+        if self.store_backend is None:
+            return func
+        return AsyncCachedFunc(self.cache(func, ignore=ignore, verbose=verbose))
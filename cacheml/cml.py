@@ -1,15 +1,75 @@
 #!/usr/bin/env  python3
 """
-Command line tool for Cache ML
-This is not finished yet!
+Command line tool for Cache ML: initialize the configuration, manage and rotate keys,
+and maintain the cache (statistics, garbage collection, verification and warming).
 """
 # Copyright 2021 Benedat LLC
 # Apache 2.0 license
 
 __all__ = ["cli"]
 import sys
-import click
+import os
+from os.path import abspath, expanduser, join, exists
+import json
+import time
+import importlib
+import datetime
 from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+from joblib.memory import MemorizedFunc
+from joblib._store_backends import FileSystemStoreBackend
+
+try:
+    from .crypto import get_new_key
+    from .cache import Cache, CacheConfigError, CommandError, init_cache, LocalFile, S3File
+except ImportError:
+    # when running locally
+    from crypto import get_new_key
+    from cache import Cache, CacheConfigError, CommandError, init_cache, LocalFile, S3File
+
+MB=1024*1024
+
+key_option = click.option(
+    "-k",
+    "--key",
+    "key_name",
+    default=None,
+    help="Name of the encryption key of the cache (default: unencrypted cache).",
+)
+
+
+def _config_dir(ctx):
+    base_dir = ctx.obj.config_base_dir
+    return join(base_dir if base_dir is not None else abspath(expanduser('~')), '.dml')
+
+
+def _open_cache(ctx, key_name):
+    try:
+        return Cache(encryption_key_name=key_name, verbose=0, _config_base_dir=ctx.obj.config_base_dir)
+    except CacheConfigError as e:
+        raise click.ClickException(str(e))
+
+
+def _read_credentials(ctx):
+    cred_file = join(_config_dir(ctx), 'credentials')
+    if not exists(cred_file):
+        raise click.ClickException(f"Credentials file {cred_file} not found. Run 'cml init' first.")
+    with open(cred_file, 'r') as f:
+        return (cred_file, json.load(f))
+
+
+def _write_credentials(cred_file, cred_data):
+    # write a new file and rename it, so that the credentials are never partially written
+    temp_file = cred_file + '.tmp'
+    with os.fdopen(os.open(temp_file, os.O_CREAT|os.O_WRONLY|os.O_TRUNC, 0o600), 'w') as g:
+        json.dump(cred_data, g, indent=2)
+    os.replace(temp_file, cred_file)
+
+
+def _format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
 
 
 @click.group()
@@ -26,29 +86,276 @@ from argparse import Namespace
     is_flag=True,
     help="Print extra debugging information and ask for confirmation before running actions.",
 )
+@click.option(
+    "--config-base-dir",
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Directory containing the .dml configuration directory (default: home directory).",
+)
 @click.pass_context
-def cli(ctx, batch, verbose):
+def cli(ctx, batch, verbose, config_base_dir):
     ctx.obj = Namespace()
     ctx.obj.batch = batch
     ctx.obj.verbose = verbose
+    ctx.obj.config_base_dir = config_base_dir
     global VERBOSE_MODE
     VERBOSE_MODE = verbose
 
 
 @click.command()
-@click.argument("name", default="default")
+@click.argument("cache_dir", type=click.Path(file_okay=False))
+@click.option("--max-size-in-mb", type=int, default=None,
+              help="Size limit of the cache (default: no limit).")
 @click.pass_context
-def initcache(ctx, )
+def init(ctx, cache_dir, max_size_in_mb):
+    """Create the configuration and credentials files (in ~/.dml), for a cache
+    in CACHE_DIR. The credentials get a new encryption key named 'default'.
+    """
+    try:
+        init_cache(abspath(expanduser(cache_dir)), max_size_in_mb, _config_base_dir=ctx.obj.config_base_dir)
+    except CommandError as e:
+        raise click.ClickException(str(e))
+
+
 @click.command()
 @click.argument("name", default="default")
 @click.pass_context
 def keygen(ctx, name):
-    """Generate a new cache encryption key with the specified name.
-    The default key name is 'default'.
+    """Generate a new cache encryption key with the specified name, and add
+    it to the credentials file. The default key name is 'default'.
     """
-    click.echo(f"keygen {name}")
+    (cred_file, cred_data) = _read_credentials(ctx)
+    cache_keys = cred_data.setdefault('cache_keys', {})
+    if name in cache_keys:
+        raise click.ClickException(f"There is already a key named {name} in {cred_file}")
+    cache_keys[name] = get_new_key()
+    _write_credentials(cred_file, cred_data)
+    click.echo(f"Added key {name} to {cred_file}")
+
+
+@click.command(name="rotate-key")
+@click.option("-k", "--key", "key_name", default="default",
+              help="Name of the encryption key of the cache (default: 'default').")
+@click.option("-j", "--workers", type=int, default=None,
+              help="Number of worker processes (default: number of CPUs).")
+@click.option("--remove-damaged", is_flag=True, default=False,
+              help="Remove the files that cannot be decrypted with either key.")
+@click.pass_context
+def rotate_key(ctx, key_name, workers, remove_damaged):
+    """Re-encrypt the cache with a new key, which replaces the key in the
+    credentials file. The old key is kept as NAME.previous. The new key is
+    saved as NAME.next before the rotation starts, so if it is interrupted
+    or fails, running the command again resumes it. The cache should not
+    be used during the rotation. Files that cannot be decrypted are errors,
+    unless --remove-damaged is given. Exits with status 1 if there are errors.
+    """
+    (cred_file, cred_data) = _read_credentials(ctx)
+    cache_keys = cred_data.get('cache_keys', {})
+    if key_name not in cache_keys:
+        raise click.ClickException(f"There is no key named {key_name} in {cred_file}")
+    next_name = key_name + '.next'
+    if next_name in cache_keys:
+        click.echo(f"Resuming the rotation of key {key_name}")
+    else:
+        cache_keys[next_name] = get_new_key()
+        _write_credentials(cred_file, cred_data)
+    cache = _open_cache(ctx, key_name)
+    start = time.time()
+    try:
+        (rotated, skipped, removed, errors) = cache.rotate_key(cache_keys[next_name], workers=workers,
+                                                              remove_damaged=remove_damaged)
+    except CacheConfigError as e:
+        raise click.ClickException(str(e))
+    for filename in removed:
+        click.echo(f"Removed {filename}, which could not be decrypted", err=True)
+    for (filename, e) in errors:
+        click.echo(f"Unable to rotate {filename}: {e}", err=True)
+    click.echo(f"Re-encrypted {rotated} files ({skipped} already done) in {time.time()-start:.1f}s")
+    if len(errors)>0:
+        click.echo(f"The key was not changed, run 'cml rotate-key --key {key_name}' again to resume",
+                   err=True)
+        ctx.exit(1)
+    cache_keys[key_name + '.previous'] = cache_keys[key_name]
+    cache_keys[key_name] = cache_keys.pop(next_name)
+    _write_credentials(cred_file, cred_data)
+    click.echo(f"Key {key_name} replaced in {cred_file}")
+
+
+@click.command()
+@key_option
+@click.pass_context
+def stats(ctx, key_name):
+    """Print the number of entries, size, hits and compute time of the cached
+    results of each function. The hits are only known for caches with a manifest.
+    """
+    cache = _open_cache(ctx, key_name)
+    by_func = {}
+    for e in cache.store_backend.list_entries():
+        by_func.setdefault(e['func_id'], []).append(e)
+    click.echo(f"{'function':<50} {'entries':>7} {'size MB':>9} {'hits':>7} {'compute s':>10} {'last access':>16}")
+    for (func_id, entries) in sorted(by_func.items(), key=lambda kv: -sum(e['size'] for e in kv[1])):
+        hits = [e['hits'] for e in entries if e['hits'] is not None]
+        click.echo(f"{func_id:<50} {len(entries):7d} {sum(e['size'] for e in entries)/MB:9.1f} " +
+                   f"{sum(hits) if len(hits)>0 else '-':>7} " +
+                   f"{sum(e['duration'] or 0.0 for e in entries):10.1f} " +
+                   f"{_format_time(max(e['last_access'] for e in entries)):>16}")
+    all_entries = [e for entries in by_func.values() for e in entries]
+    limit = f" of {cache.bytes_limit/MB:.0f}" if cache.bytes_limit is not None else ''
+    click.echo(f"Total: {len(all_entries)} entries, {sum(e['size'] for e in all_entries)/MB:.1f}{limit} MB " +
+               f"in {cache.location}")
+
+
+@click.command()
+@key_option
+@click.option("--max-size-in-mb", type=int, default=None,
+              help="Size to reduce the cache to (default: max_size_in_mb from the configuration).")
+@click.pass_context
+def gc(ctx, key_name, max_size_in_mb):
+    """Remove entries until the cache is under its size limit. The entries are
+    chosen by the eviction policy (least recently used by default).
+    """
+    cache = _open_cache(ctx, key_name)
+    bytes_limit = max_size_in_mb*MB if max_size_in_mb is not None else cache.bytes_limit
+    if bytes_limit is None:
+        raise click.ClickException("The cache has no size limit, set max_size_in_mb in the configuration " +
+                                   "or use --max-size-in-mb")
+    backend = cache.store_backend
+    before = backend.get_items()
+    backend.reduce_store_size(bytes_limit)
+    after = backend.get_items()
+    click.echo(f"Removed {len(before)-len(after)} entries, " +
+               f"{sum(i.size for i in before)/MB:.1f} MB => {sum(i.size for i in after)/MB:.1f} MB")
+
+
+@click.command()
+@key_option
+@click.option("--remove", default=False, is_flag=True,
+              help="Remove the entries that cannot be loaded.")
+@click.pass_context
+def verify(ctx, key_name, remove):
+    """Check that every entry in the cache can be loaded, and that the manifest
+    (if enabled) matches the cache directory. Exits with status 1 if there
+    are errors.
+    """
+    cache = _open_cache(ctx, key_name)
+    backend = cache.store_backend
+    errors = backend.verify_entries()
+    for (path, e) in errors:
+        click.echo(f"Unable to load {path}: {e}", err=True)
+        if remove:
+            backend.clear_item(path.split(os.sep))
+    num_errors = len(errors)
+    if backend.manifest is not None:
+        on_disk = {os.path.relpath(item.path, backend.location)
+                   for item in FileSystemStoreBackend.get_items(backend)}
+        recorded = {e['path'] for e in backend.manifest.entries()}
+        if on_disk!=recorded:
+            click.echo(f"The manifest has {len(recorded-on_disk)} entries that are not in the cache " +
+                       f"directory and is missing {len(on_disk-recorded)}, " +
+                       "run 'cml rebuild-manifest' to update it", err=True)
+            num_errors += 1
+    click.echo(f"Checked the cache in {cache.location}: {len(errors)} bad entries" +
+               (" (removed)" if remove and len(errors)>0 else ''))
+    if num_errors>0:
+        ctx.exit(1)
+
+
+@click.command(name="rebuild-manifest")
+@key_option
+@click.pass_context
+def rebuild_manifest(ctx, key_name):
+    """Rebuild the manifest of the cache entries from the cache directory."""
+    cache = _open_cache(ctx, key_name)
+    try:
+        num_entries = cache.rebuild_manifest()
+    except CacheConfigError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Rebuilt the manifest with {num_entries} entries")
+
+
+# The cache of each worker process of the warm command
+_WARM_CACHE = None
+
+def _init_warm_worker(config_base_dir, key_name):
+    global _WARM_CACHE
+    _WARM_CACHE = Cache(encryption_key_name=key_name, verbose=0, _config_base_dir=config_base_dir)
+
+
+def _load_function(spec):
+    (module_name, _, name) = spec.partition(':')
+    if name=='':
+        raise ValueError(f"Invalid function '{spec}', should be module:function")
+    func = importlib.import_module(module_name)
+    for attr in name.split('.'):
+        func = getattr(func, attr)
+    return func
+
+
+def _warm_one(spec, filename, kwargs):
+    """Compute the function's result for the file, unless it is already in the
+    cache. Returns (True if it was already cached, seconds).
+    """
+    func = _load_function(spec)
+    if not hasattr(func, 'store_backend'):
+        # not already cached by its module
+        func = _WARM_CACHE.cache(func)
+    arg = S3File(filename) if filename.startswith('s3://') else LocalFile(filename)
+    start = time.time()
+    was_cached = func.check_call_in_cache(arg, **kwargs) if isinstance(func, MemorizedFunc) else False
+    if not was_cached:
+        func(arg, **kwargs)
+    # the worker processes exit without flushing the background writes (functions
+    # cached with a plain joblib Memory have no flush())
+    if hasattr(func.store_backend, 'flush'):
+        func.store_backend.flush()
+    return (was_cached, time.time()-start)
+
+
+@click.command()
+@click.argument("warm_file", type=click.Path(exists=True, dir_okay=False))
+@key_option
+@click.option("-j", "--workers", type=int, default=None,
+              help="Number of worker processes (default: number of CPUs).")
+@click.pass_context
+def warm(ctx, warm_file, key_name, workers):
+    """Fill the cache with the results of functions on input files, in parallel.
+    WARM_FILE is a JSON list of objects with a "function" (module:function), the
+    "files" to call it on (local paths or s3:// URLs, as the only positional
+    argument), and optionally "kwargs". Functions that are not already cached
+    by their module are cached in the configured cache. Exits with status 1 if
+    any call fails.
+    """
+    with open(warm_file, 'r') as f:
+        specs = json.load(f)
+    tasks = [(spec['function'], filename, spec.get('kwargs', {}))
+             for spec in specs for filename in spec['files']]
+    _open_cache(ctx, key_name) # check the configuration before starting the workers
+    failed = 0
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_warm_worker,
+                             initargs=(ctx.obj.config_base_dir, key_name)) as executor:
+        futures = {executor.submit(_warm_one, *task):task for task in tasks}
+        for future in as_completed(futures):
+            (function, filename, _) = futures[future]
+            try:
+                (was_cached, seconds) = future.result()
+                click.echo(f"{'cached' if was_cached else 'computed':<8} {seconds:8.1f}s {function} {filename}")
+            except Exception as e:
+                failed += 1
+                click.echo(f"{'failed':<8} {function} {filename}: {e}", err=True)
+    click.echo(f"Warmed {len(tasks)-failed} of {len(tasks)} results in {time.time()-start:.1f}s")
+    if failed>0:
+        ctx.exit(1)
+
 
+cli.add_command(init)
 cli.add_command(keygen)
+cli.add_command(rotate_key)
+cli.add_command(stats)
+cli.add_command(gc)
+cli.add_command(verify)
+cli.add_command(rebuild_manifest)
+cli.add_command(warm)
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,160 @@
+"""Columnar storage of DataFrame and Series results using Arrow IPC (Feather v2).
+
+Storing a DataFrame this way lets us load a subset of the columns: the Arrow
+reader only reads the buffers of the columns that were requested. This requires
+a seekable file, which both the plain and the encrypted file objects are.
+
+This requires pyarrow, which is an optional dependency. If it is not installed,
+or a DataFrame cannot be converted without changing its data (e.g. mixed-type object
+columns, non-string column names, or object columns of lists or dicts, which would
+come back as arrays and structs), the result is pickled as usual.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import json
+
+try:
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    HAVE_ARROW=True
+except ImportError:
+    HAVE_ARROW=False
+
+ARROW_MAGIC=b'ARROW1'
+# key of our own metadata in the schema
+_METADATA_KEY=b'cacheml'
+_SERIES_COLUMN='__series__'
+
+
+class ColumnNotFoundError(KeyError):
+    """One or more requested columns are not in the cached DataFrame."""
+    pass
+
+
+def is_arrow_file(fileobj):
+    """Return True if the file object is positioned at the start of an Arrow file.
+    The file object must support peek().
+    """
+    return fileobj.peek(len(ARROW_MAGIC))[0:len(ARROW_MAGIC)]==ARROW_MAGIC
+
+
+def to_arrow_table(obj):
+    """Convert a DataFrame or Series to an Arrow table. Returns None if obj is not
+    a DataFrame or Series, or cannot be converted exactly.
+    """
+    if not HAVE_ARROW:
+        return None
+    metadata = {'series':False, 'object_columns':[], 'object_index':False}
+    if isinstance(obj, pd.Series):
+        if obj.name is not None and not isinstance(obj.name, str):
+            return None
+        metadata['series'] = True
+        metadata['series_name'] = obj.name
+        df = obj.to_frame(name=_SERIES_COLUMN)
+    elif isinstance(obj, pd.DataFrame):
+        df = obj
+    else:
+        return None
+    if isinstance(df.columns, pd.MultiIndex) or (not df.columns.is_unique) or \
+       not all(isinstance(c, str) for c in df.columns) or \
+       isinstance(df.index, pd.MultiIndex):
+        return None
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+    except (pa.ArrowException, TypeError, ValueError):
+        return None
+    # Nested values (lists, tuples, dicts) are inferred as Arrow lists, structs or
+    # maps, which come back as numpy arrays and dicts with the missing keys filled in.
+    if any(pa.types.is_nested(field.type) for field in table.schema):
+        return None
+    freq = getattr(df.index, 'freq', None)
+    metadata['index_freq'] = freq.freqstr if freq is not None else None
+    # Arrow strings may come back as a string dtype, so we remember which
+    # columns were object columns and convert them back when loading.
+    metadata['object_columns'] = [c for c in df.columns if df[c].dtype==object]
+    metadata['object_index'] = (df.index.dtype==object)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[_METADATA_KEY] = json.dumps(metadata).encode('utf-8')
+    return table.replace_schema_metadata(schema_metadata)
+
+
+def dump_arrow(table, fileobj, compression='uncompressed', compression_level=None):
+    """Write a table from to_arrow_table() to the file object. If compression is
+    'zstd' or 'lz4', each buffer is compressed separately, so column projection
+    still works.
+    """
+    feather.write_feather(table, fileobj, compression=compression,
+                          compression_level=compression_level)
+
+
+def _to_pandas(table, columns):
+    metadata = json.loads(table.schema.metadata[_METADATA_KEY].decode('utf-8'))
+    df = table.to_pandas()
+    for c in metadata['object_columns']:
+        if c in df.columns and df[c].dtype!=object:
+            df[c] = df[c].astype(object)
+    if metadata['object_index'] and df.index.dtype!=object:
+        df.index = df.index.astype(object)
+    if metadata.get('index_freq') is not None:
+        df.index.freq = metadata['index_freq']
+    if metadata['series']:
+        return df[_SERIES_COLUMN].rename(metadata['series_name'])
+    if columns is not None:
+        # to_pandas() returns the columns in the file's order
+        df = df[list(columns)]
+    return df
+
+
+def _read_columns(table_schema, columns):
+    """Return the names of the fields to read for the requested columns. We always
+    need the index columns to rebuild the index.
+    """
+    if columns is None:
+        return None
+    missing = [c for c in columns if c not in table_schema.names]
+    if len(missing)>0:
+        raise ColumnNotFoundError(f"Columns {missing} not in cached DataFrame")
+    index_columns = [c for c in table_schema.pandas_metadata['index_columns']
+                     if isinstance(c, str)]
+    return list(columns) + [c for c in index_columns if c not in columns]
+
+
+def _load(source, columns):
+    reader = pa.ipc.open_file(source)
+    if columns is not None and not _is_series(reader.schema):
+        field_names = _read_columns(reader.schema, columns)
+        included = [reader.schema.get_field_index(name) for name in field_names]
+        reader = pa.ipc.open_file(source, options=pa.ipc.IpcReadOptions(included_fields=included))
+    else:
+        columns = None
+    return _to_pandas(reader.read_all(), columns)
+
+
+def load_arrow(fileobj, columns=None):
+    """Load a DataFrame or Series from an Arrow file, given a seekable file object.
+    If columns is provided, only those columns are read (it is ignored for a Series).
+    """
+    return _load(pa.PythonFile(fileobj, mode='r'), columns)
+
+
+def load_arrow_mmap(filename, columns=None):
+    """Load a DataFrame or Series from an unencrypted Arrow file by memory-mapping it.
+    """
+    with pa.memory_map(filename, 'r') as source:
+        return _load(source, columns)
+
+
+def _is_series(schema):
+    return json.loads(schema.metadata[_METADATA_KEY].decode('utf-8'))['series']
+
+
+def select_columns(obj, columns):
+    """Apply a column projection to a result that was not stored in Arrow format."""
+    if columns is None or not HAVE_ARROW or not isinstance(obj, pd.DataFrame):
+        return obj
+    missing = [c for c in columns if c not in obj.columns]
+    if len(missing)>0:
+        raise ColumnNotFoundError(f"Columns {missing} not in cached DataFrame")
+    return obj[list(columns)]
@@ -0,0 +1,331 @@
+"""Streaming compression of cache entries.
+
+Encrypted data does not compress, so compression has to happen before encryption.
+Here, we provide file objects that compress what is written to them and write the
+result to an underlying file object (e.g. one from encrypted_file_open()), and that
+decompress what is read from an underlying file object.
+
+A compressed entry starts with a header consisting of COMPRESSED_MAGIC followed by a
+byte identifying the codec. The rest of the file is a single compressed stream.
+
+The compressed streams are not randomly accessible. The reader supports seeking
+forward (by decompressing and discarding data), which is all that the pickle-based
+entry layouts need. Arrow entries use Arrow's own compression of individual buffers
+instead, so that loading a subset of the columns still works (see arrow_compression()).
+If Arrow does not support the codec, DataFrames are pickled and compressed like any
+other result.
+
+Available codecs are zlib (always available), and zstd and lz4, which require the
+optional zstandard and lz4 packages.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import io
+import zlib
+import struct
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+    HAVE_LZ4 = True
+except ImportError:
+    HAVE_LZ4 = False
+
+CODEC_ZLIB='zlib'
+CODEC_ZSTD='zstd'
+CODEC_LZ4='lz4'
+
+COMPRESSED_MAGIC=b'CMLCMP\x00'
+_HEADER=struct.Struct('7sB')
+_CODEC_IDS={CODEC_ZLIB:1, CODEC_ZSTD:2, CODEC_LZ4:3}
+_CODECS_BY_ID={v:k for (k, v) in _CODEC_IDS.items()}
+DEFAULT_LEVELS={CODEC_ZLIB:6, CODEC_ZSTD:3, CODEC_LZ4:0}
+
+# size of the reads from the underlying file when decompressing
+_CHUNK_SIZE=256*1024
+BUF_SIZE=1024*1024
+
+
+def available_codecs():
+    """Return the list of codecs that can be used with the installed packages."""
+    codecs = [CODEC_ZLIB]
+    if zstandard is not None:
+        codecs.append(CODEC_ZSTD)
+    if HAVE_LZ4:
+        codecs.append(CODEC_LZ4)
+    return codecs
+
+
+def check_codec(codec):
+    """Raise a ValueError if the codec is unknown or its package is not installed."""
+    if codec not in _CODEC_IDS:
+        raise ValueError(f"Unknown compression codec '{codec}', valid codecs are {', '.join(_CODEC_IDS.keys())}")
+    if codec not in available_codecs():
+        raise ValueError(f"Compression codec '{codec}' requires a package that is not installed")
+
+
+def arrow_compression(codec):
+    """Return the Arrow IPC compression to use for the codec, or None if Arrow
+    does not support the codec (Arrow only supports zstd and lz4).
+    """
+    if codec is None:
+        return 'uncompressed'
+    return codec if codec in (CODEC_ZSTD, CODEC_LZ4) else None
+
+
+def _make_compressor(codec, level):
+    if codec==CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    elif codec==CODEC_LZ4:
+        return _LZ4Compressor(level)
+    else:
+        return zlib.compressobj(level)
+
+
+def _make_decompressor(codec):
+    """Return a decompressor with the interface of lz4's: decompress(data, max_length),
+    needs_input and eof. zstd is read with ZstdStreamReader instead.
+    """
+    if codec==CODEC_LZ4:
+        return lz4.frame.LZ4FrameDecompressor()
+    else:
+        return _ZlibDecompressor()
+
+
+class _ZlibDecompressor:
+    """Give the zlib decompressor the same interface as lz4's"""
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+        self.needs_input = True
+
+    @property
+    def eof(self):
+        return self.decompressor.eof
+
+    def decompress(self, data, max_length):
+        # if we did not need input, data is empty and we continue with the tail
+        output = self.decompressor.decompress(data or self.decompressor.unconsumed_tail, max_length)
+        self.needs_input = len(self.decompressor.unconsumed_tail)==0 and len(output)<max_length
+        return output
+
+
+class _ZstdFrame:
+    """Follows the block structure of a zstd frame (see RFC 8878) in the compressed
+    data passed to update(), so that we know whether the frame is complete. The
+    zstandard stream reader bounds the size of its output, but silently stops at
+    the end of a truncated frame.
+    """
+    def __init__(self):
+        self.pending = bytearray()
+        self.skip = 0 # bytes of the current section left to skip
+        self.state = 'header'
+        self.checksum = False
+        self.complete = False
+
+    def update(self, data):
+        self.pending += data
+        while not self.complete:
+            if self.skip>0:
+                n = min(self.skip, len(self.pending))
+                del self.pending[0:n]
+                self.skip -= n
+                if self.skip>0:
+                    return
+            if self.state=='end':
+                self.complete = True
+            elif self.state=='header':
+                # magic number and frame header descriptor
+                if len(self.pending)<5:
+                    return
+                descriptor = self.pending[4]
+                single_segment = (descriptor>>5)&1
+                self.checksum = bool((descriptor>>2)&1)
+                fcs_size = (1 if single_segment else 0, 2, 4, 8)[descriptor>>6]
+                self.skip = 5 + (0 if single_segment else 1) + (0, 1, 2, 4)[descriptor&3] + fcs_size
+                self.state = 'block'
+            else:
+                if len(self.pending)<3:
+                    return
+                header = int.from_bytes(self.pending[0:3], 'little')
+                block_type = (header>>1)&3
+                # an RLE block has a single byte, whatever its size
+                self.skip = 3 + (1 if block_type==1 else header>>3)
+                if header&1:
+                    self.skip += 4 if self.checksum else 0
+                    self.state = 'end'
+
+
+class _ZstdSource:
+    """The compressed data read by the zstandard stream reader, passed to a _ZstdFrame."""
+    def __init__(self, fileobj, frame):
+        self.fileobj = fileobj
+        self.frame = frame
+
+    def read(self, size):
+        data = self.fileobj.read(size)
+        self.frame.update(data)
+        return data
+
+
+class _LZ4Compressor:
+    """Give the lz4 frame compressor the same interface as the others"""
+    def __init__(self, level):
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.started = False
+
+    def compress(self, data):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.compress(data)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.flush()
+        return self.compressor.flush()
+
+
+class CompressedWriter(io.RawIOBase):
+    """Compress data and write it to fileobj. Closing this does not close fileobj.
+    """
+    def __init__(self, fileobj, codec, level=None):
+        super().__init__()
+        check_codec(codec)
+        self.fileobj = fileobj
+        self.codec = codec
+        self.compressor = _make_compressor(codec, DEFAULT_LEVELS[codec] if level is None else level)
+        self.fileobj.write(_HEADER.pack(COMPRESSED_MAGIC, _CODEC_IDS[codec]))
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        data = self.compressor.compress(b)
+        if len(data)>0:
+            self.fileobj.write(data)
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.fileobj.write(self.compressor.flush())
+
+
+class DecompressedReader(io.RawIOBase):
+    """Read and decompress data from fileobj, which must be positioned just after
+    the header. Closing this does not close fileobj. Each read decompresses at most
+    the size requested, so a highly compressible entry never needs a large
+    intermediate buffer.
+    """
+    def __init__(self, fileobj, codec):
+        super().__init__()
+        self.fileobj = fileobj
+        self.codec = codec
+        if codec==CODEC_ZSTD:
+            self.frame = _ZstdFrame()
+            self.stream = zstandard.ZstdDecompressor().stream_reader(
+                _ZstdSource(fileobj, self.frame), read_size=_CHUNK_SIZE, closefd=False)
+        else:
+            self.decompressor = _make_decompressor(codec)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _read_stream(self, view):
+        try:
+            n = self.stream.readinto(view)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Compressed cache entry is damaged: {e}") from e
+        if n==0 and len(view)>0 and not self.frame.complete:
+            raise ValueError("Compressed cache entry is truncated")
+        return n
+
+    def _decompress(self, view):
+        while not self.decompressor.eof:
+            if self.decompressor.needs_input:
+                data = self.fileobj.read(_CHUNK_SIZE)
+                if len(data)==0:
+                    raise ValueError("Compressed cache entry is truncated")
+            else:
+                data = b''
+            try:
+                output = self.decompressor.decompress(data, len(view))
+            except (zlib.error, RuntimeError) as e: # lz4 raises RuntimeError
+                raise ValueError(f"Compressed cache entry is damaged: {e}") from e
+            if len(output)>0:
+                view[0:len(output)] = output
+                return len(output)
+        return 0
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        if len(view)==0:
+            return 0
+        n = self._read_stream(view) if self.codec==CODEC_ZSTD else self._decompress(view)
+        self.position += n
+        return n
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence==io.SEEK_CUR:
+            offset += self.position
+        elif whence!=io.SEEK_SET:
+            raise io.UnsupportedOperation("Compressed cache entries do not support seeking from the end")
+        if offset<self.position:
+            raise io.UnsupportedOperation("Compressed cache entries can only seek forward")
+        scratch = bytearray(min(offset-self.position, _CHUNK_SIZE))
+        while self.position<offset:
+            view = memoryview(scratch)[0:min(offset-self.position, len(scratch))]
+            if self.readinto(view)==0:
+                break
+        return self.position
+
+
+def is_compressed_file(fileobj):
+    """Return True if the file object is positioned at the start of a compressed
+    entry. The file object must support peek().
+    """
+    return fileobj.peek(len(COMPRESSED_MAGIC))[0:len(COMPRESSED_MAGIC)]==COMPRESSED_MAGIC
+
+
+@contextmanager
+def compressed_writer(fileobj, codec, level=None, buf_size=BUF_SIZE):
+    """Return a buffered file object that compresses the data written to it
+    and writes the result to fileobj.
+    """
+    writer = io.BufferedWriter(CompressedWriter(fileobj, codec, level), buffer_size=buf_size)
+    try:
+        yield writer
+    finally:
+        writer.close()
+
+
+@contextmanager
+def decompressed_reader(fileobj, buf_size=BUF_SIZE):
+    """Return a buffered file object for the decompressed contents of fileobj,
+    which must be positioned at the start of a compressed entry.
+    """
+    header = fileobj.read(_HEADER.size)
+    (magic, codec_id) = _HEADER.unpack(header)
+    if magic!=COMPRESSED_MAGIC or codec_id not in _CODECS_BY_ID:
+        raise ValueError("Cache entry does not have a valid compression header")
+    codec = _CODECS_BY_ID[codec_id]
+    check_codec(codec)
+    reader = io.BufferedReader(DecompressedReader(fileobj, codec), buffer_size=buf_size)
+    try:
+        yield reader
+    finally:
+        reader.close()
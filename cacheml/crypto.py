@@ -5,12 +5,36 @@
 
 
 import binascii
+import io
+import os
+import struct
+import threading
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from contextlib import contextmanager
 
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 
 BUF_SIZE=1024*1024
+AES_BLOCK_SIZE=16
+
+# File formats. FORMAT_CTR is the original format: a single AES-CTR stream with no
+# header, and the nonce taken from the file name. FORMAT_GCM is a versioned format
+# with a header, followed by fixed-size frames, each encrypted and authenticated
+# separately with AES-GCM. This lets us decrypt frames in parallel, seek directly to a
+# frame, and detect corruption or tampering.
+FORMAT_CTR='ctr'
+FORMAT_GCM='gcm'
+DEFAULT_FORMAT=FORMAT_GCM
+
+# The header is: magic, version, frame size, and a random file id. The file id and the
+# frame index make up the GCM nonce for each frame.
+GCM_MAGIC=b'CacheML\x00'
+GCM_VERSION=1
+GCM_TAG_SIZE=16
+_GCM_HEADER=struct.Struct('>8sB3xI8s')
 
 def bin_to_hex_str(bdata):
     return binascii.hexlify(bdata).decode('ascii')
@@ -50,10 +74,16 @@ def _get_nonce(filepath):
         return encoded[-8:]
 
 
-class EncryptedFile:
-    __slots__ = ('filename', 'key', 'mode', 'buf_size', 'nonce', 'cipher', 'fileobj')
+class EncryptedFile(io.RawIOBase):
+    """Base class for the encrypted raw files. These implement the unbuffered
+    io.RawIOBase interface and are wrapped in the standard io.BufferedReader and
+    io.BufferedWriter classes by encrypted_file_open(). Thus, the many small reads
+    and writes done by pickle are handled by the C buffering code, and we only
+    see large, buffer-sized requests.
+    """
     def __init__(self, filename, mode, key, buf_size):
-        self.filename = filename
+        super().__init__()
+        self.name = filename
         self.key = key
         self.mode = mode
         self.buf_size = buf_size
@@ -61,302 +91,692 @@ class EncryptedFile:
         self._reset_crypto()
         self.fileobj = open(filename, mode, buffering=0)
 
-    def _reset_crypto(self):
-        self.cipher = AES.new(hex_str_to_bin(self.key), AES.MODE_CTR, nonce=self.nonce)
+    def _reset_crypto(self, position=0):
+        """Set up the cipher so that the next byte it processes is at the
+        specified offset in the file. In CTR mode, the counter for a block is just
+        the initial value plus the block number, so we can start anywhere.
+        """
+        block, skip = divmod(position, AES_BLOCK_SIZE)
+        self.cipher = AES.new(hex_str_to_bin(self.key), AES.MODE_CTR, nonce=self.nonce,
+                              initial_value=block)
+        if skip>0:
+            # advance the keystream to the middle of the block
+            self.cipher.decrypt(bytes(skip))
+
+    def _release(self):
+        """Subclasses stop any background threads and release their buffers here.
+        """
+        pass
 
     def close(self):
-        self.fileobj.close()
-
+        if self.closed:
+            return
+        try:
+            super().close() # calls flush()
+            self._release()
+        finally:
+            self.fileobj.close()
+
+
+class _ReadAhead:
+    """Background thread that reads the ciphertext (and optionally decrypts it)
+    ahead of the consumer. There is a fixed ring of buffers which cycle between
+    the free queue and the filled queue. The consumer holds one buffer at a
+    time and returns it to the free queue when it asks for the next one. Thus,
+    the consumer only waits when the thread has fallen behind.
+
+    Both the file read and the AES code release the GIL, so this gives us real overlap.
+    """
+    __slots__ = ('reader', 'slots', 'decrypt', 'free', 'filled', 'thread', 'current',
+                 'stopping', 'at_eof')
+    def __init__(self, reader, num_buffers, decrypt):
+        assert num_buffers>=2, "Need at least two buffers for read ahead"
+        self.reader = reader
+        self.decrypt = decrypt
+        self.slots = []
+        for i in range(num_buffers):
+            ciphertext = bytearray(reader.buf_size)
+            cleartext = bytearray(reader.buf_size)
+            self.slots.append((ciphertext, memoryview(ciphertext), cleartext, memoryview(cleartext)))
+        self.thread = None
+        self._reset()
+
+    def _reset(self):
+        self.free = queue.Queue()
+        for slot in self.slots:
+            self.free.put(slot)
+        self.filled = queue.Queue()
+        self.current = None
+        self.stopping = False
+        self.at_eof = False
+
+    def _run(self):
+        fileobj = self.reader.fileobj
+        cipher = self.reader.cipher
+        try:
+            while True:
+                slot = self.free.get()
+                if slot is None or self.stopping:
+                    return
+                (ciphertext, cipherview, cleartext, clearview) = slot
+                bytes_read = fileobj.readinto(ciphertext)
+                if bytes_read>0 and self.decrypt:
+                    cipher.decrypt(cipherview[0:bytes_read], output=clearview[0:bytes_read])
+                self.filled.put((slot, bytes_read, None))
+                if bytes_read==0:
+                    return
+        except BaseException as e:
+            self.filled.put((None, 0, e))
+
+    def next_buffer(self):
+        """Return the next slot and the number of bytes in it (zero at end of file).
+        The cleartext of the slot is ready to use.
+        """
+        if self.at_eof:
+            return (None, 0)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='cacheml-read-ahead',
+                                           daemon=True)
+            self.thread.start()
+        (slot, bytes_read, exc) = self.filled.get()
+        if exc is not None:
+            self.at_eof = True
+            raise exc
+        if self.current is not None:
+            self.free.put(self.current)
+        self.current = slot
+        if bytes_read==0:
+            self.at_eof = True
+        elif not self.decrypt:
+            (ciphertext, cipherview, cleartext, clearview) = slot
+            self.reader.cipher.decrypt(cipherview[0:bytes_read], output=clearview[0:bytes_read])
+        return (slot, bytes_read)
+
+    def stop(self):
+        """Stop the thread and put all the buffers back on the free queue. Called before
+        a seek or a close. The next call to next_buffer() will restart the thread.
+        """
+        if self.thread is not None:
+            self.stopping = True
+            self.free.put(None)
+            self.thread.join()
+            self.thread = None
+        self._reset()
 
 
 class EncryptedReader(EncryptedFile):
-    __slots__ = ('ciphertext', 'cipherview', 'cleartext', 'clearview',
-                 'extra_start', 'extra_end', 'extra_size')
-    def __init__(self, filename, mode, key, buf_size):
+    """Raw reader for a file written by EncryptedWriter. Normally, readinto() reads
+    the ciphertext directly into the caller's buffer and decrypts it in place, so there
+    is no copying at all.
+
+    If read_ahead is greater than zero, a background thread keeps that many buffers of
+    ciphertext read ahead of the caller. If decrypt_ahead is also True, the thread
+    decrypts the buffers as well. Otherwise, decryption happens on the caller's thread,
+    overlapped with the disk reads. In this mode, there is one copy from the read
+    ahead buffer to the caller's buffer.
+    """
+    def __init__(self, filename, mode, key, buf_size, read_ahead=0, decrypt_ahead=False):
         assert mode.startswith('r')
         super().__init__(filename, mode, key, buf_size)
-        self.ciphertext = bytearray(buf_size)
-        self.cipherview = memoryview(self.ciphertext)
-        self.cleartext = bytearray(buf_size)
-        self.clearview = memoryview(self.cleartext)
-        # If there is extra in the buffer at the end of a call,
-        # we track it with a start pointer, end pointer, and size.
-        # This must be checked in the next call
-        self.extra_start = self.extra_end = self.extra_size = 0
-
-    def _split(self, first_length):
-        """Split this buffer into two parts, where the first part is first_length long and
-        the rest is the remainder of the buffer. The first part is returned as a copy.
-        The buffer is then advanced to point to the rest (it may be zero length).
+        self.position = 0 # position of the caller in the cleartext
+        if read_ahead>0:
+            self.read_ahead = _ReadAhead(self, read_ahead, decrypt_ahead)
+        else:
+            self.read_ahead = None
+        # When using read ahead, the current buffer holds buf_len bytes starting at
+        # file offset buf_start, and the caller has consumed buf_offset of them.
+        self.clearview = None
+        self.buf_start = self.buf_len = self.buf_offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        if self.read_ahead is None:
+            bytes_read = self.fileobj.readinto(view)
+            if bytes_read>0:
+                self.cipher.decrypt(view[0:bytes_read], output=view[0:bytes_read])
+            self.position += bytes_read
+            return bytes_read
+        if self.buf_offset==self.buf_len:
+            (slot, bytes_read) = self.read_ahead.next_buffer()
+            self.buf_start = self.position
+            self.buf_offset = 0
+            self.buf_len = bytes_read
+            if bytes_read==0:
+                self.clearview = None
+                return 0
+            self.clearview = slot[3]
+        n = min(len(view), self.buf_len - self.buf_offset)
+        view[0:n] = self.clearview[self.buf_offset:self.buf_offset+n]
+        self.buf_offset += n
+        self.position += n
+        return n
+
+    def readall(self):
+        """Read the rest of the file. We size the result from the file size, so that
+        the ciphertext never needs to be held in memory in addition to the cleartext.
         """
-        new_start = self.extra_start + first_length
-        # need to wrap in a bytes here, as the calling pickle expects a bytes, not a bytearray
-        # This is unfortunate, as it already is doing a copy.
-        first = bytes(self.cleartext[self.extra_start:new_start])
-        self.extra_start=new_start
-        self.extra_size = self.extra_end-new_start
-        return first
-
-    def read(self, size=(-1)):
-        # Parts is used when we need to combine the results from multiple
-        # reads. The elements should always be a copied bytearray (vs. a view
-        # into the cleartext buffer), unless it is the last element of multiple
-        # and no more will be added.
-        parts = []
-       # print(f"file position before read: {self.fileobj.tell()}")
-        if size>0 and (self.extra_size > 0) and size<=self.extra_size:
-            # we can satisfy the request out of the left over from the last call
-            new_start = self.extra_start + size
-            # need to wrap in a bytes here, as the calling pickle expects a bytes, not a bytearray
-            # This is unfortunate, as it already is doing a copy.
-            first = bytes(self.cleartext[self.extra_start:new_start])
-            self.extra_start=new_start
-            self.extra_size = self.extra_end-new_start
-            return first
-        elif self.extra_size > 0:
-            parts.append(self.cleartext[self.extra_start:self.extra_end])
-            bytes_ready = self.extra_size
-            self.extra_start = self.extra_end = self.extra_size = 0
+        remaining = os.fstat(self.fileobj.fileno()).st_size - self.position
+        result = bytearray(max(remaining, 0))
+        view = memoryview(result)
+        total = 0
+        while total<len(result):
+            bytes_read = self.readinto(view[total:])
+            if bytes_read==0:
+                break
+            total += bytes_read
+        view.release()
+        del result[total:]
+        return bytes(result)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move to an arbitrary position in the file. All three values of
+        whence are supported. We seek the underlying file and reposition the cipher
+        counter, so only the bytes actually read get decrypted. With read ahead, if the
+        new position is still in the current buffer, we just move our offset.
+        """
+        if whence==os.SEEK_SET:
+            position = offset
+        elif whence==os.SEEK_CUR:
+            position = self.position + offset
+        elif whence==os.SEEK_END:
+            position = os.fstat(self.fileobj.fileno()).st_size + offset
         else:
-            bytes_ready = 0
-        if size==(-1):
-            # Read the entire file as a single batch.
-            # No point using our buffers, as we don't know the expect
-            # size and the decrypted data must be returned as a copy.
-            ciphercontents = self.fileobj.read(-1)
-            if len(parts)>0:
-                parts.append(self.cipher.decrypt(ciphercontents))
-                return b''.join(parts)
-            else:
-                return self.cipher.decrypt(ciphercontents)
-        # if we get here, we are reading into the buffers
-        #print(f"entering loop, bytes_ready={bytes_ready}")
-        while True:
-            bytes_read = self.fileobj.readinto(self.ciphertext)
-            if bytes_read==0: # got to end of file
-                if len(parts)>1:
-                    return b''.join(parts)
-                elif len(parts)==1:
-                    return parts[0] if isinstance(parts[0], bytes) else bytes(parts[0])
-                else:
-                    return bytes()
-            # based on the api, the decrypted bytes always
-            # equals the size of the cipher text
-            decrypted_view = self.clearview[0:bytes_read]
-            self.cipher.decrypt(self.cipherview[0:bytes_read],
-                                output=decrypted_view)
-            bytes_ready += bytes_read
-            #print(f"bytes_read = {bytes_read}, bytes_ready now is {bytes_ready}")
-            if bytes_ready==size:
-                if len(parts)>0:
-                    parts.append(decrypted_view)
-                    return b''.join(parts)
-                else:
-                    return decrypted_view.tobytes()
-            elif bytes_ready>size:
-                extra_bytes = bytes_ready-size
-                bytes_to_return = bytes_read - extra_bytes
-                parts.append(self.clearview[0:bytes_to_return])
-                self.extra_start = bytes_to_return
-                self.extra_end = bytes_read
-                self.extra_size = bytes_read - bytes_to_return
-                if len(parts)>1:
-                    r =  b''.join(parts)
-                    return r
-                else:
-                    return parts[0].tobytes()
-            else:
-                assert bytes_ready<size
-                parts.append(bytes(self.cleartext[0:bytes_read]))
-                assert self.extra_size==0
-            # need to do another read
-
-    def readline(self, size=(-1)):
-        assert size==(-1), f"currently do not suport readline with a size (size was {size})"
-        # if self.extra_size > 0:
-        #     print(f"call to readline(): clear_extra={len(self.clearextra)} bytes")
-        # else:
-        #     print("call to readline(): clear_extra=None")
-
-        # Parts is used when we need to combine the results from multiple
-        # reads. The elements should always be a copied bytearray (vs. a view
-        # into the cleartext buffer), unless it is the last element of multiple
-        # and no more will be added.
-        parts = []
-
-        if self.extra_size > 0:
-            i = self.cleartext.find(b'\n', self.extra_start, self.extra_end)
-            if i>=0:
-                # we can do this entirely from the cleartext
-                new_start = i+1
-                # need to wrap in a bytes here, as the calling pickle expects a bytes, not a bytearray
-                # This is unfortunate, as it already is doing a copy.
-                first = bytes(self.cleartext[self.extra_start:new_start])
-                self.extra_start=new_start
-                self.extra_size = self.extra_end-new_start
-                return first
-            else:
-                # the remainder from last time is not enough, save it to parts to free up buffer
-                parts.append(self.cleartext[self.extra_start:self.extra_end])
-                self.extra_start = self.extra_end = self.extra_size = 0
+            raise ValueError(f"Invalid value for whence: {whence}")
+        if position<0:
+            raise ValueError(f"Negative seek position {position}")
+        if self.read_ahead is not None:
+            if self.buf_len>0 and self.buf_start<=position<=(self.buf_start+self.buf_len):
+                self.buf_offset = position - self.buf_start
+                self.position = position
+                return position
+            self.read_ahead.stop()
+            self.clearview = None
+            self.buf_start = self.buf_len = self.buf_offset = 0
+        self._reset_crypto(position)
+        self.fileobj.seek(position, os.SEEK_SET)
+        self.position = position
+        return position
+
+    def _release(self):
+        if self.read_ahead is not None:
+            self.read_ahead.stop()
+            self.read_ahead = None
+        self.clearview = None
+
+
+class _WriteBehind:
+    """Background thread that writes filled ciphertext buffers to the file, so that
+    the caller can encrypt into the next buffer while the previous one goes to disk.
+    Buffers cycle between the free and filled queues. If all the buffers are waiting
+    to be written, the caller blocks until one is free.
+
+    Errors from the file write are saved and re-raised on the caller's thread.
+    """
+    __slots__ = ('fileobj', 'free', 'filled', 'thread', 'error')
+    def __init__(self, fileobj, buf_size, num_buffers):
+        assert num_buffers>=2, "Need at least two buffers for write behind"
+        self.fileobj = fileobj
+        self.free = queue.Queue()
+        for i in range(num_buffers):
+            self.free.put(bytearray(buf_size))
+        self.filled = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='cacheml-write-behind',
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
         while True:
-            bytes_read = self.fileobj.readinto(self.ciphertext)
-            if bytes_read==0:
-                if len(parts)>1:
-                    #print(f"line consists of {len(parts)} parts")
-                    return b''.join(parts)
-                elif len(parts)==1:
-                    #print(f"return orphan part of length {parts[0]}")
-                    return parts[0]
-                else:
-                    return bytes()
-            decrypted_view = self.clearview[0:bytes_read]
-            self.cipher.decrypt(self.cipherview[0:bytes_read],
-                                output=decrypted_view)
-            i = self.cleartext.find(b'\n', 0, bytes_read)
-            if i<0: # no newline found
-                slice = self.cleartext[0:bytes_read] # will make a copy
-                parts.append(slice)
-            else:
-                slice = self.cleartext[0:i+1]
-                if bytes_read>(i+1):
-                    self.extra_start = i+1
-                    self.extra_end = bytes_read
-                    self.extra_size = self.extra_end - self.extra_start
-                else:
-                    self.extra_start = self.extra_end = self.extra_size = 0
-                if len(parts)>0:
-                    parts.append(slice)
-                    line =b''.join(parts)
-                    #print(f"line consists of {len(parts)} parts")
-                    return line
-                else:
-                    return slice
-
-    def seek(self, offset, whence=0):
-        """We only support resetting the postition base to the start of file.
-        In that case, we also have to reset the decryption cipher state.
+            item = self.filled.get()
+            if item is None:
+                self.filled.task_done()
+                return
+            (buf, length) = item
+            try:
+                if self.error is None: # after an error, just recycle the buffers
+                    view = memoryview(buf)[0:length]
+                    while len(view)>0:
+                        view = view[self.fileobj.write(view):]
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.free.put(buf)
+                self.filled.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, buf, length):
+        """Queue the first length bytes of buf for writing and return an empty buffer
+        to use next.
         """
-        assert offset==0 and whence==0, f"Unexpected parameters for seek: (offset={offset}, whence={whence})"
-        self._reset_crypto()
-        self.extra_start = self.extra_end = self.extra_size = 0
-        return self.fileobj.seek(offset, whence)
-
-    def close(self):
-        super().close()
-        # release buffers asap
-        self.cipherview = self.clearview = None
-        self.ciphertext = self.cleartext = None
+        self._check_error()
+        self.filled.put((buf, length))
+        return self.free.get()
 
+    def wait(self):
+        """Wait until everything submitted so far has been written."""
+        self.filled.join()
+        self._check_error()
 
+    def stop(self):
+        self.filled.put(None)
+        self.thread.join()
+        self._check_error()
 
 
 class EncryptedWriter(EncryptedFile):
-    """We buffer the data as cleartext and then translate a buffer at a time
-    as we write the buffers out"""
-    __slots__ = ('cleartext', 'clearview', 'bytes_in_buf', 'ciphertext')
-    def __init__(self, filename, mode, key, buf_size):
+    """Raw encrypted writer. The cleartext is buffered by io.BufferedWriter, so each
+    write() call encrypts the data into our ciphertext buffer, a buffer at a time,
+    and writes it out. If write_behind is greater than zero, we use that many ciphertext
+    buffers and they are written to the file by a background thread.
+    """
+    def __init__(self, filename, mode, key, buf_size, write_behind=0):
         assert mode.startswith('w')
         super().__init__(filename, mode, key, buf_size=buf_size)
-        self.cleartext = bytearray(buf_size)
-        self.clearview = memoryview(self.cleartext)
-        self.bytes_in_buf = 0 # bytes already copied to the cleartext buffer
-        self.ciphertext = bytearray(buf_size) # buffer to use in translations
-        #print(f"Writer buf_size={buf_size}")
+        if write_behind>0:
+            self.write_behind = _WriteBehind(self.fileobj, buf_size, write_behind)
+            self.ciphertext = self.write_behind.free.get()
+        else:
+            self.write_behind = None
+            self.ciphertext = bytearray(buf_size)
+        self.cipherview = memoryview(self.ciphertext)
 
+    def writable(self):
+        return True
 
     def write(self, b):
-        #print(f"write() ({len(b)} bytes), bytes_written={self.bytes_in_buf}")
-        writeview = memoryview(b)
-        bytes_to_write = len(b)
-        while bytes_to_write>0:
-            room_in_buf = self.buf_size - self.bytes_in_buf
-            assert room_in_buf>0
-            this_group_size = min(room_in_buf, bytes_to_write)
-            #print(f"  room_in_buf = {room_in_buf}, this_group_size = {this_group_size}")
-            end_idx = self.bytes_in_buf + this_group_size
-            source_offset = len(b) - bytes_to_write
-            self.clearview[self.bytes_in_buf:end_idx] = writeview[source_offset:source_offset+this_group_size]
-            self.bytes_in_buf += this_group_size
-            bytes_to_write -= this_group_size
-            if end_idx==self.buf_size: # exactly buf size, empty buffer
-                self.cipher.encrypt(self.cleartext, output=self.ciphertext)
-                self.fileobj.write(self.ciphertext)
-                self.bytes_in_buf = 0
-                #print(f"wrote {len(self.cleartext)} bytes")
-        return len(b)
+        writeview = memoryview(b).cast('B')
+        for start in range(0, len(writeview), self.buf_size):
+            chunk = writeview[start:start+self.buf_size]
+            cipherview = self.cipherview[0:len(chunk)]
+            self.cipher.encrypt(chunk, output=cipherview)
+            if self.write_behind is not None:
+                self.ciphertext = self.write_behind.submit(self.ciphertext, len(chunk))
+                self.cipherview = memoryview(self.ciphertext)
+            else:
+                while len(cipherview)>0:
+                    cipherview = cipherview[self.fileobj.write(cipherview):]
+        return len(writeview)
 
     def flush(self):
-        if self.bytes_in_buf>0:
-            cipherview = memoryview(self.ciphertext)[0:self.bytes_in_buf]
-            self.cipher.encrypt(self.clearview[0:self.bytes_in_buf], cipherview)
-            self.fileobj.write(cipherview)
-            self.bytes_in_buf = 0
+        if self.write_behind is not None and not self.closed:
+            self.write_behind.wait()
 
-    def close(self):
-        self.flush()
-        super().close()
-        self.cleartext = None
+    def _release(self):
+        """Wait for the write behind thread to finish before the file is closed.
+        Thus, when close() returns, all the data has been written and the file can be
+        renamed.
+        """
+        if self.write_behind is not None:
+            write_behind = self.write_behind
+            self.write_behind = None
+            write_behind.stop()
+        self.ciphertext = self.cipherview = None
 
-class EncryptedWriterNoClearBuf(EncryptedFile):
-    """Encrypted writer with no buffering of cleartext - it immediately encrypts the
-    write data and stores the encrypted text in a buffer.
+
+_CRYPTO_POOL = None
+_CRYPTO_POOL_PID = None
+_CRYPTO_POOL_LOCK = threading.Lock()
+
+def _get_crypto_pool():
+    """Return the process-wide thread pool used to encrypt and decrypt frames.
+    The AES code releases the GIL, so this scales across cores. We check the pid
+    so that a forked child builds its own pool.
     """
-    __slots__ = ('ciphertext', 'cipherview', 'bytes_written')
-    def __init__(self, filename, mode, key, buf_size):
-        assert mode.startswith('w')
-        super().__init__(filename, mode, key, buf_size=buf_size)
-        self.ciphertext = bytearray(buf_size)
-        self.cipherview = memoryview(self.ciphertext)
-        self.bytes_written = 0 # bytes written to the ciphertext buffer
-        #print(f"Writer buf_size={buf_size}")
+    global _CRYPTO_POOL, _CRYPTO_POOL_PID
+    with _CRYPTO_POOL_LOCK:
+        if _CRYPTO_POOL is None or _CRYPTO_POOL_PID!=os.getpid():
+            _CRYPTO_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                              thread_name_prefix='cacheml-crypto')
+            _CRYPTO_POOL_PID = os.getpid()
+        return _CRYPTO_POOL
+
+
+def _pread(fileobj, lock, length, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fileobj.fileno(), length, offset)
+    with lock:
+        fileobj.seek(offset)
+        return fileobj.read(length)
+
+
+def _pwrite(fileobj, lock, data, offset):
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while len(view)>0:
+            written = os.pwrite(fileobj.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        with lock:
+            fileobj.seek(offset)
+            while len(view)>0:
+                view = view[fileobj.write(view):]
+
+
+def _gcm_cipher(bin_key, header, index, is_last):
+    file_id = header[-8:]
+    cipher = AES.new(bin_key, AES.MODE_GCM, nonce=file_id+struct.pack('>I', index))
+    # The header and the last frame flag are authenticated as well. The flag
+    # lets us detect a file that was truncated at a frame boundary.
+    cipher.update(header + (b'\x01' if is_last else b'\x00'))
+    return cipher
+
+
+class EncryptedFrameReader(io.RawIOBase):
+    """Raw reader for files in FORMAT_GCM. Frames are read and decrypted by tasks in
+    the crypto thread pool, up to window frames ahead of the caller. A readinto() that
+    covers several whole frames decrypts them in parallel, directly into the caller's
+    buffer. If a frame fails authentication, we raise a ValueError.
+    """
+    def __init__(self, filename, mode, key, window=None):
+        assert mode.startswith('r')
+        super().__init__()
+        self.name = filename
+        self.mode = mode
+        self.bin_key = hex_str_to_bin(key)
+        self.fileobj = open(filename, mode, buffering=0)
+        self.lock = threading.Lock()
+        try:
+            self.header = self.fileobj.read(_GCM_HEADER.size)
+            if len(self.header)!=_GCM_HEADER.size:
+                raise ValueError(f"{filename} is too short to be an encrypted file")
+            (magic, version, self.frame_size, file_id) = _GCM_HEADER.unpack(self.header)
+            if magic!=GCM_MAGIC:
+                raise ValueError(f"{filename} is not in the {FORMAT_GCM} format")
+            if version!=GCM_VERSION:
+                raise ValueError(f"{filename} has unsupported format version {version}")
+            payload = os.fstat(self.fileobj.fileno()).st_size - _GCM_HEADER.size
+            full_frame = self.frame_size + GCM_TAG_SIZE
+            self.num_frames = (payload + full_frame - 1)//full_frame
+            self.size = payload - self.num_frames*GCM_TAG_SIZE
+            if self.num_frames==0 or (payload - (self.num_frames-1)*full_frame)<GCM_TAG_SIZE:
+                raise ValueError(f"{filename} is truncated")
+            if self.size==0:
+                # no reads will happen, but we still authenticate the empty frame
+                self._decrypt_frame(0)
+        except:
+            self.fileobj.close()
+            raise
+        self.window = window if window is not None else 2*(os.cpu_count() or 1)
+        self.position = 0
+        self.frames = {} # frame index => future of the decrypted frame
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _frame_len(self, index):
+        if index==self.num_frames-1:
+            return self.size - index*self.frame_size
+        else:
+            return self.frame_size
+
+    def _decrypt_frame(self, index, output=None):
+        """Read and decrypt a frame. Runs in the crypto pool. If output is not
+        provided, we allocate a buffer for the cleartext.
+        """
+        length = self._frame_len(index)
+        offset = _GCM_HEADER.size + index*(self.frame_size + GCM_TAG_SIZE)
+        data = _pread(self.fileobj, self.lock, length+GCM_TAG_SIZE, offset)
+        if len(data)!=length+GCM_TAG_SIZE:
+            raise ValueError(f"{self.name}: short read of frame {index}")
+        if output is None:
+            output = bytearray(length)
+        cipher = _gcm_cipher(self.bin_key, self.header, index, index==self.num_frames-1)
+        data = memoryview(data)
+        cipher.decrypt(data[0:length], output=output)
+        try:
+            cipher.verify(data[length:])
+        except ValueError:
+            raise ValueError(f"{self.name}: authentication failed for frame {index}")
+        return output
+
+    def _schedule(self, index):
+        """Make sure that the frames from index to the end of the window are being
+        decrypted, and drop any frames that are outside the window.
+        """
+        last = min(index+self.window, self.num_frames)
+        for i in list(self.frames.keys()):
+            if i<index or i>=last:
+                self.frames.pop(i).cancel()
+        pool = _get_crypto_pool()
+        for i in range(index, last):
+            if i not in self.frames:
+                self.frames[i] = pool.submit(self._decrypt_frame, i)
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        if self.position>=self.size or len(view)==0:
+            return 0
+        (index, offset) = divmod(self.position, self.frame_size)
+        if offset==0:
+            # Decrypt whole frames directly into the caller's buffer, in parallel.
+            # We only do this for multiple frames, as the buffered reader will read a
+            # frame at a time and those are better served by the read ahead window.
+            end = index
+            total = 0
+            while end<self.num_frames and total+self._frame_len(end)<=len(view):
+                total += self._frame_len(end)
+                end += 1
+            if end-index>1:
+                pool = _get_crypto_pool()
+                futures = []
+                start = 0
+                for i in range(index, end):
+                    length = self._frame_len(i)
+                    future = self.frames.pop(i, None)
+                    if future is not None:
+                        view[start:start+length] = future.result()
+                    else:
+                        futures.append(pool.submit(self._decrypt_frame, i,
+                                                   view[start:start+length]))
+                    start += length
+                for future in futures:
+                    future.result()
+                self.position += total
+                return total
+        self._schedule(index)
+        frame = self.frames[index].result()
+        n = min(len(view), len(frame)-offset)
+        view[0:n] = memoryview(frame)[offset:offset+n]
+        self.position += n
+        return n
+
+    def readall(self):
+        result = bytearray(max(self.size - self.position, 0))
+        view = memoryview(result)
+        total = 0
+        while total<len(result):
+            bytes_read = self.readinto(view[total:])
+            if bytes_read==0:
+                break
+            total += bytes_read
+        view.release()
+        del result[total:]
+        return bytes(result)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence==os.SEEK_SET:
+            position = offset
+        elif whence==os.SEEK_CUR:
+            position = self.position + offset
+        elif whence==os.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid value for whence: {whence}")
+        if position<0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return position
 
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+            # tasks that are already running use the file, so wait for them
+            for future in self.frames.values():
+                future.cancel()
+            wait(list(self.frames.values()))
+            self.frames = {}
+        finally:
+            self.fileobj.close()
+
+
+class EncryptedFrameWriter(io.RawIOBase):
+    """Raw writer for files in FORMAT_GCM. Each frame is encrypted and written to its
+    location in the file by a task in the crypto thread pool. We keep at most window
+    frames in flight, so memory is bounded if the disk cannot keep up.
+    A frame is not submitted until we know whether it is the last one, so the final
+    frame is only written by close().
+    """
+    def __init__(self, filename, mode, key, frame_size=BUF_SIZE, window=None):
+        assert mode.startswith('w')
+        super().__init__()
+        self.name = filename
+        self.mode = mode
+        self.bin_key = hex_str_to_bin(key)
+        self.frame_size = frame_size
+        self.header = _GCM_HEADER.pack(GCM_MAGIC, GCM_VERSION, frame_size, get_random_bytes(8))
+        self.fileobj = open(filename, mode, buffering=0)
+        self.lock = threading.Lock()
+        _pwrite(self.fileobj, self.lock, self.header, 0)
+        self.window = window if window is not None else 2*(os.cpu_count() or 1)
+        self.index = 0
+        self.frame = bytearray(frame_size)
+        self.frame_len = 0
+        self.pending = deque()
+
+    def writable(self):
+        return True
+
+    def _encrypt_frame(self, index, frame, length, is_last):
+        """Encrypt a frame and write it to the file. Runs in the crypto pool."""
+        output = bytearray(length+GCM_TAG_SIZE)
+        cipher = _gcm_cipher(self.bin_key, self.header, index, is_last)
+        cipher.encrypt(memoryview(frame)[0:length], output=memoryview(output)[0:length])
+        output[length:] = cipher.digest()
+        offset = _GCM_HEADER.size + index*(self.frame_size + GCM_TAG_SIZE)
+        _pwrite(self.fileobj, self.lock, output, offset)
+
+    def _submit_frame(self, is_last):
+        while len(self.pending)>=self.window:
+            self.pending.popleft().result()
+        self.pending.append(_get_crypto_pool().submit(self._encrypt_frame, self.index,
+                                                      self.frame, self.frame_len, is_last))
+        self.index += 1
+        self.frame = bytearray(self.frame_size) if not is_last else None
+        self.frame_len = 0
 
     def write(self, b):
-        #print(f"write() ({len(b)} bytes), bytes_written={self.bytes_written}")
-        writeview = memoryview(b)
-        bytes_to_write = len(b)
-        while bytes_to_write>0:
-            room_in_buf = self.buf_size - self.bytes_written
-            assert room_in_buf>0
-            this_group_size = min(room_in_buf, bytes_to_write)
-            #print(f"  room_in_buf = {room_in_buf}, this_group_size = {this_group_size}")
-            end_idx = self.bytes_written + this_group_size
-            source_offset = len(b) - bytes_to_write
-            this_write_buf = writeview[source_offset:source_offset+this_group_size]
-            cipherview_subbuf = self.cipherview[self.bytes_written:end_idx]
-            #print(f"[{self.bytes_written}:{end_idx}] cleartext len={len(this_write_buf)}, cipher len={len(cipherview_subbuf)}")
-            self.cipher.encrypt(this_write_buf, output=cipherview_subbuf)
-            self.bytes_written += this_group_size
-            bytes_to_write -= this_group_size
-            if end_idx==self.buf_size: # exactly buf size, empty buffer
-                self.fileobj.write(self.ciphertext)
-                self.bytes_written = 0
-                #print(f"wrote {len(self.ciphertext)} bytes")
-        return len(b)
+        writeview = memoryview(b).cast('B')
+        start = 0
+        while start<len(writeview):
+            if self.frame_len==self.frame_size:
+                self._submit_frame(is_last=False)
+            n = min(len(writeview)-start, self.frame_size-self.frame_len)
+            self.frame[self.frame_len:self.frame_len+n] = writeview[start:start+n]
+            self.frame_len += n
+            start += n
+        return len(writeview)
+
+    def _wait(self):
+        while len(self.pending)>0:
+            self.pending.popleft().result()
 
     def flush(self):
-        if self.bytes_written>0:
-            self.fileobj.write(self.ciphertext[0:self.bytes_written])
-            #print(f"Flushed {self.bytes_written} bytes")
-            self.bytes_written = 0
+        if not self.closed:
+            self._wait()
 
     def close(self):
-        if self.bytes_written>0:
-            self.fileobj.write(self.ciphertext[0:self.bytes_written])
-            #print(f"Flushed {self.bytes_written} bytes")
-            self.bytes_written = 0
-        super().close()
-        self.ciphertext = None
+        """Encrypt the last frame and wait for all the frames to be written. Thus,
+        when this returns, the file is complete and can be renamed.
+        """
+        if self.closed:
+            return
+        try:
+            self._submit_frame(is_last=True)
+            super().close()
+        finally:
+            wait(list(self.pending))
+            self.pending.clear()
+            self.fileobj.close()
+
+
+def get_file_format(filename):
+    """Return the format of an existing encrypted file, based on its header."""
+    with open(filename, 'rb') as f:
+        magic = f.read(len(GCM_MAGIC))
+    return FORMAT_GCM if magic==GCM_MAGIC else FORMAT_CTR
+
+
+def key_matches(filename, key):
+    """Return True if the file is in FORMAT_GCM and was encrypted with key, and
+    False if it is in FORMAT_GCM but does not authenticate with key (another key,
+    or a damaged file). FORMAT_CTR files are not authenticated, so for those we
+    return None. Only the last frame is decrypted.
+    """
+    if get_file_format(filename)!=FORMAT_GCM:
+        return None
+    try:
+        reader = EncryptedFrameReader(filename, 'rb', key)
+    except ValueError:
+        return False
+    try:
+        reader._decrypt_frame(reader.num_frames-1)
+        return True
+    except ValueError:
+        return False
+    finally:
+        reader.close()
 
 
 @contextmanager
-def encrypted_file_open(filename, mode, key, buf_size=BUF_SIZE):
+def encrypted_file_open(filename, mode, key, buf_size=BUF_SIZE, read_ahead=0,
+                        decrypt_ahead=False, write_behind=0, file_format=DEFAULT_FORMAT):
+    """Open an encrypted file for reading or writing. The result is a standard
+    io.BufferedReader or io.BufferedWriter with a buffer of buf_size bytes.
+
+    When writing, file_format selects FORMAT_GCM (the default, with frames of buf_size
+    bytes) or the older FORMAT_CTR. When reading, we detect the format from the file.
+    The read_ahead, decrypt_ahead and write_behind options only apply to FORMAT_CTR
+    (see EncryptedReader and EncryptedWriter). FORMAT_GCM files always use the crypto
+    thread pool.
+    """
     #print(f"encrypted_file_open({filename}, {mode})")
     if mode.startswith('r'):
-        fileobj = EncryptedReader(filename, mode, key, buf_size=buf_size)
+        if get_file_format(filename)==FORMAT_GCM:
+            raw = EncryptedFrameReader(filename, mode, key)
+        else:
+            raw = EncryptedReader(filename, mode, key, buf_size=buf_size,
+                                  read_ahead=read_ahead, decrypt_ahead=decrypt_ahead)
+        fileobj = io.BufferedReader(raw, buffer_size=buf_size)
     elif mode.startswith('w'):
-        fileobj = EncryptedWriterNoClearBuf(filename, mode, key, buf_size=buf_size)
+        if file_format==FORMAT_GCM:
+            raw = EncryptedFrameWriter(filename, mode, key, frame_size=buf_size)
+        elif file_format==FORMAT_CTR:
+            raw = EncryptedWriter(filename, mode, key, buf_size=buf_size,
+                                  write_behind=write_behind)
+        else:
+            raise ValueError(f"Invalid file format '{file_format}'")
+        fileobj = io.BufferedWriter(raw, buffer_size=buf_size)
     else:
         assert 0, f"Invalid mode '{mode}'"
     try:
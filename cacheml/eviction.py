@@ -0,0 +1,115 @@
+"""Eviction policies, which choose the entries to remove when the cache is over its
+size limit (max_size_in_mb).
+
+joblib removes the least recently used entries, regardless of what they cost to
+recompute, so it will remove a large result that took an hour to compute to make
+room for many small ones that are cheap to recompute. The policies here work on the
+entries recorded in the manifest (see manifest.py), which has the size, the access
+times and hits, and the compute time of each entry. Pinned entries are never evicted.
+
+ * LRU evicts the least recently used entries (like joblib),
+ * LFU evicts the least frequently used (hit) entries, the least recently used first
+   among those with the same number of hits,
+ * GreedyDual-Size (GDS) evicts the entries with the lowest compute time per byte,
+   aged by an inflation value, so that entries that are no longer used are eventually
+   evicted however expensive they were. See Cao and Irani, "Cost-Aware WWW Proxy
+   Caching Algorithms", USITS 1997.
+
+To add a policy, subclass EvictionPolicy and add it to POLICIES.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+POLICY_LRU='lru'
+POLICY_LFU='lfu'
+POLICY_GDS='gds'
+
+# When evicting after a write, we go down to this fraction below the size limit,
+# so that we do not have to evict again after each of the following writes.
+EVICTION_SLACK=0.1
+
+
+class EvictionPolicy:
+    """Base class for the eviction policies. The entries are dicts with the manifest's
+    columns (see manifest.COLUMNS), and those with the lowest priority are evicted
+    first.
+    """
+    name = None
+
+    def priority(self, entry, inflation):
+        raise NotImplementedError
+
+    def select(self, entries, bytes_to_free, inflation):
+        """Return (entries to evict, new inflation value), evicting at least
+        bytes_to_free bytes if the unpinned entries add up to that much.
+        """
+        candidates = sorted((e for e in entries if not e['pinned']),
+                            key=lambda e: self.priority(e, inflation))
+        victims = []
+        freed = 0
+        for e in candidates:
+            if freed>=bytes_to_free:
+                break
+            victims.append(e)
+            freed += e['size']
+        return (victims, inflation)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+
+class LRUPolicy(EvictionPolicy):
+    name = POLICY_LRU
+
+    def priority(self, entry, inflation):
+        return entry['last_access']
+
+
+class LFUPolicy(EvictionPolicy):
+    name = POLICY_LFU
+
+    def priority(self, entry, inflation):
+        return (entry['hits'], entry['last_access'])
+
+
+class GreedyDualSizePolicy(EvictionPolicy):
+    """The priority of an entry is the inflation value when it was last written or
+    hit, plus its cost (compute time, zero if unknown) divided by its size. Evicting
+    raises the inflation value to the priority of the last evicted entry, so the
+    entries that are used again get ahead of those that are not.
+    """
+    name = POLICY_GDS
+
+    def priority(self, entry, inflation):
+        return entry['inflation'] + (entry['duration'] or 0.0)/max(entry['size'], 1)
+
+    def select(self, entries, bytes_to_free, inflation):
+        (victims, _) = super().select(entries, bytes_to_free, inflation)
+        if len(victims)>0:
+            inflation = max(inflation, self.priority(victims[-1], inflation))
+        return (victims, inflation)
+
+
+POLICIES = {p.name:p for p in (LRUPolicy, LFUPolicy, GreedyDualSizePolicy)}
+
+
+def entries_to_evict(manifest, policy, bytes_limit, keep=None):
+    """Return the entries of the manifest to evict to get under bytes_limit,
+    according to the policy, and update the manifest's inflation value. The entry
+    at path keep (e.g. the one just written) is not evicted.
+    """
+    entries = manifest.entries()
+    size = sum(e['size'] for e in entries)
+    if size<=bytes_limit:
+        return []
+    (victims, inflation) = policy.select([e for e in entries if e['path']!=keep], size-bytes_limit,
+                                         manifest.inflation)
+    manifest.set_inflation(inflation)
+    return victims
+
+
+def get_policy(name):
+    """Return an instance of the named policy. Raises a ValueError if it is unknown."""
+    if name not in POLICIES:
+        raise ValueError(f"Unknown eviction policy '{name}', valid policies are {', '.join(POLICIES.keys())}")
+    return POLICIES[name]()
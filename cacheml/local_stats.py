@@ -0,0 +1,237 @@
+"""Validation of local input files.
+
+The cache keys of LocalFile arguments include the stats of the file. By default,
+these are the modification time and size, as returned by os.stat(). This has two
+issues that we address here:
+
+ * joblib gets the state of each argument more than once per call. Within a
+   validation scope (see local_validation_scope()), each file is stat'ed at most
+   once, in that thread or asyncio task. Cached functions use a scope for each call.
+ * the modification time changes when a file is touched or copied to another
+   host, even if the content is the same, which invalidates the cached results.
+   If fingerprint is set (see configure_local_validation()), the cache keys use a
+   hash of the content instead of the time.
+
+Hashing a large file is not free, so fingerprints are kept in a persistent index
+(an SQLite database), keyed by the device, inode, modification time (in ns) and
+size of the file. A file is only hashed again when one of those changes. The index
+may be shared by several processes.
+
+The hash is xxh3-128 if xxhash is installed, otherwise blake3 if installed, and
+blake2b from the standard library if neither is. The name of the hash is part of
+the fingerprint, so hosts sharing a cache should have the same hash packages.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+from os.path import join, expanduser, dirname
+import threading
+import sqlite3
+import hashlib
+import warnings
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+try:
+    import xxhash
+    HASH_NAME='xxh3_128'
+    _new_hash = xxhash.xxh3_128
+except ImportError:
+    try:
+        import blake3
+        HASH_NAME='blake3'
+        _new_hash = blake3.blake3
+    except ImportError:
+        HASH_NAME='blake2b'
+        _new_hash = lambda: hashlib.blake2b(digest_size=16)
+
+CHUNK_SIZE=1024*1024
+DEFAULT_INDEX_PATH=join(expanduser('~'), '.dml', 'fingerprints.db')
+
+_settings = {'fingerprint':False, 'index_path':DEFAULT_INDEX_PATH}
+# the stats of the files in the current scope, per thread (or asyncio task)
+_stat_memo = ContextVar('local_stat_memo', default=None)
+_index = None
+_index_lock = threading.Lock()
+
+
+def configure_local_validation(fingerprint=None, index_path=None):
+    """Set whether cache keys use a fingerprint of the content of local files
+    rather than their modification time, and the path of the fingerprint index.
+    A value of None leaves that setting unchanged.
+    """
+    global _index
+    if fingerprint is not None:
+        _settings['fingerprint'] = bool(fingerprint)
+    if index_path is not None and index_path!=_settings['index_path']:
+        with _index_lock:
+            _settings['index_path'] = index_path
+            if _index is not None:
+                _index.close()
+            _index = None
+
+
+def get_fingerprint_index():
+    """Return the FingerprintIndex at the configured path."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = FingerprintIndex(_settings['index_path'])
+        return _index
+
+
+def stat_file(path):
+    """Return os.stat(path). Within a validation scope, the file is only stat'ed once."""
+    memo = _stat_memo.get()
+    if memo is None:
+        return os.stat(path)
+    fstats = memo.get(path)
+    if fstats is None:
+        fstats = os.stat(path)
+        memo[path] = fstats
+    return fstats
+
+
+def file_hasher(path, size=None):
+    """Return a hash object updated with the content of the file, or with its first
+    size bytes. More data may be added with update(). See format_hash().
+    """
+    h = _new_hash()
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining is None or remaining>0:
+            data = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if len(data)==0:
+                break
+            h.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return h
+
+
+def format_hash(h):
+    """Return the fingerprint for a hash object."""
+    return f'{HASH_NAME}:{h.hexdigest()}'
+
+
+def hash_file(path, size=None):
+    """Return the fingerprint of the content of the file, or of its first size bytes."""
+    return format_hash(file_hasher(path, size))
+
+
+def _index_key(fstats):
+    return (fstats.st_dev, fstats.st_ino, fstats.st_mtime_ns, fstats.st_size)
+
+
+def get_fingerprint(path, fstats=None):
+    """Return the fingerprint of the file, from the index if the file has not
+    changed since it was last hashed.
+    """
+    if fstats is None:
+        fstats = stat_file(path)
+    index = get_fingerprint_index()
+    key = _index_key(fstats)
+    fingerprint = index.get(key)
+    if fingerprint is None:
+        fingerprint = hash_file(path)
+        # if the file changed while we were reading it, the fingerprint may
+        # not match either version, so we do not remember it
+        if _index_key(os.stat(path))==key:
+            index.put(key, fingerprint)
+    return fingerprint
+
+
+def get_local_stats(path):
+    """Return the stats tuple of a local file used in cache keys."""
+    fstats = stat_file(path)
+    if _settings['fingerprint']:
+        return (get_fingerprint(path, fstats), fstats.st_size)
+    return (fstats.st_mtime, fstats.st_size)
+
+
+@contextmanager
+def local_validation_scope():
+    """Within this context, each file is stat'ed at most once, in this thread
+    (or asyncio task).
+    """
+    if _stat_memo.get() is not None:
+        yield # nested: the outermost scope applies
+        return
+    token = _stat_memo.set({})
+    try:
+        yield
+    finally:
+        _stat_memo.reset(token)
+
+
+class FingerprintIndex:
+    """Persistent map from (device, inode, mtime_ns, size) to the fingerprint of a
+    file, for the current hash. Lookups are memoized in the process. If the
+    database cannot be used (e.g. it is on a read-only filesystem), we warn and
+    only keep the fingerprints in memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._memo = {}
+        self._conn = None
+        self._pid = None
+        self._disabled = False
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None or self._pid!=os.getpid():
+            # a connection must not be used across a fork
+            os.makedirs(dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS fingerprints ' +
+                               '(device INTEGER, inode INTEGER, mtime_ns INTEGER, size INTEGER, ' +
+                               'hash TEXT, fingerprint TEXT, ' +
+                               'PRIMARY KEY (device, inode, mtime_ns, size, hash))')
+            self._pid = os.getpid()
+        return self._conn
+
+    def _disable(self, e):
+        warnings.warn(f"Unable to use fingerprint index {self.path}: {e}")
+        self._disabled = True
+
+    def get(self, key):
+        """Return the fingerprint for the key, or None if not found."""
+        with self._lock:
+            fingerprint = self._memo.get(key)
+            if fingerprint is not None or self._disabled:
+                return fingerprint
+            try:
+                row = self._connection().execute(
+                    'SELECT fingerprint FROM fingerprints WHERE device=? AND inode=? AND ' +
+                    'mtime_ns=? AND size=? AND hash=?', key + (HASH_NAME,)).fetchone()
+            except sqlite3.Error as e:
+                self._disable(e)
+                return None
+            if row is not None:
+                self._memo[key] = row[0]
+                return row[0]
+            return None
+
+    def put(self, key, fingerprint):
+        with self._lock:
+            self._memo[key] = fingerprint
+            if self._disabled:
+                return
+            try:
+                self._connection().execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?)',
+                                           key + (HASH_NAME, fingerprint))
+            except sqlite3.Error as e:
+                self._disable(e)
+
+    def clear_memo(self):
+        """Forget the fingerprints held in memory (but not those in the database)."""
+        with self._lock:
+            self._memo.clear()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid==os.getpid():
+                self._conn.close()
+            self._conn = None
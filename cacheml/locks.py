@@ -0,0 +1,178 @@
+"""Per-entry locks, so that concurrent misses on the same entry compute it only once.
+
+When several workers call a cached function with the same arguments at the same
+time, they all miss, and without coordination they all compute the result. With
+single-flight locking, the first caller takes a lock on the entry and computes it,
+and the others wait for the lock, after which they load the result from the cache.
+
+The locks are files next to the entry directories (<entry>.lock), created with
+O_EXCL, so they work between processes (including on shared filesystems where
+flock() is not reliable) as well as between threads of one process. The lock file
+holds the host, process id and thread id of the holder.
+
+A holder that dies without releasing its lock would block the others, so locks can
+be stale:
+
+ * while a lock is held, a heartbeat thread updates the modification time of its
+   file. A lock file that has not been updated for stale_after seconds is stale,
+ * a lock held by a process that no longer exists on this host is stale.
+
+A stale lock is removed and the waiter tries again. Waiters give up after a timeout
+and compute the result themselves. In the rare races (e.g. two waiters removing the
+same stale lock), the worst case is computing the result more than once, which was
+the situation without locks: the entry files are always written atomically.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+import json
+import socket
+import threading
+import time
+import uuid
+
+DEFAULT_STALE_AFTER=60.0
+DEFAULT_LOCK_TIMEOUT=600.0
+# polling interval while waiting, doubled up to the maximum
+MIN_POLL=0.02
+MAX_POLL=1.0
+
+_HELD = set() # locks held by this process
+_HELD_LOCK = threading.Lock()
+_heartbeat = {'thread':None, 'pid':None}
+_wakeup = threading.Event() # set when a lock is acquired, to recompute the interval
+
+
+def _heartbeat_loop():
+    while True:
+        with _HELD_LOCK:
+            held = list(_HELD)
+        interval = min([l.stale_after for l in held], default=DEFAULT_STALE_AFTER)/4
+        for l in held:
+            try:
+                os.utime(l.path)
+            except OSError:
+                pass # released in the meantime
+        _wakeup.wait(interval)
+        _wakeup.clear()
+
+
+def _ensure_heartbeat():
+    # the thread does not survive a fork
+    if _heartbeat['thread'] is None or _heartbeat['pid']!=os.getpid():
+        _heartbeat['pid'] = os.getpid()
+        _heartbeat['thread'] = threading.Thread(target=_heartbeat_loop, name='cacheml-lock-heartbeat',
+                                                daemon=True)
+        _heartbeat['thread'].start()
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # exists, but owned by another user
+    return True
+
+
+class EntryLock:
+    """A lock file at path. Use acquire() and release(), or use it as a context manager,
+    which waits with the default timeout.
+    """
+    def __init__(self, path, stale_after=DEFAULT_STALE_AFTER):
+        self.path = path
+        self.stale_after = stale_after
+        self.held = False
+        # True if another holder had the lock when we tried to acquire it
+        self.contended = False
+        self._token = None
+
+    def _try_create(self):
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(self.path, os.O_CREAT|os.O_EXCL|os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'host':socket.gethostname(), 'pid':os.getpid(),
+                       'thread':threading.get_ident(), 'token':token}, f)
+        self._token = token
+        return True
+
+    def _read_owner(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None # removed, or being written
+
+    def is_stale(self):
+        """Return True if the lock file exists but its holder is gone."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return False
+        if time.time()-mtime>self.stale_after:
+            return True
+        owner = self._read_owner()
+        return owner is not None and owner.get('host')==socket.gethostname() and \
+               not _pid_exists(owner.get('pid'))
+
+    def _remove_stale(self):
+        owner = self._read_owner()
+        # check again just before removing, in case it was replaced by a new holder
+        if self.is_stale() and self._read_owner()==owner:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def acquire(self, timeout=DEFAULT_LOCK_TIMEOUT):
+        """Wait up to timeout seconds (forever if None) for the lock. Returns True if
+        it was acquired.
+        """
+        assert not self.held, f"Lock {self.path} is already held"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        deadline = None if timeout is None else time.time() + timeout
+        poll = MIN_POLL
+        self.contended = False
+        while not self._try_create():
+            self.contended = True
+            if self.is_stale():
+                self._remove_stale()
+                continue
+            if deadline is not None and time.time()>=deadline:
+                return False
+            time.sleep(poll if deadline is None else max(0, min(poll, deadline-time.time())))
+            poll = min(2*poll, MAX_POLL)
+        self.held = True
+        with _HELD_LOCK:
+            _HELD.add(self)
+            _ensure_heartbeat()
+        _wakeup.set()
+        return True
+
+    def release(self):
+        if not self.held:
+            return
+        with _HELD_LOCK:
+            _HELD.discard(self)
+        self.held = False
+        owner = self._read_owner()
+        if owner is not None and owner.get('token')==self._token:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __repr__(self):
+        return f"EntryLock({self.path}, held={self.held})"
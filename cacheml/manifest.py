@@ -0,0 +1,228 @@
+"""Manifest of the entries of a cache, in an SQLite database.
+
+joblib finds the entries of a cache (e.g. to enforce the size limit) by walking the
+cache directory and stat'ing every file, which takes minutes for a large cache on
+network storage. With the 'manifest' backend option, the store backend records each
+entry in a manifest when it is written, loaded or removed, and answers those
+questions with a query instead.
+
+Each entry is keyed by its path relative to the cache location (function id and
+argument hash), and records its size (the total size of the files in the entry's
+directory, i.e. the output and metadata files), when it was created and last
+accessed, how many times it was loaded (hits), and how long the result took to
+compute (from the entry's metadata). Pinned entries are never evicted, and the
+inflation value is used by the GreedyDual-Size eviction policy (see eviction.py).
+
+The database is in WAL mode, so that readers do not block the writer, and may be
+shared by the processes using the cache. Hits are buffered in memory and written in
+batches, so they add little to the cost of a cache hit. If the manifest is lost or
+gets out of date (e.g. entries were copied into the cache directory), it can be
+rebuilt from the files, see CacheMLStoreBackend.rebuild_manifest().
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+import time
+import sqlite3
+import threading
+import atexit
+import weakref
+
+# the buffered hits are written when there are this many, or after this many seconds
+HIT_BATCH_SIZE=100
+HIT_BATCH_SECONDS=5.0
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    func_id TEXT NOT NULL,
+    args_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    duration REAL,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    inflation REAL NOT NULL DEFAULT 0
+)'''
+# columns added since the first version of the manifest
+_ADDED_COLUMNS = {'pinned':'INTEGER NOT NULL DEFAULT 0', 'inflation':'REAL NOT NULL DEFAULT 0'}
+_STATE_SCHEMA = 'CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value REAL NOT NULL)'
+# the current inflation value, given to entries when they are written or hit
+_INFLATION = "(SELECT coalesce((SELECT value FROM state WHERE name='inflation'), 0))"
+
+_MANIFESTS = weakref.WeakSet()
+
+COLUMNS = ('path', 'func_id', 'args_id', 'size', 'created', 'last_access', 'hits', 'duration',
+           'pinned', 'inflation')
+
+
+def _escape_like(s):
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class Manifest:
+    """The manifest database at db_path. Entries are identified by their path
+    relative to the cache location, as a string. This is safe to use from
+    multiple threads.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.RLock()
+        self._hits = {} # path => (last access, number of hits)
+        self._hits_since = time.time()
+        _MANIFESTS.add(self)
+
+    def _connection(self):
+        if self._conn is None or self._pid!=os.getpid():
+            # a connection must not be used across a fork
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(_SCHEMA)
+            self._conn.execute(_STATE_SCHEMA)
+            existing = {row[1] for row in self._conn.execute('PRAGMA table_info(entries)')}
+            for (name, definition) in _ADDED_COLUMNS.items():
+                if name not in existing:
+                    self._conn.execute(f'ALTER TABLE entries ADD COLUMN {name} {definition}')
+            self._pid = os.getpid()
+            self._hits.clear()
+        return self._conn
+
+    def _split(self, path):
+        (func_id, args_id) = os.path.split(path)
+        return (func_id, args_id)
+
+    def record_entry(self, path, size, duration=None):
+        """Record a new entry, or update an existing one. The entry's output and
+        metadata files may be written in either order, so each write records the
+        size of the entry so far. The creation time is that of the first write.
+        """
+        now = time.time()
+        (func_id, args_id) = self._split(path)
+        with self._lock:
+            self._hits.pop(path, None)
+            self._connection().execute(
+                'INSERT INTO entries (path, func_id, args_id, size, created, last_access, duration, ' +
+                f'inflation) VALUES (?, ?, ?, ?, ?, ?, ?, {_INFLATION}) ON CONFLICT(path) DO UPDATE SET ' +
+                'size=excluded.size, last_access=excluded.last_access, ' +
+                'duration=coalesce(excluded.duration, duration), inflation=excluded.inflation',
+                (path, func_id, args_id, size, now, now, duration))
+
+    def record_hit(self, path):
+        """Record that the entry was loaded. This is buffered, see flush_hits()."""
+        with self._lock:
+            (_, count) = self._hits.get(path, (None, 0))
+            self._hits[path] = (time.time(), count+1)
+            if len(self._hits)>=HIT_BATCH_SIZE or time.time()-self._hits_since>=HIT_BATCH_SECONDS:
+                self.flush_hits()
+
+    def flush_hits(self):
+        """Write the buffered hits."""
+        with self._lock:
+            if len(self._hits)>0:
+                conn = self._connection()
+                with conn:
+                    conn.execute('BEGIN')
+                    conn.executemany('UPDATE entries SET last_access=max(last_access, ?), hits=hits+?, ' +
+                                     f'inflation={_INFLATION} WHERE path=?',
+                                     [(t, n, p) for (p, (t, n)) in self._hits.items()])
+                self._hits.clear()
+            self._hits_since = time.time()
+
+    def _where_prefix(self, prefix):
+        if prefix in ('', '.'):
+            return ('', ())
+        return ("WHERE path=? OR path LIKE ? ESCAPE '\\'", (prefix, _escape_like(prefix + os.sep) + '%'))
+
+    def remove(self, prefix):
+        """Remove the entry at prefix and all the entries under it ('' for all)."""
+        with self._lock:
+            self.flush_hits()
+            (where, params) = self._where_prefix(prefix)
+            self._connection().execute('DELETE FROM entries ' + where, params)
+
+    def pin(self, prefix, pinned=True):
+        """Pin (or unpin) the entry at prefix and all the entries under it, and
+        return the number of entries. Pinned entries are never evicted.
+        """
+        with self._lock:
+            (where, params) = self._where_prefix(prefix)
+            return self._connection().execute('UPDATE entries SET pinned=? ' + where,
+                                              (1 if pinned else 0,) + params).rowcount
+
+    @property
+    def inflation(self):
+        with self._lock:
+            return self._connection().execute('SELECT ' + _INFLATION).fetchone()[0]
+
+    def set_inflation(self, value):
+        """Raise the inflation value (it never decreases)."""
+        with self._lock:
+            self._connection().execute(
+                "INSERT INTO state (name, value) VALUES ('inflation', ?) " +
+                'ON CONFLICT(name) DO UPDATE SET value=max(value, excluded.value)', (value,))
+
+    def entries(self, func_id=None):
+        """Return the entries (of one function, if func_id is given) as dicts, most
+        recently accessed first.
+        """
+        with self._lock:
+            self.flush_hits()
+            query = f"SELECT {', '.join(COLUMNS)} FROM entries"
+            params = ()
+            if func_id is not None:
+                query += ' WHERE func_id=?'
+                params = (func_id,)
+            rows = self._connection().execute(query + ' ORDER BY last_access DESC', params).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def total_size(self):
+        with self._lock:
+            return self._connection().execute('SELECT coalesce(sum(size), 0) FROM entries').fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute('SELECT count(*) FROM entries').fetchone()[0]
+
+    def rebuild(self, entries):
+        """Replace the contents of the manifest with the entries, an iterable of dicts
+        with the path, size, created, last_access and duration of each entry. The
+        pins of the entries that were already in the manifest are kept.
+        """
+        with self._lock:
+            self._hits.clear()
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN')
+                pinned = [row[0] for row in conn.execute('SELECT path FROM entries WHERE pinned=1')]
+                conn.execute('DELETE FROM entries')
+                conn.executemany(
+                    'INSERT INTO entries (path, func_id, args_id, size, created, last_access, duration) ' +
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(e['path'],) + self._split(e['path']) +
+                     (e['size'], e['created'], e['last_access'], e.get('duration', None))
+                     for e in entries])
+                conn.executemany('UPDATE entries SET pinned=1 WHERE path=?', [(p,) for p in pinned])
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid==os.getpid():
+                self.flush_hits()
+                self._conn.close()
+            self._conn = None
+
+
+def _flush_all():
+    for manifest in list(_MANIFESTS):
+        if manifest._pid==os.getpid():
+            try:
+                manifest.flush_hits()
+            except sqlite3.Error:
+                pass # the hits are only used to order evictions
+
+atexit.register(_flush_all)
@@ -0,0 +1,151 @@
+"""In-process memory tier for cached results.
+
+This keeps recently loaded (or computed) results in memory, in front of the disk
+cache, so that repeated calls do not have to read, decrypt and unpickle the same
+entry. The tier has a budget in bytes, based on an estimate of the size of each
+result (see estimate_size()), and evicts the least recently used results first.
+
+Entries are keyed by the relative path of the entry in the disk cache, which joblib
+builds from the function id and the argument hash. The argument hash includes the
+stats of any LocalFile or S3File arguments, so a change to an input file results in
+a different key.
+
+The results are returned as is, not copied. As with functools.lru_cache, a caller
+that modifies a result in place will see the modified version on the next hit.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+import sys
+import threading
+import itertools
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+# with deep=False, the number of elements of a container that are measured
+_SAMPLE_SIZE=100
+
+
+def estimate_size(obj, deep=True, _seen=None):
+    """Estimate the memory used by obj, including the objects it references.
+    numpy arrays and pandas objects report their data size. Containers are
+    traversed; anything else is just sys.getsizeof().
+
+    With deep=False, the estimate is much cheaper for large objects: the Python
+    objects in object arrays and columns (e.g. strings) are not measured, and the
+    size of large containers is extrapolated from a sample of their elements.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    if np is not None and isinstance(obj, np.ndarray):
+        if obj.dtype==object and deep:
+            return sys.getsizeof(obj) + sum(estimate_size(o, deep, _seen) for o in obj.flat)
+        return sys.getsizeof(obj) if obj.base is None else obj.nbytes
+    if pd is not None and isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=deep).sum())
+    if pd is not None and isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep=deep))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += _estimate_elements(obj.items(), len(obj), deep, _seen, pairs=True)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += _estimate_elements(obj, len(obj), deep, _seen)
+    elif hasattr(obj, '__dict__'):
+        size += estimate_size(obj.__dict__, deep, _seen)
+    return size
+
+
+def _estimate_elements(elements, length, deep, _seen, pairs=False):
+    """The size of the elements of a container, or of the keys and values if pairs
+    is True. Without deep, a large container is estimated from a sample.
+    """
+    if deep or length<=_SAMPLE_SIZE:
+        (sample, scale) = (elements, 1)
+    else:
+        sample = list(itertools.islice(elements, 0, None, length//_SAMPLE_SIZE))
+        scale = length/len(sample)
+    total = 0
+    for element in sample:
+        if pairs:
+            total += estimate_size(element[0], deep, _seen) + estimate_size(element[1], deep, _seen)
+        else:
+            total += estimate_size(element, deep, _seen)
+    return int(total*scale)
+
+
+class MemoryTier:
+    """A byte-bounded LRU map from entry paths (relative to the cache location) to results.
+    This is safe to use from multiple threads.
+    """
+    def __init__(self, bytes_limit):
+        self.bytes_limit = bytes_limit
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # path => (result, size)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return (True, result) if the path is in the tier, (False, None) otherwise.
+        """
+        with self._lock:
+            try:
+                (result, _) = self._entries[path]
+            except KeyError:
+                self.misses += 1
+                return (False, None)
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return (True, result)
+
+    def put(self, path, result):
+        """Add a result. If it is larger than the budget, it is not added."""
+        size = estimate_size(result)
+        with self._lock:
+            self._discard(path)
+            if size>self.bytes_limit:
+                return
+            self._entries[path] = (result, size)
+            self.current_bytes += size
+            while self.current_bytes>self.bytes_limit:
+                (_, (_, evicted_size)) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def _discard(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def discard_prefix(self, prefix):
+        """Remove the entry at prefix and all the entries under it."""
+        if prefix in ('', '.'):
+            self.clear()
+            return
+        with self._lock:
+            for path in [p for p in self._entries if p==prefix or p.startswith(prefix + os.sep)]:
+                self._discard(path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f"MemoryTier({len(self._entries)} entries, {self.current_bytes} of " + \
+               f"{self.bytes_limit} bytes, {self.hits} hits, {self.misses} misses)"
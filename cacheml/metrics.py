@@ -0,0 +1,297 @@
+"""Metrics of cache operations.
+
+A CacheMetrics counts the hits, misses, bytes read and written and evictions of
+each cached function, and records a latency histogram for each phase of the calls:
+
+  PHASE_HASH         hashing the arguments (including checking the input files)
+  PHASE_LOOKUP       checking whether the entry is in the cache
+  PHASE_READ         reading the entry (for encrypted caches, see PHASE_DECRYPT)
+  PHASE_DECRYPT      reading and decrypting the entry of an encrypted cache. The
+                     reads and the decryption are pipelined, so they are measured
+                     together.
+  PHASE_DESERIALIZE  rebuilding the result from the bytes read
+  PHASE_COMPUTE      calling the function on a miss
+  PHASE_WRITE        serializing (and encrypting) the result and writing the entry
+
+The metrics are exported by passing a snapshot (see CacheMetrics.snapshot()) to
+exporters: a MetricsExporter, such as PrometheusTextfileExporter or JSONExporter,
+or any callable taking the snapshot.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+import io
+import json
+import time
+import atexit
+import bisect
+import threading
+import weakref
+from contextlib import contextmanager
+
+PHASE_HASH='hash'
+PHASE_LOOKUP='lookup'
+PHASE_READ='read'
+PHASE_DECRYPT='decrypt'
+PHASE_DESERIALIZE='deserialize'
+PHASE_COMPUTE='compute'
+PHASE_WRITE='write'
+PHASES=(PHASE_HASH, PHASE_LOOKUP, PHASE_READ, PHASE_DECRYPT, PHASE_DESERIALIZE,
+        PHASE_COMPUTE, PHASE_WRITE)
+
+COUNTERS=('hits', 'misses', 'bytes_read', 'bytes_written', 'evictions')
+
+# upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, 300.0)
+
+
+class Histogram:
+    """Counts of observations in LATENCY_BUCKETS, plus their sum."""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0]*len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        if i<len(self.counts):
+            self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def to_dict(self):
+        """The cumulative count of each bucket, as in Prometheus."""
+        cumulative = []
+        total = 0
+        for (le, n) in zip(LATENCY_BUCKETS, self.counts):
+            total += n
+            cumulative.append([le, total])
+        return {'count':self.count, 'sum':self.sum, 'buckets':cumulative}
+
+
+class _FunctionMetrics:
+    __slots__ = ('counters', 'phases')
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.phases = {}
+
+
+# per thread, the time spent in the timers running inside the current one
+_timer_stack = threading.local()
+
+# the CacheMetrics to export when the process exits
+_all_metrics = weakref.WeakSet()
+
+
+class CacheMetrics:
+    """The metrics of a cache, by function id. This is thread-safe. If
+    export_interval is set (in seconds), the metrics are exported when they
+    are updated and that much time has passed since the last export. They
+    are also exported when the process exits, if there are exporters.
+    """
+    def __init__(self, export_interval=None):
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._exporters = []
+        self.export_interval = export_interval
+        self._last_export = time.time()
+        _all_metrics.add(self)
+
+    def _function(self, func_id):
+        metrics = self._functions.get(func_id)
+        if metrics is None:
+            metrics = self._functions.setdefault(func_id, _FunctionMetrics())
+        return metrics
+
+    def count(self, func_id, counter, value=1):
+        """Add value to one of the COUNTERS of the function."""
+        with self._lock:
+            self._function(func_id).counters[counter] += value
+        self._maybe_export()
+
+    def observe(self, func_id, phase, seconds):
+        """Record the latency of one of the PHASES of the function."""
+        with self._lock:
+            phases = self._function(func_id).phases
+            histogram = phases.get(phase)
+            if histogram is None:
+                histogram = phases[phase] = Histogram()
+            histogram.observe(seconds)
+        self._maybe_export()
+
+    @contextmanager
+    def timer(self, func_id, phase, exclusive=False):
+        """Record the time spent in the with block. If exclusive is True, the time
+        spent in the timers nested in it (in the same thread) is not included, e.g.
+        to separate the function's computation from the hashing and writing done
+        by the joblib call.
+        """
+        stack = getattr(_timer_stack, 'stack', None)
+        if stack is None:
+            stack = _timer_stack.stack = []
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if len(stack)>0:
+                stack[-1] += elapsed
+            self.record_span(func_id, phase, start, elapsed, elapsed-nested if exclusive else elapsed)
+
+    def record_span(self, func_id, phase, start, elapsed, seconds=None):
+        """Record a phase that started at start (from time.perf_counter()) and took
+        elapsed seconds. The time observed is seconds if given, e.g. to exclude
+        nested phases.
+        """
+        self.observe(func_id, phase, seconds if seconds is not None else elapsed)
+
+    def record_reads(self, func_id, reader):
+        """Record the reads of an entry, given its MeteredReader."""
+        self.count(func_id, 'bytes_read', reader.bytes_read)
+
+    def snapshot(self):
+        """Return the metrics as a dict: 'time' (a timestamp) and 'functions', which
+        maps each function id to its COUNTERS and its 'phases', a dict of
+        histograms with the count, sum, and cumulative counts of the buckets.
+        """
+        with self._lock:
+            functions = {func_id:dict(m.counters,
+                                      phases={phase:h.to_dict() for (phase, h) in m.phases.items()})
+                         for (func_id, m) in self._functions.items()}
+        return {'time':time.time(), 'functions':functions}
+
+    def reset(self):
+        with self._lock:
+            self._functions = {}
+
+    def add_exporter(self, exporter):
+        """Add a MetricsExporter, or a callable which is passed the snapshot."""
+        self._exporters.append(exporter)
+
+    def export(self):
+        """Pass a snapshot to the exporters."""
+        self._last_export = time.time()
+        if len(self._exporters)==0:
+            return
+        snapshot = self.snapshot()
+        for exporter in self._exporters:
+            if isinstance(exporter, MetricsExporter):
+                exporter.export(snapshot)
+            else:
+                exporter(snapshot)
+
+    def _maybe_export(self):
+        if self.export_interval is not None and time.time()-self._last_export>=self.export_interval:
+            self.export()
+
+
+@atexit.register
+def _export_all():
+    for metrics in list(_all_metrics):
+        metrics.export()
+
+
+class MetricsExporter:
+    """Base class of the exporters."""
+    def export(self, snapshot):
+        raise NotImplementedError()
+
+
+def _write_atomically(path, text):
+    # readers (e.g. the Prometheus node exporter) never see a partial file
+    temporary_path = f'{path}.tmp-pid-{os.getpid()}'
+    with open(temporary_path, 'w') as f:
+        f.write(text)
+    os.replace(temporary_path, path)
+
+
+class JSONExporter(MetricsExporter):
+    """Write the snapshot to a JSON file."""
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, snapshot):
+        _write_atomically(self.path, json.dumps(snapshot, indent=2))
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusTextfileExporter(MetricsExporter):
+    """Write the metrics in the Prometheus text format, for the textfile collector
+    of the node exporter. The metric names start with prefix, and the functions
+    and phases are labels.
+    """
+    def __init__(self, path, prefix='cacheml'):
+        self.path = path
+        self.prefix = prefix
+
+    def export(self, snapshot):
+        out = io.StringIO()
+        functions = sorted(snapshot['functions'].items())
+        for counter in COUNTERS:
+            name = f'{self.prefix}_{counter}_total'
+            out.write(f'# HELP {name} Cache {counter.replace("_", " ")} of each function.\n')
+            out.write(f'# TYPE {name} counter\n')
+            for (func_id, metrics) in functions:
+                out.write(f'{name}{{function="{_label(func_id)}"}} {metrics[counter]}\n')
+        name = f'{self.prefix}_phase_seconds'
+        out.write(f'# HELP {name} Latency of each phase of the cached calls.\n')
+        out.write(f'# TYPE {name} histogram\n')
+        for (func_id, metrics) in functions:
+            for (phase, histogram) in sorted(metrics['phases'].items()):
+                labels = f'function="{_label(func_id)}",phase="{phase}"'
+                for (le, n) in histogram['buckets']:
+                    out.write(f'{name}_bucket{{{labels},le="{le}"}} {n}\n')
+                out.write(f'{name}_bucket{{{labels},le="+Inf"}} {histogram["count"]}\n')
+                out.write(f'{name}_sum{{{labels}}} {histogram["sum"]}\n')
+                out.write(f'{name}_count{{{labels}}} {histogram["count"]}\n')
+        _write_atomically(self.path, out.getvalue())
+
+
+def size_bucket(size):
+    """The power of 2 at or above size, to group read sizes."""
+    return 1 << max(size-1, 0).bit_length()
+
+
+class MeteredReader(io.RawIOBase):
+    """Wraps a (buffered) file object being read, counting the bytes read, the
+    time spent reading them, and the read calls by size_bucket() of the size
+    requested. Wrap it in an io.BufferedReader for peek().
+    """
+    def __init__(self, fileobj):
+        super().__init__()
+        self._fileobj = fileobj
+        self.bytes_read = 0
+        self.seconds = 0.0
+        self.read_calls = 0
+        self.read_sizes = {}
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self._fileobj.seekable()
+
+    def readinto(self, b):
+        start = time.perf_counter()
+        n = self._fileobj.readinto(b)
+        self.seconds += time.perf_counter() - start
+        self.bytes_read += n or 0
+        self.read_calls += 1
+        bucket = size_bucket(len(b))
+        self.read_sizes[bucket] = self.read_sizes.get(bucket, 0) + 1
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self._fileobj.tell()
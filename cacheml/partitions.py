@@ -0,0 +1,76 @@
+"""Per-partition caching of functions over datasets.
+
+A dataset (a LocalDirectory or S3Prefix) can be passed to any cached function, but
+then the result is keyed on the stats of all its files, so adding one partition
+means processing all of them again. A PartitionedFunc instead calls the cached
+function once per file of the dataset, so each partition's result is a separate
+cache entry, and combines the per-partition results (by default, by concatenating
+them). When a partition is added or changed, only that partition is processed.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+try:
+    from .local_stats import local_validation_scope
+    from .s3_stats import s3_validation_scope
+except ImportError:
+    from local_stats import local_validation_scope
+    from s3_stats import s3_validation_scope
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+def concat_results(results):
+    """Concatenate the per-partition results: DataFrames and Series with pandas.concat(),
+    numpy arrays with numpy.concatenate(), and lists and tuples by joining them. For
+    other types, the list of results is returned.
+    """
+    if len(results)==0:
+        return results
+    if pd is not None and all(isinstance(r, (pd.DataFrame, pd.Series)) for r in results):
+        return pd.concat(results)
+    if np is not None and all(isinstance(r, np.ndarray) for r in results):
+        return np.concatenate(results)
+    if all(isinstance(r, list) for r in results):
+        return [v for r in results for v in r]
+    if all(isinstance(r, tuple) for r in results):
+        return tuple(v for r in results for v in r)
+    return results
+
+
+class PartitionedFunc:
+    """Calls a cached function on each file of a dataset and combines the results.
+    This is returned by Cache.cache_partitions(). Calling it with a dataset and
+    additional arguments calls the cached function as func(file, *args, **kwargs)
+    for each file of the dataset, in path order.
+    """
+    def __init__(self, cached_func, combine=None):
+        self.cached_func = cached_func
+        self.combine = combine if combine is not None else concat_results
+
+    @property
+    def func(self):
+        return self.cached_func.func
+
+    def call_partitions(self, dataset, *args, **kwargs):
+        """Return the list of per-partition results, without combining them."""
+        with local_validation_scope(), s3_validation_scope():
+            # the listing is done within the scope, so the stats of the files
+            # are not checked again when hashing the arguments
+            return [self.cached_func(f, *args, **kwargs) for f in dataset.files()]
+
+    def __call__(self, dataset, *args, **kwargs):
+        return self.combine(self.call_partitions(dataset, *args, **kwargs))
+
+    def clear(self, warn=True):
+        """Remove the results of all the partitions."""
+        self.cached_func.clear(warn=warn)
+
+    def __repr__(self):
+        return f'PartitionedFunc({self.cached_func})'
@@ -0,0 +1,149 @@
+"""Background persistence of cache entries.
+
+Writing an entry (serializing, compressing, encrypting and renaming it) can take
+several seconds for a large result. With the 'persist_in_background' backend option,
+the store backend hands new entries to a PersistQueue and returns at once, so the
+caller gets its result without waiting for the write. A single worker thread
+writes the entries in order.
+
+Until an entry has been written, it is served from the queue, so a later call in the
+same process does not recompute it. Other processes only see it once it is written.
+The items are not copied (that would cost as much as the write we are avoiding), so
+callers must not modify a result in place until it has been written (see flush()):
+the modified version would be cached.
+
+The queue has a budget in bytes, based on memory_tier.estimate_size() with
+deep=False, so that sizing an item on the caller's thread is cheap even for a large
+DataFrame (the strings of object columns are not measured). When the pending entries
+exceed it, submitting another one blocks until there is room (backpressure), which
+bounds the memory held by the queue. flush() waits until all
+the pending entries are written, and all the queues are flushed at exit.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+import threading
+import atexit
+import weakref
+import warnings
+from collections import deque
+import concurrent.futures.thread
+
+try:
+    from .memory_tier import estimate_size
+except ImportError:
+    from memory_tier import estimate_size
+
+DEFAULT_QUEUE_LIMIT=1024*1024*1024
+
+_QUEUES = weakref.WeakSet()
+
+
+class PersistQueue:
+    """Writes entries in a background thread. The entries are identified by a key
+    (their path relative to the cache location), and written by calling the
+    function given to submit(). This is safe to use from multiple threads.
+    """
+    def __init__(self, bytes_limit=DEFAULT_QUEUE_LIMIT):
+        self.bytes_limit = bytes_limit
+        self.pending_bytes = 0
+        self._tasks = deque() # (key, item, size, write_func)
+        self._items = {} # key => latest pending item
+        self._running = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        _QUEUES.add(self)
+
+    def _ensure_worker(self):
+        # the worker thread does not survive a fork, so each process starts its own
+        if self._thread is None or self._pid!=os.getpid():
+            if self._pid is not None:
+                # the pending entries are written by the parent
+                self._tasks.clear()
+                self._items.clear()
+                self.pending_bytes = 0
+                self._running = 0
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='cacheml-persist', daemon=True)
+            self._thread.start()
+
+    def submit(self, key, item, write_func):
+        """Queue write_func() to write item, blocking while the queue is over budget.
+        The item must not be modified until it is written.
+        """
+        size = estimate_size(item, deep=False)
+        with self._cond:
+            self._ensure_worker()
+            # always accept an item when the queue is empty, even if it is over budget
+            while (len(self._tasks)>0 or self._running>0) and \
+                  self.pending_bytes + size>self.bytes_limit:
+                self._cond.wait()
+            self._tasks.append((key, item, size, write_func))
+            self._items[key] = item
+            self.pending_bytes += size
+            self._cond.notify_all()
+
+    def after_pending(self, func):
+        """Call func() in the worker thread once the items submitted so far are written."""
+        with self._cond:
+            self._ensure_worker()
+            self._tasks.append((None, None, 0, func))
+            self._cond.notify_all()
+
+    def get(self, key):
+        """Return (True, item) if there is a pending item for the key, (False, None) otherwise."""
+        with self._cond:
+            if key in self._items:
+                return (True, self._items[key])
+            return (False, None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._tasks)==0:
+                    self._cond.wait()
+                (key, item, size, write_func) = self._tasks.popleft()
+                self._running += 1
+            try:
+                write_func()
+            except Exception as e:
+                warnings.warn(f"Unable to persist cache entry {key}: {e}")
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self.pending_bytes -= size
+                    if self._items.get(key) is item:
+                        del self._items[key]
+                    self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until all the pending entries are written. Returns False if the
+        timeout (in seconds) expired first.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self._tasks)==0 and self._running==0,
+                                       timeout=timeout)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._tasks) + self._running
+
+    def __repr__(self):
+        return f"PersistQueue({len(self)} pending, {self.pending_bytes} of {self.bytes_limit} bytes)"
+
+
+def _flush_all():
+    for queue in list(_QUEUES):
+        if queue._pid==os.getpid():
+            queue.flush()
+
+# The writes may use a concurrent.futures executor (see crypto.py), which refuses new
+# work once its own exit hook has run. That hook is registered with
+# threading._register_atexit(), which runs before atexit and in reverse order,
+# so we register there as well (after importing concurrent.futures), to run first.
+if hasattr(threading, '_register_atexit'):
+    threading._register_atexit(_flush_all)
+else:
+    atexit.register(_flush_all)
@@ -0,0 +1,254 @@
+"""Profiling of cached calls.
+
+A Profile records a trace of each call to a cached function made while it is
+active (see Cache.profile()): the time spent in each phase (see metrics.py, plus
+PHASE_STAT for checking the input files), the bytes read and written, the number
+of read calls on the entry and their sizes, and, with trace_memory, the peak memory
+allocated during the call (from tracemalloc, see _peak_since()). The trace can be
+printed with table(), or saved with save_chrome_trace() for chrome://tracing or
+Perfetto.
+
+Each call is recorded in the thread that made it. Entries written by the background
+persistence thread are recorded as events outside of any call.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    from .metrics import CacheMetrics, PHASE_HASH, PHASE_LOOKUP, PHASE_READ, PHASE_DECRYPT, \
+        PHASE_DESERIALIZE, PHASE_COMPUTE, PHASE_WRITE
+except ImportError:
+    from metrics import CacheMetrics, PHASE_HASH, PHASE_LOOKUP, PHASE_READ, PHASE_DECRYPT, \
+        PHASE_DESERIALIZE, PHASE_COMPUTE, PHASE_WRITE
+
+# checking the stats of the input files (part of PHASE_HASH)
+PHASE_STAT='stat'
+# a whole call of a cached function
+PHASE_CALL='call'
+
+TABLE_PHASES=(PHASE_HASH, PHASE_STAT, PHASE_LOOKUP, PHASE_READ, PHASE_DECRYPT,
+              PHASE_DESERIALIZE, PHASE_COMPUTE, PHASE_WRITE)
+
+MB=1024*1024
+
+# the active profiles, see profile_span()
+_active_profiles = []
+
+
+def is_profiling():
+    return len(_active_profiles)>0
+
+
+def profile_span(phase, **args):
+    """Record the with block as an event of the active profiles. This is for
+    the phases that are not measured by the metrics.
+    """
+    if len(_active_profiles)==0:
+        return nullcontext()
+    return _span(list(_active_profiles), phase, args)
+
+
+@contextmanager
+def _span(profiles, phase, args):
+    if phase==PHASE_CALL:
+        calls = [p._begin_call(args) for p in profiles]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for (i, p) in enumerate(profiles):
+            if phase==PHASE_CALL:
+                p._end_call(calls[i], elapsed)
+            else:
+                p._add_event(phase, args, start, elapsed, elapsed)
+
+
+def _reset_peak():
+    """Reset the peak of the traced memory, and return the (current, peak) traced
+    memory, for _peak_since().
+    """
+    if hasattr(tracemalloc, 'reset_peak'): # Python 3.9
+        tracemalloc.reset_peak()
+    return tracemalloc.get_traced_memory()
+
+
+def _peak_since(at_reset):
+    """Return the peak of the traced memory since _reset_peak() returned at_reset.
+    Without tracemalloc.reset_peak(), the peak is exact if it was raised since then,
+    otherwise this is the highest of the traced memory then and now.
+    """
+    (current, peak) = tracemalloc.get_traced_memory()
+    if at_reset is None or hasattr(tracemalloc, 'reset_peak') or peak>at_reset[1]:
+        return peak
+    return max(current, at_reset[0])
+
+
+def _format_size(size):
+    for (unit, scale) in (('M', MB), ('K', 1024)):
+        if size>=scale:
+            return f'{size//scale}{unit}'
+    return str(size)
+
+
+class Profile(CacheMetrics):
+    """The trace of the calls made while the profile is active. As this is a
+    CacheMetrics, it also aggregates the metrics of the calls. The metrics are
+    passed on to the cache's own metrics, if enabled.
+
+    calls is a list of dicts, one per call, with the 'function', 'start' and
+    'duration' of the call, whether it was a 'hit', its 'events' (dicts with the
+    'phase', 'start', 'duration', and 'seconds', which excludes nested phases for
+    PHASE_COMPUTE), its counters ('bytes_read', 'bytes_written', 'hits', 'misses'),
+    'read_calls', 'read_sizes' (number of read calls by size, rounded up to a power
+    of 2), and 'peak_memory' in bytes (None without trace_memory). events holds
+    the events outside of calls.
+    """
+    def __init__(self, metrics=None, trace_memory=True):
+        super().__init__()
+        self.metrics = metrics
+        self.trace_memory = trace_memory
+        self.calls = []
+        self.events = []
+        self._calls = threading.local()
+        self._started_tracemalloc = False
+        self._origin = time.perf_counter()
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        _active_profiles.append(self)
+
+    def stop(self):
+        _active_profiles.remove(self)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _call_stack(self):
+        stack = getattr(self._calls, 'stack', None)
+        if stack is None:
+            stack = self._calls.stack = []
+        return stack
+
+    def _current_call(self):
+        stack = self._call_stack()
+        return stack[-1] if len(stack)>0 else None
+
+    def _begin_call(self, args):
+        stack = self._call_stack()
+        if self.trace_memory and len(stack)==0 and tracemalloc.is_tracing():
+            self._calls.memory_at_start = _reset_peak()
+        call = {'function':args.get('function'), 'start':time.perf_counter()-self._origin,
+                'duration':None, 'hit':None, 'events':[], 'bytes_read':0, 'bytes_written':0,
+                'hits':0, 'misses':0, 'read_calls':0, 'read_sizes':{}, 'peak_memory':None,
+                'tid':threading.get_ident()}
+        stack.append(call)
+        return call
+
+    def _end_call(self, call, elapsed):
+        stack = self._call_stack()
+        stack.pop()
+        call['duration'] = elapsed
+        call['hit'] = call['misses']==0
+        if self.trace_memory and tracemalloc.is_tracing():
+            call['peak_memory'] = _peak_since(getattr(self._calls, 'memory_at_start', None))
+        if len(stack)==0:
+            self.calls.append(call)
+        else:
+            # a cached function called by another one
+            stack[-1]['events'].append(dict(call, phase=PHASE_CALL))
+
+    def _add_event(self, phase, args, start, elapsed, seconds):
+        event = dict(args, phase=phase, start=start-self._origin, duration=elapsed, seconds=seconds,
+                     tid=threading.get_ident())
+        call = self._current_call()
+        (call['events'] if call is not None else self.events).append(event)
+
+    def record_span(self, func_id, phase, start, elapsed, seconds=None):
+        self._add_event(phase, {'function':func_id}, start, elapsed,
+                        seconds if seconds is not None else elapsed)
+        super().record_span(func_id, phase, start, elapsed, seconds)
+
+    def observe(self, func_id, phase, seconds):
+        super().observe(func_id, phase, seconds)
+        if self.metrics is not None:
+            self.metrics.observe(func_id, phase, seconds)
+
+    def count(self, func_id, counter, value=1):
+        super().count(func_id, counter, value)
+        if self.metrics is not None:
+            self.metrics.count(func_id, counter, value)
+        call = self._current_call()
+        if call is not None and counter in call:
+            call[counter] += value
+
+    def record_reads(self, func_id, reader):
+        super().record_reads(func_id, reader)
+        call = self._current_call()
+        if call is not None:
+            call['read_calls'] += reader.read_calls
+            for (size, n) in reader.read_sizes.items():
+                call['read_sizes'][size] = call['read_sizes'].get(size, 0) + n
+
+    def phase_seconds(self, call):
+        """Return the seconds spent in each phase of the call, a dict."""
+        seconds = {}
+        for event in call['events']:
+            if event['phase']!=PHASE_CALL:
+                seconds[event['phase']] = seconds.get(event['phase'], 0.0) + event['seconds']
+        return seconds
+
+    def table(self):
+        """Return the calls as a table (a string), with the seconds spent in each phase."""
+        phases = [p for p in TABLE_PHASES
+                  if any(p in self.phase_seconds(call) for call in self.calls)]
+        lines = [f"{'#':>3} {'function':<40} {'result':<6} {'total s':>8} " +
+                 ''.join(f'{p[:11]:>12}' for p in phases) +
+                 f" {'MB read':>8} {'MB written':>10} {'reads':>6} {'peak MB':>8}  read sizes"]
+        for (i, call) in enumerate(self.calls):
+            seconds = self.phase_seconds(call)
+            peak = f"{call['peak_memory']/MB:8.1f}" if call['peak_memory'] is not None else f"{'-':>8}"
+            sizes = ' '.join(f"{_format_size(size)}:{n}" for (size, n) in sorted(call['read_sizes'].items()))
+            lines.append(f"{i:3d} {str(call['function'])[-40:]:<40} {'hit' if call['hit'] else 'miss':<6} " +
+                         f"{call['duration']:8.3f} " +
+                         ''.join(f"{seconds[p]:12.3f}" if p in seconds else f"{'-':>12}" for p in phases) +
+                         f" {call['bytes_read']/MB:8.1f} {call['bytes_written']/MB:10.1f} " +
+                         f"{call['read_calls']:6d} {peak}  {sizes}")
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Return the trace in the Chrome trace event format, as a dict."""
+        pid = os.getpid()
+        trace_events = []
+        def add(event, name, args):
+            trace_events.append({'name':name, 'cat':event['phase'], 'ph':'X', 'pid':pid,
+                                 'tid':event['tid'], 'ts':event['start']*1e6,
+                                 'dur':event['duration']*1e6, 'args':args})
+        def add_call(call):
+            add(dict(call, phase=PHASE_CALL), str(call['function']),
+                {k:call[k] for k in ('hit', 'bytes_read', 'bytes_written', 'read_calls', 'peak_memory')})
+            for event in call['events']:
+                if event['phase']==PHASE_CALL:
+                    add_call(event)
+                else:
+                    add(event, event['phase'], {k:v for (k, v) in event.items()
+                                                if k not in ('phase', 'start', 'duration', 'tid')})
+        for call in self.calls:
+            add_call(call)
+        for event in self.events:
+            add(event, event['phase'], {k:v for (k, v) in event.items()
+                                        if k not in ('phase', 'start', 'duration', 'tid')})
+        return {'traceEvents':trace_events, 'displayTimeUnit':'ms'}
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
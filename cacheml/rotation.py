@@ -0,0 +1,165 @@
+"""Rotation of the encryption key of a cache.
+
+Rotating a key re-encrypts every file of the cache (entries, metadata and function
+code) with the new key, so the cached results do not have to be recomputed. Each
+file is streamed through decryption with the old key and encryption with the new
+one, to a temporary file next to it, which then replaces the original (an atomic
+rename). The cleartext is never written to disk.
+
+The files are written in FORMAT_GCM (see crypto.py), whose authentication tells us
+whether a file was already encrypted with the new key. Thus, an interrupted rotation
+is resumed by running it again with the same keys: the files that were already
+rotated are skipped. FORMAT_CTR files are not authenticated, so they are always
+rotated, and the old key must be the right one. Before rotating, we check the old key
+against a sample of the FORMAT_GCM files, and stop if it matches none of them, so that
+a wrong key does not destroy the cache. A FORMAT_GCM file that authenticates with
+neither key is damaged: it is reported as an error, or removed (so that its result is
+recomputed) if remove_damaged is set.
+
+The files are spread over a pool of processes, and the frames of each file are
+encrypted and decrypted in parallel by the crypto thread pool, so the rotation is
+limited by the disk rather than by AES. The cache should not be used while its key is
+rotated: readers with either key will fail on some of the files, and recompute them.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    from .crypto import encrypted_file_open, key_matches, FORMAT_GCM, BUF_SIZE
+except ImportError:
+    from crypto import encrypted_file_open, key_matches, FORMAT_GCM, BUF_SIZE
+
+# size of the copies from the old file to the new one, several frames so that they
+# are decrypted in parallel
+COPY_SIZE=16*BUF_SIZE
+
+# number of files checked by check_old_key()
+KEY_CHECK_SAMPLE_SIZE=16
+
+
+def rotate_file(filename, old_key, new_key, remove_damaged=False):
+    """Re-encrypt the file with new_key. Returns True if it was rotated, False if
+    it was already encrypted with new_key, and None if it authenticates with
+    neither key and was removed. Without remove_damaged, such a file raises a
+    ValueError instead.
+    """
+    if key_matches(filename, new_key):
+        return False
+    if key_matches(filename, old_key) is False:
+        if not remove_damaged:
+            raise ValueError("the file does not authenticate with the old or the new key")
+        os.remove(filename)
+        return None
+    # like joblib's temporary files, so the name has the same extension (the
+    # FORMAT_CTR nonce depends on it) and the store backend ignores it
+    temporary_filename = f'{filename}.rotate-pid-{os.getpid()}'
+    try:
+        buffer = bytearray(COPY_SIZE)
+        view = memoryview(buffer)
+        with encrypted_file_open(filename, 'rb', old_key) as reader, \
+             encrypted_file_open(temporary_filename, 'wb', new_key, file_format=FORMAT_GCM) as writer:
+            while True:
+                n = reader.readinto(buffer)
+                if n==0:
+                    break
+                writer.write(view[0:n])
+        # the original is gone after the rename, so the new file must be on disk
+        with open(temporary_filename, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temporary_filename, filename)
+    except BaseException:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+    return True
+
+
+def _cache_files(location):
+    for (dirpath, _, filenames) in os.walk(location):
+        for name in filenames:
+            if '.rotate-pid-' in name:
+                # left by an interrupted rotation
+                os.remove(os.path.join(dirpath, name))
+            elif not (name.endswith('.lock') or '-pid-' in name):
+                # skip the entry locks and the temporary files of writes
+                yield os.path.join(dirpath, name)
+
+
+def check_old_key(filenames, old_key, new_key, sample_size=KEY_CHECK_SAMPLE_SIZE):
+    """Check old_key against up to sample_size of the FORMAT_GCM files that are not
+    already encrypted with new_key. Raises a ValueError if it matches none of them,
+    unless some files are already encrypted with new_key: the rotation was then
+    started with a matching old_key, and only damaged files may be left. If there
+    are no FORMAT_GCM files to check, we cannot tell.
+    """
+    (checked, resumed) = (0, False)
+    for filename in filenames:
+        if checked==sample_size:
+            break
+        try:
+            matches_new = key_matches(filename, new_key)
+            if matches_new is not False:
+                # already rotated, or not authenticated
+                resumed = resumed or matches_new
+                continue
+            if key_matches(filename, old_key):
+                return
+        except FileNotFoundError:
+            continue
+        checked += 1
+    if checked>0 and not resumed:
+        raise ValueError(f"The old key does not match any of the {checked} cache files checked, "
+                         "it is probably not the key of this cache")
+
+
+def _rotate_files(filenames, old_key, new_key, remove_damaged=False):
+    """Rotate a batch of files in a worker process. Returns (rotated, skipped,
+    removed, errors).
+    """
+    (rotated, skipped, removed, errors) = (0, 0, [], [])
+    for filename in filenames:
+        try:
+            result = rotate_file(filename, old_key, new_key, remove_damaged)
+            if result is None:
+                removed.append(filename)
+            elif result:
+                rotated += 1
+            else:
+                skipped += 1
+        except FileNotFoundError:
+            pass # removed in the meantime
+        except Exception as e:
+            errors.append((filename, str(e)))
+    return (rotated, skipped, removed, errors)
+
+
+def rotate_cache_key(location, old_key, new_key, workers=None, batch_size=16,
+                     remove_damaged=False):
+    """Re-encrypt all the files under location with new_key, using workers
+    processes (default: the number of CPUs). Returns (number of files rotated,
+    number already encrypted with new_key, list of damaged files that were
+    removed, list of (filename, error) for the files that could not be rotated).
+    The damaged files are only removed if remove_damaged is set, otherwise they
+    are errors. Raises a ValueError, before any file is changed, if old_key does
+    not match the cache (see check_old_key()).
+    """
+    filenames = sorted(_cache_files(location))
+    check_old_key(filenames, old_key, new_key)
+    batches = [filenames[i:i+batch_size] for i in range(0, len(filenames), batch_size)]
+    workers = workers if workers is not None else (os.cpu_count() or 1)
+    if workers<=1 or len(batches)<=1:
+        return _rotate_files(filenames, old_key, new_key, remove_damaged)
+    (rotated, skipped, removed, errors) = (0, 0, [], [])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_rotate_files, batch, old_key, new_key, remove_damaged)
+                   for batch in batches]
+        for future in as_completed(futures):
+            (r, s, rm, e) = future.result()
+            rotated += r
+            skipped += s
+            removed.extend(rm)
+            errors.extend(e)
+    return (rotated, skipped, removed, errors)
@@ -0,0 +1,105 @@
+"""Process-wide pool of S3FileSystem objects.
+
+Each S3FileSystem has its own client and connection pool, so creating one for every
+S3File (or every time one is unpickled) means a new client and new TLS sessions each
+time. Instead, we share one S3FileSystem per set of options (profile, endpoint,
+credentials, etc.) within a process.
+
+Clients must not be shared across a fork, so the pool remembers the process id that
+created it. A child process (e.g. a loky or multiprocessing worker) discards the
+inherited pool and lazily builds its own on first use.
+
+Asynchronous filesystems (for use from asyncio code) are bound to an event loop, so
+there is a separate pool for each loop, see get_async_s3_filesystem().
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import os
+import json
+import threading
+import weakref
+import asyncio
+
+from s3fs import S3FileSystem
+
+_POOL = {}
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+_ASYNC_POOL = weakref.WeakKeyDictionary() # event loop => {key: filesystem}
+
+
+def pool_key(options):
+    """Return the key of the pool entry for the S3FileSystem options."""
+    # the options may contain nested dicts (e.g. client_kwargs), so we cannot
+    # just use a tuple of the items
+    return json.dumps(options, sort_keys=True, default=repr)
+
+
+def _check_pid():
+    global _POOL_PID
+    if _POOL_PID!=os.getpid():
+        # new process: the inherited clients belong to the parent
+        _POOL.clear()
+        _ASYNC_POOL.clear()
+        _POOL_PID = os.getpid()
+
+
+def get_s3_filesystem(**options):
+    """Return the shared S3FileSystem for these options, creating it if needed.
+    The options are the keyword arguments of S3FileSystem.
+    """
+    key = pool_key(options)
+    with _POOL_LOCK:
+        _check_pid()
+        fs = _POOL.get(key)
+        if fs is None:
+            # we do our own caching of instances, so that we control when they are dropped
+            fs = S3FileSystem(skip_instance_cache=True, **options)
+            _POOL[key] = fs
+        return fs
+
+
+async def get_async_s3_filesystem(**options):
+    """Return the shared asynchronous S3FileSystem for these options and the running
+    event loop, creating it (and its session) if needed.
+    """
+    loop = asyncio.get_running_loop()
+    key = pool_key(options)
+    with _POOL_LOCK:
+        _check_pid()
+        filesystems = _ASYNC_POOL.setdefault(loop, {})
+        fs = filesystems.get(key)
+    if fs is None:
+        fs = S3FileSystem(skip_instance_cache=True, asynchronous=True, loop=loop, **options)
+        await fs.set_session()
+        with _POOL_LOCK:
+            # another task may have created one in the meantime
+            if filesystems.setdefault(key, fs) is not fs:
+                await fs._s3.close()
+                fs = filesystems[key]
+    return fs
+
+
+async def close_async_s3_filesystems():
+    """Close the sessions of the asynchronous filesystems of the running event loop,
+    and remove them from the pool. Call this before closing the loop.
+    """
+    with _POOL_LOCK:
+        filesystems = _ASYNC_POOL.pop(asyncio.get_running_loop(), {})
+    for fs in filesystems.values():
+        if fs._s3 is not None:
+            await fs._s3.close()
+
+
+def clear_s3_filesystems():
+    """Drop all the pooled filesystems, e.g. after the credentials have changed."""
+    with _POOL_LOCK:
+        _POOL.clear()
+        _ASYNC_POOL.clear()
+
+
+def num_s3_filesystems():
+    """Return the number of filesystems in the pool of this process."""
+    with _POOL_LOCK:
+        return len(_POOL) if _POOL_PID==os.getpid() else 0
@@ -0,0 +1,199 @@
+"""Validation of S3 input files.
+
+To check whether a cached result is still valid for an S3File argument, we need the
+current stats of the object. Getting them one object at a time means a HEAD request
+per object, and joblib asks for them more than once per call. Here, we keep the
+stats in a process-wide table, and provide:
+
+ * validate_s3_files(), which gets the stats of many files with one (paginated)
+   listing per common prefix, rather than one request per file,
+ * a time-to-live (TTL), so that objects validated recently are not checked again,
+ * a validation scope (see s3_validation_scope()). Within a scope, each object is
+   checked at most once, whatever the TTL. Cached functions hash their arguments
+   within a scope. Scopes are per thread and per asyncio task.
+
+The stats used in the cache keys are normally the LastModified time and size. If
+use_etag is set, we use the ETag instead of the time, so that re-uploading
+identical content keeps the existing cache entries. Note that ETags of multipart
+uploads depend on the part size, so the same content uploaded by a different tool
+may still get a different ETag.
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import posixpath
+import asyncio
+
+try:
+    from .s3_pool import pool_key, get_s3_filesystem, get_async_s3_filesystem
+except ImportError:
+    from s3_pool import pool_key, get_s3_filesystem, get_async_s3_filesystem
+
+# Default settings: stats are checked again on every use, and keyed on LastModified
+DEFAULT_TTL=0.0
+
+_settings = {'ttl':DEFAULT_TTL, 'use_etag':False}
+_STATS = {} # (pool key, path) => (info, time of validation)
+_LOCK = threading.Lock()
+# the keys validated in the current scope, per thread (or asyncio task)
+_validated = ContextVar('s3_validated', default=None)
+
+
+def configure_s3_validation(ttl=None, use_etag=None):
+    """Set the TTL, in seconds, for the stats of S3 objects, and whether cache keys
+    use the ETag of the objects rather than their LastModified time. A value of
+    None leaves that setting unchanged.
+    """
+    if ttl is not None:
+        _settings['ttl'] = float(ttl)
+    if use_etag is not None:
+        _settings['use_etag'] = bool(use_etag)
+
+
+def clear_s3_stats():
+    """Forget all the stats, so that the next use of each object checks it again."""
+    with _LOCK:
+        _STATS.clear()
+
+
+def _normalize(path):
+    return path[len('s3://'):] if path.startswith('s3://') else path
+
+
+def _get_cached(key):
+    with _LOCK:
+        entry = _STATS.get(key)
+    if entry is None:
+        return None
+    (info, validated_at) = entry
+    validated = _validated.get()
+    if validated is not None and key in validated:
+        return info
+    if time.time()-validated_at<=_settings['ttl'] and _settings['ttl']>0:
+        return info
+    return None
+
+
+def _put(key, info):
+    with _LOCK:
+        _STATS[key] = (info, time.time())
+    validated = _validated.get()
+    if validated is not None:
+        validated.add(key)
+
+
+def stats_from_info(info):
+    """Return the stats tuple used in cache keys from an S3 info dict."""
+    if _settings['use_etag']:
+        return (info['ETag'], info['size'])
+    return (info['LastModified'], info['size'])
+
+
+def get_s3_stats(fs, s3_options, path):
+    """Return the stats tuple of an object, from the table if still valid,
+    otherwise with a HEAD request.
+    """
+    key = (pool_key(s3_options), _normalize(path))
+    info = _get_cached(key)
+    if info is None:
+        info = fs.info(path, refresh=True)
+        _put(key, info)
+    return stats_from_info(info)
+
+
+async def aget_s3_stats(fs, s3_options, path):
+    """Same as get_s3_stats(), for an asynchronous filesystem."""
+    key = (pool_key(s3_options), _normalize(path))
+    info = _get_cached(key)
+    if info is None:
+        info = await fs._info(path, refresh=True)
+        _put(key, info)
+    return stats_from_info(info)
+
+
+def _group_unvalidated(files):
+    """Group the files that are not already valid by their options and directory.
+    Returns a dict mapping (options key, prefix) to (s3_options, paths).
+    """
+    groups = {}
+    for f in files:
+        key = (pool_key(f.s3_options), _normalize(f.path))
+        if _get_cached(key) is not None:
+            continue
+        group_key = (key[0], posixpath.dirname(key[1]))
+        groups.setdefault(group_key, (f.s3_options, set()))[1].add(key[1])
+    return groups
+
+
+def _record_group(options_key, paths, infos):
+    for info in infos:
+        if info['name'] in paths:
+            _put((options_key, info['name']), info)
+
+
+def validate_s3_files(files):
+    """Fill in the stats of many S3File objects. The files are grouped by their
+    directory (prefix) and, for each group of two or more files that are not
+    already valid, we list the prefix once. Files not found in the listing are
+    left for a HEAD request when they are used.
+    """
+    for ((options_key, prefix), (s3_options, paths)) in _group_unvalidated(files).items():
+        if len(paths)<2:
+            continue
+        fs = get_s3_filesystem(**s3_options)
+        _record_group(options_key, paths, list_s3_prefix(fs, prefix))
+
+
+async def avalidate_s3_files(files):
+    """Same as validate_s3_files(), using the asynchronous filesystems. The
+    listings, and the HEAD requests for files on their own, run concurrently,
+    so that hashing the files afterwards (within the same scope) makes no requests.
+    """
+    async def validate_group(options_key, prefix, s3_options, paths):
+        fs = await get_async_s3_filesystem(**s3_options)
+        if len(paths)>=2:
+            infos = await fs._ls(prefix, detail=True, refresh=True)
+            _record_group(options_key, paths, [i for i in infos if i.get('type')=='file'])
+        for path in paths:
+            await aget_s3_stats(fs, s3_options, path)
+    await asyncio.gather(*[validate_group(options_key, prefix, s3_options, paths)
+                           for ((options_key, prefix), (s3_options, paths))
+                           in _group_unvalidated(files).items()])
+
+
+def list_s3_prefix(fs, prefix, recursive=False):
+    """Return the info dicts for the objects directly under the prefix, or all the
+    objects under it if recursive. This is a single (paginated) listing.
+    """
+    if recursive:
+        fs.invalidate_cache(prefix)
+        infos = fs.find(prefix, detail=True).values()
+    else:
+        infos = fs.ls(prefix, detail=True, refresh=True)
+    return [info for info in infos if info.get('type')=='file']
+
+
+def record_listing(s3_options, infos):
+    """Record the stats from a listing (e.g. from list_s3_prefix())."""
+    options_key = pool_key(s3_options)
+    for info in infos:
+        _put((options_key, info['name']), info)
+
+
+@contextmanager
+def s3_validation_scope():
+    """Within this context, each object is checked at most once, in this thread
+    (or asyncio task).
+    """
+    if _validated.get() is not None:
+        yield # nested: the outermost scope applies
+        return
+    token = _validated.set(set())
+    try:
+        yield
+    finally:
+        _validated.reset(token)
@@ -0,0 +1,150 @@
+"""Serialization of cache entries.
+
+The standard joblib layout pickles everything in-band, so each array buffer is
+copied into the pickle stream when writing and copied back out when reading.
+Here, we use pickle protocol 5 instead: large contiguous buffers (numpy arrays,
+and thus the blocks of pandas DataFrames) are written as separate, aligned sections
+of the file after a small metadata pickle. When loading, each section is read
+directly into a newly allocated buffer with readinto(), or memory-mapped if the
+file is not encrypted. The unpickler then builds the arrays on top of these
+buffers without any further copies.
+
+The file layout is:
+
+  magic (8 bytes)
+  length of the metadata pickle, number of buffers (two unsigned 64-bit ints)
+  for each buffer, its offset and length (two unsigned 64-bit ints)
+  metadata pickle
+  buffers, each starting at a multiple of ALIGNMENT bytes
+"""
+# Copyright 2021 Benedat LLC
+# Apache 2.0 license
+
+import mmap
+import pickle
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+OOB_MAGIC=b'CMLOOB\x00\x01'
+ALIGNMENT=64
+# buffers smaller than this stay in the metadata pickle
+MIN_OOB_SIZE=4096
+
+_COUNTS=struct.Struct('<QQ')
+_ENTRY=struct.Struct('<QQ')
+
+# mmap_mode => (mode to open the file, mmap access)
+_MMAP_ACCESS = {
+    'r':('rb', mmap.ACCESS_READ),
+    'c':('rb', mmap.ACCESS_COPY),
+    'r+':('r+b', mmap.ACCESS_WRITE),
+    'w+':('r+b', mmap.ACCESS_WRITE)
+}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+
+def is_oob_file(fileobj):
+    """Return True if the file object is positioned at the start of an entry in our
+    layout. The file object must support peek(), which the buffered file objects
+    from open() and encrypted_file_open() do.
+    """
+    return fileobj.peek(len(OOB_MAGIC))[0:len(OOB_MAGIC)]==OOB_MAGIC
+
+
+def dump_oob(obj, fileobj):
+    """Pickle obj to fileobj, writing the large buffers out-of-band."""
+    buffers = []
+    def buffer_callback(buf):
+        raw = buf.raw()
+        if raw.nbytes<MIN_OOB_SIZE:
+            return True # serialize in-band
+        buffers.append(raw)
+        return False
+    metadata = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+    header_len = len(OOB_MAGIC) + _COUNTS.size + len(buffers)*_ENTRY.size
+    offset = header_len + len(metadata)
+    entries = []
+    for buf in buffers:
+        offset = _align(offset)
+        entries.append((offset, buf.nbytes))
+        offset += buf.nbytes
+    fileobj.write(OOB_MAGIC)
+    fileobj.write(_COUNTS.pack(len(metadata), len(buffers)))
+    for entry in entries:
+        fileobj.write(_ENTRY.pack(*entry))
+    fileobj.write(metadata)
+    position = header_len + len(metadata)
+    for (buf, (offset, length)) in zip(buffers, entries):
+        fileobj.write(bytes(offset-position))
+        fileobj.write(buf)
+        position = offset + length
+
+
+def _allocate(length):
+    """Allocate an uninitialized buffer. bytearray() would zero the memory first,
+    which is wasted work since we are about to read into it.
+    """
+    if np is not None:
+        return np.empty(length, dtype=np.uint8)
+    else:
+        return bytearray(length)
+
+
+def _read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data)!=size:
+        raise ValueError(f"Cache entry is truncated (expecting {size} bytes, got {len(data)})")
+    return data
+
+
+def _read_header(fileobj):
+    magic = _read_exactly(fileobj, len(OOB_MAGIC))
+    if magic!=OOB_MAGIC:
+        raise ValueError("Cache entry does not have the out-of-band layout")
+    (metadata_len, num_buffers) = _COUNTS.unpack(_read_exactly(fileobj, _COUNTS.size))
+    table = _read_exactly(fileobj, num_buffers*_ENTRY.size)
+    entries = [_ENTRY.unpack_from(table, i*_ENTRY.size) for i in range(num_buffers)]
+    metadata = _read_exactly(fileobj, metadata_len)
+    return (entries, metadata)
+
+
+def load_oob(fileobj):
+    """Load an entry from a file object, reading each buffer directly into its
+    final location.
+    """
+    (entries, metadata) = _read_header(fileobj)
+    buffers = []
+    for (offset, length) in entries:
+        fileobj.seek(offset)
+        buf = _allocate(length)
+        if fileobj.readinto(buf)!=length:
+            raise ValueError(f"Cache entry is truncated (buffer at offset {offset})")
+        buffers.append(buf)
+    return pickle.loads(metadata, buffers=buffers)
+
+
+def load_oob_mmap(filename, mmap_mode='r'):
+    """Load an (unencrypted) entry, memory-mapping the buffers. The mmap_mode
+    values are the same as numpy.memmap. With 'r', the resulting arrays are read-only.
+    With 'c', they can be modified in memory only, and with 'r+', changes are written
+    to the file. As in joblib, 'w+' is the same as 'r+', rather than overwriting the
+    entry.
+    """
+    if mmap_mode not in _MMAP_ACCESS:
+        raise ValueError(f"Invalid mmap_mode {mmap_mode!r}, should be one of {list(_MMAP_ACCESS)}")
+    (file_mode, access) = _MMAP_ACCESS[mmap_mode]
+    with open(filename, file_mode) as f:
+        (entries, metadata) = _read_header(f)
+        if len(entries)==0:
+            return pickle.loads(metadata)
+        # the map stays open as long as the arrays reference it
+        mapped = mmap.mmap(f.fileno(), 0, access=access)
+    view = memoryview(mapped)
+    return pickle.loads(metadata, buffers=[view[offset:offset+length] for (offset, length) in entries])
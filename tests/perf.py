@@ -1,100 +1,291 @@
-"""Profiling
-and performance testing
+"""Benchmarks of the cache on synthetic data.
+
+Measures:
+  * cache_miss / cache_hit: a cached function returning a dataframe or an array,
+    with a cleartext and an encrypted cache (the miss includes writing the entry,
+    the hit includes loading it)
+  * file_read: reading a file of the same size with the plain file object, and
+    decrypting it with EncryptedReader (FORMAT_CTR) and FORMAT_GCM, for several
+    buffer sizes
+  * s3_input: a cached function reading a CSV file from S3, against a local moto
+    server (skipped if moto is not installed)
+
+Each benchmark is run --repeat times and we report the best, median and mean times
+and the throughput. Use --output to save the results as JSON, along with the commit
+and the machine, and --compare to compare them with the results saved for another
+commit. With --compare, we exit with status 1 if any benchmark got slower than
+--threshold (on its median time), so this can run in CI.
 """
 import sys
 import os
 from os.path import join
-import pickle
+import time
+import json
+import argparse
+import fnmatch
+import platform
+import statistics
+import subprocess
 
+import numpy as np
 import pandas as pd
-import joblib
 
 from utils_for_tests import *
 sys.path.append(get_module_path())
-from cacheml.crypto import *
-
-KEY=get_new_key()
-
-def my_read_csv(file_path, usecols=[0,2,3,6,7,8]):
-    print("loading csv file")
-    return pd.read_csv(file_path, header=0, usecols=usecols,
-                       converters={'commit_author_date':pd.to_datetime})
-
-def pickle_df(df):
-    with encrypted_file_open(join(TEMPDIR, 'data.pkl'), 'wb', KEY) as f:
-        pickle.dump(df, f)
-
-def unpickle_df():
-    with encrypted_file_open(join(TEMPDIR, 'data.pkl'), 'rb', KEY) as f:
-        return pickle.load(f)
-
-def jl_dump_df(df):
-    with encrypted_file_open(join(TEMPDIR, 'data.pkl'), 'wb', KEY) as f:
-        joblib.dump(df, f)
-
-def jl_load_df():
-    with encrypted_file_open(join(TEMPDIR, 'data.pkl'), 'rb', KEY) as f:
-        return joblib.load(f)
-
-def jl_cleartext_dump_df(df):
-    with open(join(TEMPDIR, 'data.pkl'), 'wb') as f:
-        joblib.dump(df, f)
-
-def jl_cleartext_load_df():
-    with open(join(TEMPDIR, 'data.pkl'), 'rb') as f:
-        return joblib.load(f)
-
-def run_encrypted_pickle():
-    t1 = time.time()
-    df = my_read_csv(get_local_data_file())
-    print(f"Read csv in {fmt_time(t1)}")
-    t2 = time.time()
-    pickle_df(df)
-    print(f"Pickle in {fmt_time(t2)}")
-    t3 = time.time()
-    df2 = unpickle_df()
-    print(f"Unpickle in {fmt_time(t3)}")
-    assert df2.equals(df)
-    print(f"data frame has {len(df2.columns)} and {len(df2)} rows")
-
-def run_encrypted_joblib_dl():
-    t1 = time.time()
-    df = my_read_csv(get_local_data_file())
-    print(f"Read csv in {fmt_time(t1)}")
-    t2 = time.time()
-    jl_dump_df(df)
-    print(f"Dump in {fmt_time(t2)}")
-    t3 = time.time()
-    df2 = jl_load_df()
-    print(f"Load in {fmt_time(t3)}")
-    assert df2.equals(df)
-    print(f"data frame has {len(df2.columns)} and {len(df2)} rows")
-
-def run_joblib_dl():
-    t1 = time.time()
-    df = my_read_csv(get_local_data_file())
-    print(f"Read csv in {fmt_time(t1)}")
-    t2 = time.time()
-    jl_cleartext_dump_df(df)
-    print(f"Dump in {fmt_time(t2)}")
-    t3 = time.time()
-    df2 = jl_cleartext_load_df()
-    print(f"Load in {fmt_time(t3)}")
-    assert df2.equals(df)
-    print(f"data frame has {len(df2.columns)} and {len(df2)} rows")
-
-
-def main(argv=sys.argv):
+from cacheml.crypto import get_new_key, encrypted_file_open, FORMAT_CTR, FORMAT_GCM
+from cacheml.cache import Cache, S3File
+
+try:
+    from moto.server import ThreadedMotoServer
+    import boto3
+    HAVE_MOTO=True
+except ImportError:
+    HAVE_MOTO=False
+
+MB=1024*1024
+BUFFER_SIZES=[64*1024, 256*1024, MB, 4*MB]
+DTYPES=['int', 'float', 'str', 'datetime', 'category', 'bool']
+S3_PORT=5128
+S3_BUCKET='cacheml-benchmark'
+
+# the datasets returned by the cached functions, by name
+DATASETS = {}
+
+
+def make_dataframe(rows, dtypes, seed=42):
+    """A synthetic dataframe with one column for each of dtypes (see DTYPES)"""
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for (i, dtype) in enumerate(dtypes):
+        name = f'{dtype}{i}'
+        if dtype=='int':
+            columns[name] = rng.integers(0, 1000000, rows)
+        elif dtype=='float':
+            columns[name] = rng.random(rows)
+        elif dtype=='str':
+            columns[name] = [f'org{j%500}/repo{j%5000}' for j in rng.integers(0, 100000, rows)]
+        elif dtype=='datetime':
+            columns[name] = pd.date_range('2015-01-01', periods=rows, freq='s', tz='UTC')
+        elif dtype=='category':
+            columns[name] = pd.Categorical.from_codes(rng.integers(0, 20, rows),
+                                                      [f'cat{j}' for j in range(20)])
+        elif dtype=='bool':
+            columns[name] = rng.random(rows)<0.5
+        else:
+            raise ValueError(f"Unknown dtype {dtype}, should be one of {', '.join(DTYPES)}")
+    return pd.DataFrame(columns)
+
+
+def make_array(size_in_mb, seed=42):
+    rng = np.random.default_rng(seed)
+    return rng.random(int(size_in_mb*MB)//8)
+
+
+def nbytes(data):
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(deep=True).sum())
+    return data.nbytes
+
+
+def get_dataset(name, version):
+    """The cached function: version is changed to force a miss"""
+    return DATASETS[name]
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=get_module_path(),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Runner:
+    def __init__(self, repeat, only):
+        self.repeat = repeat
+        self.only = only
+        self.results = []
+
+    def selected(self, name):
+        return self.only is None or any(fnmatch.fnmatch(name, pattern) for pattern in self.only)
+
+    def run(self, name, func, size, setup=None):
+        """Time func() repeat times (calling setup() before each, untimed) and
+        record the result. size is the number of bytes moved by each call.
+        """
+        if not self.selected(name):
+            return
+        times = []
+        for i in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter()-start)
+        result = {'name':name, 'bytes':size, 'times':times, 'min':min(times),
+                  'median':statistics.median(times), 'mean':statistics.mean(times),
+                  'stdev':statistics.stdev(times) if len(times)>1 else 0.0,
+                  'mb_per_s':size/MB/statistics.median(times) if size else None}
+        self.results.append(result)
+        print(f"{name:<40} {result['min']:9.4f} {result['median']:9.4f} {result['mean']:9.4f} " +
+              (f"{result['mb_per_s']:9.1f}" if size else f"{'-':>9}"))
+
+
+def bench_cache(runner, args):
+    write_cache_config()
+    write_cache_credentials(get_new_key())
+    DATASETS['dataframe'] = make_dataframe(args.rows, args.dtypes.split(','))
+    DATASETS['array'] = make_array(args.array_mb)
+    for (mode, key_name) in [('cleartext', None), ('encrypted', 'default')]:
+        cache = Cache(encryption_key_name=key_name, verbose=0, _config_base_dir=TEMPDIR)
+        cached = cache.cache(get_dataset)
+        for (name, data) in DATASETS.items():
+            size = nbytes(data)
+            version = [0]
+            def miss():
+                cached(name, version[0])
+                cache.flush()
+            def next_version():
+                version[0] += 1
+            runner.run(f'cache_miss[{mode}-{name}]', miss, size, setup=next_version)
+            runner.run(f'cache_hit[{mode}-{name}]', lambda: cached(name, version[0]), size)
+        cache.clear(warn=False)
+
+
+def bench_file_read(runner, args):
+    data = os.urandom(int(args.array_mb*MB))
+    key = get_new_key()
+    filenames = {'plain':join(TEMPDIR, 'plain.pkl'), 'ctr':join(TEMPDIR, 'ctr.pkl'),
+                 'gcm':join(TEMPDIR, 'gcm.pkl')}
+    with open(filenames['plain'], 'wb') as f:
+        f.write(data)
+    for (file_format, filename) in [(FORMAT_CTR, filenames['ctr']), (FORMAT_GCM, filenames['gcm'])]:
+        with encrypted_file_open(filename, 'wb', key, file_format=file_format) as f:
+            f.write(data)
+    for buf_size in BUFFER_SIZES:
+        def read_plain():
+            with open(filenames['plain'], 'rb', buffering=buf_size) as f:
+                while f.read(buf_size):
+                    pass
+        def read_encrypted(filename):
+            with encrypted_file_open(filename, 'rb', key, buf_size=buf_size) as f:
+                while f.read(buf_size):
+                    pass
+        runner.run(f'file_read[plain-{buf_size//1024}k]', read_plain, len(data))
+        for name in ['ctr', 'gcm']:
+            runner.run(f'file_read[{name}-{buf_size//1024}k]',
+                       lambda: read_encrypted(filenames[name]), len(data))
+
+
+def read_s3_csv(s3_file):
+    with s3_file.open('rb') as f:
+        return pd.read_csv(f)
+
+
+def bench_s3_input(runner, args):
+    if not HAVE_MOTO:
+        print("Skipping the s3_input benchmarks, moto is not installed")
+        return
+    if not runner.selected('s3_input[miss]') and not runner.selected('s3_input[hit]'):
+        return
+    server = ThreadedMotoServer(port=S3_PORT, verbose=False)
+    server.start()
+    saved_env = {k:os.environ.get(k) for k in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']}
+    os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+    try:
+        endpoint = f'http://127.0.0.1:{S3_PORT}'
+        s3 = boto3.client('s3', endpoint_url=endpoint, region_name='us-east-1')
+        s3.create_bucket(Bucket=S3_BUCKET)
+        body = make_dataframe(args.rows, args.dtypes.split(',')).to_csv(index=False).encode('utf-8')
+        s3.put_object(Bucket=S3_BUCKET, Key='data.csv', Body=body)
+        s3_file = S3File(f's3://{S3_BUCKET}/data.csv', endpoint_url=endpoint)
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        cached = cache.cache(read_s3_csv)
+        def miss():
+            cached(s3_file)
+            cache.flush()
+        runner.run('s3_input[miss]', miss, len(body), setup=lambda: cache.clear(warn=False))
+        runner.run('s3_input[hit]', lambda: cached(s3_file), len(body))
+        cache.clear(warn=False)
+    finally:
+        server.stop()
+        for (k, v) in saved_env.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+
+def compare(results, params, old_file, threshold):
+    """Print the change in median times from the results in old_file. Returns
+    the number of benchmarks that are slower by more than threshold.
+    """
+    with open(old_file, 'r') as f:
+        old = json.load(f)
+    old_by_name = {r['name']:r for r in old['benchmarks']}
+    print(f"\nCompared with {old.get('commit')} ({old_file}):")
+    print(f"{'benchmark':<40} {'old':>9} {'new':>9} {'ratio':>7}")
+    regressions = 0
+    for r in results:
+        if r['name'] not in old_by_name:
+            continue
+        ratio = r['median']/old_by_name[r['name']]['median']
+        slower = ratio>threshold
+        regressions += slower
+        print(f"{r['name']:<40} {old_by_name[r['name']]['median']:9.4f} {r['median']:9.4f} {ratio:7.2f}" +
+              (" SLOWER" if slower else ''))
+    if old.get('params')!=params:
+        print("Warning: the benchmarks were run with different parameters")
+    return regressions
+
+
+BENCHMARKS = [bench_cache, bench_file_read, bench_s3_input]
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help="Rows in the synthetic dataframe (default %(default)s)")
+    parser.add_argument('--dtypes', default='int,float,str,datetime,category',
+                        help=f"Comma-separated column types of the dataframe, from {', '.join(DTYPES)} " +
+                             "(default %(default)s)")
+    parser.add_argument('--array-mb', type=float, default=64,
+                        help="Size of the synthetic array and files in MB (default %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of runs of each benchmark (default %(default)s)")
+    parser.add_argument('--only', action='append', default=None,
+                        help="Only run the benchmarks matching this pattern, e.g. 'cache_hit*' " +
+                             "(can be repeated)")
+    parser.add_argument('--output', default=None,
+                        help="Save the results to this JSON file")
+    parser.add_argument('--compare', default=None,
+                        help="Compare with the results saved in this JSON file")
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help="With --compare, ratio of the median times above which a " +
+                             "benchmark is a regression (default %(default)s)")
+    args = parser.parse_args(argv)
+    # the parameters of the benchmarks, to check that results are comparable
+    params = {k:v for (k, v) in vars(args).items() if k not in ('output', 'compare', 'threshold', 'only')}
+    runner = Runner(args.repeat, args.only)
     clear_tempdir()
     os.mkdir(TEMPDIR)
     try:
-        #run_encrypted_pickle()
-        run_encrypted_joblib_dl()
-        return 0
+        print(f"{'benchmark':<40} {'min s':>9} {'median s':>9} {'mean s':>9} {'MB/s':>9}")
+        for benchmark in BENCHMARKS:
+            benchmark(runner, args)
     finally:
         clear_tempdir()
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'commit':get_commit(), 'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'machine':{'platform':platform.platform(), 'python':platform.python_version(),
+                                  'cpus':os.cpu_count()},
+                       'params':params, 'benchmarks':runner.results}, f, indent=2)
+    if args.compare is not None and compare(runner.results, params, args.compare, args.threshold)>0:
+        return 1
+    return 0
 
 
 if __name__=='__main__':
     sys.exit(main())
-
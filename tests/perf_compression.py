@@ -0,0 +1,98 @@
+"""Compare the compression codecs for cache entries: entry size versus load time.
+
+The load time is measured from the local disk. For cache volumes on network
+storage, pass the bandwidth of the volume (in MB/s) with --bandwidth and we
+also estimate the load time including the transfer of the entry.
+
+Uses the commits data file if it is present, otherwise a synthetic dataframe.
+"""
+import sys
+import os
+from os.path import join, exists, getsize
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key
+from cacheml.compression import available_codecs, DEFAULT_LEVELS
+from cacheml.cache import CacheMLStoreBackend, EncryptedStoreBackend, LAYOUT_OOB, DATAFRAME_ARROW
+
+def get_dataframe(rows):
+    if exists(get_local_data_file()):
+        return pd.read_csv(get_local_data_file(), header=0, usecols=[0,2,3,6,7,8],
+                           converters={'commit_author_date':pd.to_datetime})
+    rng = np.random.default_rng(42)
+    return pd.DataFrame({
+        'repo':[f'org{i%500}/repo{i%5000}' for i in range(rows)],
+        'commit_author_date':pd.date_range('2015-01-01', periods=rows, freq='min', tz='UTC'),
+        'additions':rng.poisson(20, rows),
+        'deletions':rng.poisson(10, rows),
+        'score':rng.random(rows)
+    })
+
+def make_codec_backend(key, dataframe_format, codec, level):
+    options = {'layout':LAYOUT_OOB, 'dataframe_format':dataframe_format,
+               'compression':codec, 'compression_level':level}
+    if key is None:
+        return make_backend(CacheMLStoreBackend, **options)
+    return make_backend(EncryptedStoreBackend, key=key, **options)
+
+def run(df, key, dataframe_format, bandwidth, repeat):
+    configs = [(None, None)] + \
+              [(codec, level) for codec in available_codecs()
+               for level in sorted({1, DEFAULT_LEVELS[codec]})]
+    print(f"{'codec':>6} {'level':>5} {'size MB':>9} {'ratio':>6} {'dump s':>7} {'load s':>7}" +
+          (f" {'net load s':>10}" if bandwidth else ''))
+    base_size = None
+    for (codec, level) in configs:
+        backend = make_codec_backend(key, dataframe_format, codec, level)
+        path = ['perf', f'{codec}-{level}']
+        t1 = time.time()
+        backend.dump_item(path, df, verbose=0)
+        dump_time = time.time() - t1
+        size = getsize(join(TEMPDIR, 'joblib', *path, 'output.pkl'))
+        if base_size is None:
+            base_size = size
+        load_time = None
+        for i in range(repeat):
+            t2 = time.time()
+            df2 = backend.load_item(path, verbose=0)
+            load_time = min(load_time, time.time()-t2) if load_time is not None else time.time()-t2
+        assert df2.equals(df)
+        line = f"{str(codec):>6} {str(level):>5} {size/1e6:9.1f} {base_size/size:6.2f} " + \
+               f"{dump_time:7.2f} {load_time:7.2f}"
+        if bandwidth:
+            line += f" {load_time + size/(bandwidth*1e6):10.2f}"
+        print(line)
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=2000000,
+                        help="Rows in the synthetic dataframe (default %(default)s)")
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help="Bandwidth of the cache volume in MB/s, to estimate network load times")
+    parser.add_argument('--cleartext', action='store_true', default=False,
+                        help="Use an unencrypted cache")
+    parser.add_argument('--pickle', action='store_true', default=False,
+                        help="Store the dataframe in the pickle layout rather than as Arrow")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of loads for each codec, we report the best (default %(default)s)")
+    args = parser.parse_args(argv)
+    clear_tempdir()
+    os.mkdir(TEMPDIR)
+    try:
+        df = get_dataframe(args.rows)
+        print(f"Data frame has {len(df.columns)} columns and {len(df)} rows")
+        run(df, None if args.cleartext else get_new_key(),
+            'pickle' if args.pickle else DATAFRAME_ARROW, args.bandwidth, args.repeat)
+        return 0
+    finally:
+        clear_tempdir()
+
+
+if __name__=='__main__':
+    sys.exit(main())
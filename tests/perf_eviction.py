@@ -0,0 +1,109 @@
+"""Compare the eviction policies by replaying a workload against a size-limited cache.
+
+Each request in the workload is for an entry with a size and a compute time. A
+request for an entry in the cache is a hit and saves its compute time. Otherwise,
+the entry is computed and written, and if it was evicted earlier, its compute time
+is recomputation that a larger cache would have saved. The replay uses the manifest
+and the eviction code of the store backend, but no entry files are written.
+
+The default workload is synthetic: a few large results that are expensive to compute
+and many small cheap ones, requested with Zipf-distributed popularity. To replay your
+own workload, pass --trace with a CSV file that has the key, size (bytes) and
+duration (seconds) of each request, in order. These can be taken from the manifest of
+an existing cache, see manifest.py.
+"""
+import sys
+import os
+from os.path import join
+import time
+import argparse
+import csv
+
+import numpy as np
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.manifest import Manifest
+from cacheml.eviction import POLICIES, get_policy, entries_to_evict, EVICTION_SLACK
+
+def synthetic_trace(num_entries, num_requests, seed):
+    """Return a list of (key, size, duration) requests."""
+    rng = np.random.default_rng(seed)
+    # 5% are large (100-500MB) and take minutes, the rest are small (1-20MB) and take seconds
+    large = rng.random(num_entries) < 0.05
+    sizes = np.where(large, rng.uniform(100e6, 500e6, num_entries), rng.uniform(1e6, 20e6, num_entries))
+    durations = np.where(large, rng.uniform(60, 1800, num_entries), rng.uniform(0.5, 10, num_entries))
+    popularity = 1.0/np.arange(1, num_entries+1)**0.8
+    keys = rng.choice(rng.permutation(num_entries), size=num_requests, p=popularity/popularity.sum())
+    return [(f'{k:032x}', int(sizes[k]), float(durations[k])) for k in keys]
+
+def read_trace(filename):
+    with open(filename, 'r', newline='') as f:
+        return [(row['key'], int(row['size']), float(row['duration'])) for row in csv.DictReader(f)]
+
+def replay(trace, policy_name, bytes_limit):
+    """Return (hits, misses, seconds saved by hits, seconds recomputed after eviction)."""
+    manifest = Manifest(join(TEMPDIR, f'{policy_name}.manifest.db'))
+    policy = get_policy(policy_name)
+    cached = set()
+    seen = set()
+    (hits, misses, saved, recomputed) = (0, 0, 0.0, 0.0)
+    for (key, size, duration) in trace:
+        path = join('func', key)
+        if path in cached:
+            manifest.record_hit(path)
+            hits += 1
+            saved += duration
+            continue
+        misses += 1
+        if path in seen:
+            recomputed += duration
+        seen.add(path)
+        cached.add(path)
+        manifest.record_entry(path, size, duration)
+        # as in CacheMLStoreBackend._evict_after_write()
+        if manifest.total_size()>bytes_limit:
+            for e in entries_to_evict(manifest, policy, int(bytes_limit*(1-EVICTION_SLACK)), keep=path):
+                manifest.remove(e['path'])
+                cached.discard(e['path'])
+    manifest.close()
+    return (hits, misses, saved, recomputed)
+
+def run(trace, bytes_limit):
+    total_size = sum({key:size for (key, size, _) in trace}.values())
+    print(f"{len(trace)} requests for {len(set(key for (key, _, _) in trace))} entries, " +
+          f"{total_size/1e9:.1f} GB in total, cache limit {bytes_limit/1e9:.1f} GB")
+    print(f"{'policy':>6} {'hits':>7} {'misses':>7} {'hit ratio':>9} {'saved h':>8} " +
+          f"{'recomputed h':>12} {'replay s':>8}")
+    for name in POLICIES:
+        t1 = time.time()
+        (hits, misses, saved, recomputed) = replay(trace, name, bytes_limit)
+        print(f"{name:>6} {hits:7d} {misses:7d} {hits/len(trace):9.3f} {saved/3600:8.1f} " +
+              f"{recomputed/3600:12.1f} {time.time()-t1:8.1f}")
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--trace', default=None,
+                        help="CSV file with the key, size and duration of each request")
+    parser.add_argument('--entries', type=int, default=2000,
+                        help="Entries in the synthetic workload (default %(default)s)")
+    parser.add_argument('--requests', type=int, default=20000,
+                        help="Requests in the synthetic workload (default %(default)s)")
+    parser.add_argument('--seed', type=int, default=42,
+                        help="Random seed for the synthetic workload (default %(default)s)")
+    parser.add_argument('--limit-in-mb', type=int, default=10000,
+                        help="Size limit of the cache (default %(default)s)")
+    args = parser.parse_args(argv)
+    clear_tempdir()
+    os.mkdir(TEMPDIR)
+    try:
+        trace = read_trace(args.trace) if args.trace is not None \
+                else synthetic_trace(args.entries, args.requests, args.seed)
+        run(trace, 1024*1024*args.limit_in_mb)
+        return 0
+    finally:
+        clear_tempdir()
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Tests for incremental caching of append-only files."""
+import sys
+import os
+from os.path import join
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.appends import append_results
+from cacheml.cache import LocalFile, Cache
+
+DEBUG=False
+
+
+class TestAppends(unittest.TestCase):
+    def setUp(self):
+        init_test_cache()
+        self.cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        self.log_file = join(TEMPDIR, 'events.csv')
+        with open(self.log_file, 'w') as f:
+            f.write('event,value\n')
+            for i in range(100):
+                f.write(f'e{i},{i}\n')
+        self.parsed_rows = []
+        @self.cache.cache_appends
+        def parse(f, scale=1):
+            df = pd.read_csv(f.path)
+            self.parsed_rows.append(len(df))
+            df['value'] *= scale
+            return df
+        self.parse = parse
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def _append(self, lines):
+        with open(self.log_file, 'a') as f:
+            f.write(lines)
+
+    def test_append(self):
+        self.assertTrue(self.parse(LocalFile(self.log_file)).equals(pd.read_csv(self.log_file)))
+        self.assertTrue(self.parse(LocalFile(self.log_file)).equals(pd.read_csv(self.log_file)))
+        self.assertEqual(self.parsed_rows, [100])
+        # only the new lines are parsed, including the header
+        self._append('e100,100\ne101,101\n')
+        result = self.parse(LocalFile(self.log_file))
+        self.assertEqual(self.parsed_rows, [100, 2])
+        self.assertTrue(result.equals(pd.read_csv(self.log_file)))
+        # an incomplete line is left for later
+        self._append('e102,102\ne10')
+        self.assertEqual(len(self.parse(LocalFile(self.log_file))), 103)
+        self.assertEqual(self.parse(LocalFile(self.log_file)).iloc[-1]['event'], 'e102')
+        self._append('3,103\n')
+        result = self.parse(LocalFile(self.log_file))
+        self.assertEqual(self.parsed_rows, [100, 2, 1, 1])
+        self.assertTrue(result.equals(pd.read_csv(self.log_file)))
+        # other arguments are part of the key
+        self.assertEqual(self.parse(LocalFile(self.log_file), scale=2)['value'].sum(),
+                         2*result['value'].sum())
+        self.assertEqual(self.parsed_rows, [100, 2, 1, 1, 104])
+
+    def test_rewrite(self):
+        self.parse(LocalFile(self.log_file))
+        # same size, different prefix
+        with open(self.log_file, 'r+') as f:
+            f.seek(len('event,value\n'))
+            f.write('x0')
+        self._append('e100,100\n')
+        result = self.parse(LocalFile(self.log_file))
+        self.assertEqual(self.parsed_rows, [100, 101])
+        self.assertEqual(result.iloc[0]['event'], 'x0')
+        # truncated
+        with open(self.log_file, 'w') as f:
+            f.write('event,value\ne0,0\n')
+        self.assertEqual(len(self.parse(LocalFile(self.log_file))), 1)
+        self.assertEqual(self.parsed_rows, [100, 101, 1])
+
+    def test_background_persistence(self):
+        write_cache_config(cache_dir=join(TEMPDIR, 'cache2'), persist_in_background=True)
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        parse = cache.cache_appends(self.parse.func)
+        parse(LocalFile(self.log_file))
+        cache.flush()
+        # the write of the updated result fails, e.g. the process dies first
+        backend = cache.store_backend
+        write_item = backend._write_item
+        backend._write_item = lambda path, item, verbose: False
+        self._append('e100,100\ne101,101\n')
+        self.assertEqual(len(parse(LocalFile(self.log_file))), 102)
+        cache.flush()
+        backend._write_item = write_item
+        # the metadata still describes the stored result, so no rows are lost
+        result = parse(LocalFile(self.log_file))
+        self.assertTrue(result.equals(pd.read_csv(self.log_file)))
+        self.assertEqual(self.parsed_rows, [100, 2, 2])
+        # a pending update is seen by the next call
+        self._append('e102,102\n')
+        parse(LocalFile(self.log_file))
+        self.assertTrue(parse(LocalFile(self.log_file)).equals(pd.read_csv(self.log_file)))
+        self.assertEqual(self.parsed_rows, [100, 2, 2, 1])
+
+    def test_append_results(self):
+        self.assertEqual(append_results([1, 2], [3]), [1, 2, 3])
+        df = append_results(pd.DataFrame({'a':[1, 2]}, index=[5, 6]), pd.DataFrame({'a':[3]}))
+        self.assertEqual(list(df.index), [5, 6, 0])
+        self.assertTrue(np.array_equal(append_results(np.arange(2), np.arange(1)),
+                                       np.array([0, 1, 0])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Tests for caching coroutine functions and async S3 access."""
+import sys
+import os
+from os.path import join
+import unittest
+import asyncio
+import threading
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key
+from cacheml.s3_pool import get_s3_filesystem, clear_s3_filesystems, close_async_s3_filesystems
+from cacheml.s3_stats import clear_s3_stats
+from cacheml.local_stats import _stat_memo
+from cacheml.cache import S3File, LocalFile, Cache
+
+DEBUG=False
+BUCKET='cacheml-async-test'
+PORT=5127
+ENDPOINT=f'http://127.0.0.1:{PORT}'
+
+
+def make_cache():
+    write_cache_config()
+    write_cache_credentials(get_new_key())
+    return Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+
+
+class TestAsyncCache(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.cache = make_cache()
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_acache(self):
+        calls = []
+        @self.cache.acache
+        async def make_frame(rows):
+            calls.append(rows)
+            await asyncio.sleep(0.01)
+            return pd.DataFrame({'a':np.arange(rows)})
+        async def run():
+            first = await asyncio.gather(*[make_frame(rows) for rows in [10, 20, 30]])
+            second = await asyncio.gather(*[make_frame(rows) for rows in [10, 20, 30]])
+            return (first, second)
+        (first, second) = asyncio.run(run())
+        self.assertEqual(sorted(calls), [10, 20, 30])
+        for (a, b) in zip(first, second):
+            self.assertTrue(a.equals(b))
+        # the entries are shared with the synchronous wrapper
+        self.assertTrue(self.cache.cache(make_frame.func).store_backend.contains_item(
+            self.cache.cache(make_frame.func)._get_output_identifiers(10)))
+        self.assertEqual(make_frame.__name__, 'make_frame')
+
+    def test_hashing_off_the_loop(self):
+        data_file = join(TEMPDIR, 'data.txt')
+        with open(data_file, 'w') as f:
+            f.write('10\n')
+        @self.cache.acache
+        async def read_number(f):
+            with f.open('r') as fp:
+                return int(fp.read())
+        get_output_identifiers = read_number.cached_func._get_output_identifiers
+        hashing = []
+        def record(*args, **kwargs):
+            hashing.append((threading.get_ident(), _stat_memo.get() is not None))
+            return get_output_identifiers(*args, **kwargs)
+        read_number.cached_func._get_output_identifiers = record
+        async def run():
+            return (threading.get_ident(), await read_number(LocalFile(data_file)),
+                    await read_number(LocalFile(data_file)))
+        (loop_thread, first, second) = asyncio.run(run())
+        self.assertEqual((first, second), (10, 10))
+        self.assertEqual(len(hashing), 2)
+        for (thread, in_scope) in hashing:
+            self.assertNotEqual(thread, loop_thread)
+            self.assertTrue(in_scope)
+
+    def test_not_coroutine(self):
+        with self.assertRaises(TypeError):
+            self.cache.acache(lambda x: x)
+
+
+class TestAsyncS3(MotoTestCase):
+    port = PORT
+    bucket = BUCKET
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        for i in range(5):
+            cls.s3.put_object(Bucket=BUCKET, Key=f'data/part-{i}.csv', Body=f'a\n{i}\n'.encode('ascii'))
+
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        clear_s3_filesystems()
+        clear_s3_stats()
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_cached_function(self):
+        cache = make_cache()
+        calls = []
+        @cache.acache
+        async def read_all(files):
+            calls.append(len(files))
+            total = 0
+            for f in files:
+                g = await f.open_async('rb')
+                total += len(await g.read())
+                await g.close()
+            return total
+        async def run():
+            files = [await S3File.acreate(f's3://{BUCKET}/data/part-{i}.csv', endpoint_url=ENDPOINT)
+                     for i in range(5)]
+            # from here on, the synchronous filesystem must not be used
+            sync_fs = get_s3_filesystem(endpoint_url=ENDPOINT)
+            def fail(*args, **kwargs):
+                raise AssertionError("blocking S3 request")
+            (sync_fs.info, sync_fs.ls) = (fail, fail)
+            results = [await read_all(files), await read_all(files)]
+            await close_async_s3_filesystems()
+            return results
+        self.assertEqual(asyncio.run(run()), [20, 20])
+        self.assertEqual(calls, [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Tests for the cml command line tool."""
+import sys
+import os
+from os.path import join, exists
+import unittest
+import json
+import stat
+
+import numpy as np
+from click.testing import CliRunner
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.cml import cli
+from cacheml.cache import Cache, LocalFile
+
+DEBUG=False
+
+WARM_MODULE = '''
+import os
+def count_lines(f, skip=0):
+    with open(f.path, 'r') as g:
+        lines = g.readlines()[skip:]
+    with open({log_file!r}, 'a') as log:
+        log.write(f'{{os.getpid()}}\\n')
+    return len(lines)
+'''
+
+JOBLIB_MODULE = '''
+import os
+from joblib import Memory
+memory = Memory({location!r}, verbose=0)
+@memory.cache
+def file_size(f):
+    return os.path.getsize(f.path)
+'''
+
+
+class TestCml(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.runner = CliRunner()
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def cml(self, *args, exit_code=0):
+        result = self.runner.invoke(cli, ['--config-base-dir', TEMPDIR] + list(args))
+        self.assertEqual(result.exit_code, exit_code, result.output)
+        return result.output
+
+    def _init(self, **config):
+        self.cml('init', join(TEMPDIR, 'cache'))
+        cfg_file = join(TEMPDIR, '.dml', 'config')
+        with open(cfg_file, 'r') as f:
+            cfg_data = json.load(f)
+        cfg_data.update(config)
+        with open(cfg_file, 'w') as f:
+            json.dump(cfg_data, f)
+
+    def test_init_and_keygen(self):
+        self._init()
+        self.assertTrue(exists(join(TEMPDIR, '.dml', 'config')))
+        self.assertIn('already exits', self.cml('init', join(TEMPDIR, 'cache'), exit_code=1))
+        self.cml('keygen', 'other')
+        cred_file = join(TEMPDIR, '.dml', 'credentials')
+        with open(cred_file, 'r') as f:
+            self.assertEqual(sorted(json.load(f)['cache_keys'].keys()), ['default', 'other'])
+        self.assertEqual(stat.S_IMODE(os.stat(cred_file).st_mode), 0o600)
+        self.assertIn('already a key', self.cml('keygen', 'other', exit_code=1))
+
+    def test_maintenance(self):
+        self._init(manifest=True)
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        @cache.cache
+        def make_array(n):
+            return np.arange(n)
+        for i in range(4):
+            make_array(40000 + i)
+        make_array(40000)
+        # hits are buffered by the process that records them
+        cache.store_backend.manifest.flush_hits()
+        output = self.cml('stats', '--key', 'default')
+        (line,) = [l for l in output.split('\n') if 'make_array' in l]
+        self.assertEqual(line.split()[1:3], ['4', '1.2'])
+        self.assertEqual(line.split()[3], '1') # hits
+        self.assertIn('Total: 4 entries', output)
+        self.assertIn('no size limit', self.cml('gc', exit_code=1))
+        self.assertIn('Removed 1 entries', self.cml('gc', '--max-size-in-mb', '1'))
+        self.assertIn('0 bad entries', self.cml('verify', '--key', 'default'))
+        # truncate an entry
+        entry = cache.store_backend.manifest.entries()[0]['path']
+        with open(join(cache.store_backend.location, entry, 'output.pkl'), 'r+b') as f:
+            f.truncate(1000)
+        output = self.cml('verify', '--key', 'default', exit_code=1)
+        self.assertIn(f'Unable to load {entry}', output)
+        self.cml('verify', '--key', 'default', '--remove', exit_code=1)
+        self.assertIn('0 bad entries', self.cml('verify', '--key', 'default'))
+        # the manifest is out of date
+        cache.store_backend.manifest.remove('')
+        self.assertIn('rebuild-manifest', self.cml('verify', '--key', 'default', exit_code=1))
+        self.assertIn('with 2 entries', self.cml('rebuild-manifest', '--key', 'default'))
+        self.cml('verify', '--key', 'default')
+
+    def test_warm(self):
+        self._init()
+        log_file = join(TEMPDIR, 'calls.log')
+        with open(join(TEMPDIR, 'warm_module.py'), 'w') as f:
+            f.write(WARM_MODULE.format(log_file=log_file))
+        sys.path.append(TEMPDIR)
+        data_files = []
+        for i in range(3):
+            data_files.append(join(TEMPDIR, f'data{i}.csv'))
+            with open(data_files[-1], 'w') as f:
+                f.write('a,b\n' + 'x,y\n'*i)
+        warm_file = join(TEMPDIR, 'warm.json')
+        with open(warm_file, 'w') as f:
+            json.dump([{'function':'warm_module:count_lines', 'files':data_files, 'kwargs':{'skip':1}}], f)
+        output = self.cml('warm', warm_file, '--key', 'default', '--workers', '2')
+        self.assertEqual(output.count('computed'), 3)
+        self.assertIn('Warmed 3 of 3', output)
+        output = self.cml('warm', warm_file, '--key', 'default', '--workers', '2')
+        self.assertEqual(output.count('cached'), 3)
+        with open(log_file, 'r') as f:
+            self.assertEqual(len(f.readlines()), 3)
+        # the results are those of the function called by analysts
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        import warm_module
+        self.assertEqual(cache.cache(warm_module.count_lines)(LocalFile(data_files[2]), skip=1), 2)
+        with open(log_file, 'r') as f:
+            self.assertEqual(len(f.readlines()), 3)
+        with open(warm_file, 'w') as f:
+            json.dump([{'function':'warm_module:missing', 'files':data_files[:1]}], f)
+        self.assertIn('failed', self.cml('warm', warm_file, '--key', 'default', exit_code=1))
+
+    def test_warm_joblib_memory(self):
+        # functions cached by their module with joblib's own Memory
+        self._init()
+        with open(join(TEMPDIR, 'joblib_module.py'), 'w') as f:
+            f.write(JOBLIB_MODULE.format(location=join(TEMPDIR, 'joblib_cache')))
+        sys.path.append(TEMPDIR)
+        data_file = join(TEMPDIR, 'data.csv')
+        with open(data_file, 'w') as f:
+            f.write('a,b\n')
+        warm_file = join(TEMPDIR, 'warm.json')
+        with open(warm_file, 'w') as f:
+            json.dump([{'function':'joblib_module:file_size', 'files':[data_file]}], f)
+        self.assertIn('Warmed 1 of 1', self.cml('warm', warm_file, '--workers', '1'))
+        self.assertEqual(self.cml('warm', warm_file, '--workers', '1').count('cached'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import sys
+import os
+from os.path import join
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key
+from cacheml.columnar import HAVE_ARROW, ColumnNotFoundError, to_arrow_table
+from cacheml.cache import CacheMLStoreBackend, EncryptedStoreBackend, Cache, \
+    DATAFRAME_ARROW, DATAFRAME_PICKLE
+
+DEBUG=False
+
+def make_df(rows=10000):
+    return pd.DataFrame({'a':np.arange(rows), 'b':np.arange(rows)*0.5,
+                         'c':[f'row {i}' for i in range(rows)],
+                         'd':pd.Categorical(['x', 'y']*(rows//2))},
+                        index=pd.Index([f'k{i}' for i in range(rows)], name='key'))
+
+
+@unittest.skipUnless(HAVE_ARROW, "pyarrow is not installed")
+class TestArrowBackend(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.key = get_new_key()
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def _backends(self, **options):
+        return [make_backend(CacheMLStoreBackend, **options),
+                make_backend(EncryptedStoreBackend, key=self.key, **options)]
+
+    def test_roundtrip(self):
+        df = make_df()
+        series = pd.Series(np.arange(1000)*2.0, name='values')
+        for backend in self._backends():
+            backend.dump_item(['func', 'df'], df, verbose=0)
+            result = backend.load_item(['func', 'df'], verbose=0)
+            self.assertTrue(result.equals(df))
+            self.assertEqual(result['c'].dtype, df['c'].dtype)
+            self.assertEqual(result.index.name, 'key')
+            backend.dump_item(['func', 'series'], series, verbose=0)
+            result = backend.load_item(['func', 'series'], verbose=0)
+            self.assertTrue(result.equals(series))
+            self.assertEqual(result.name, 'values')
+
+    def test_projection(self):
+        df = make_df()
+        for backend in self._backends():
+            backend.dump_item(['func', 'df'], df, verbose=0)
+            result = backend.load_item(['func', 'df'], verbose=0, columns=['c', 'a'])
+            self.assertEqual(list(result.columns), ['c', 'a'])
+            self.assertTrue(result.equals(df[['c', 'a']]))
+            self.assertRaises(ColumnNotFoundError, backend.load_item, ['func', 'df'],
+                              verbose=0, columns=['a', 'missing'])
+
+    def test_fallback_to_pickle(self):
+        """Frames that Arrow cannot store exactly and other objects are pickled"""
+        items = [pd.DataFrame({0:[1, 2], 1:[3, 4]}), # non-string column names
+                 pd.DataFrame({'mixed':[1, 'a']}),
+                 {'a':1}]
+        for backend in self._backends():
+            for (i, item) in enumerate(items):
+                backend.dump_item(['func', str(i)], item, verbose=0)
+                result = backend.load_item(['func', str(i)], verbose=0)
+                if isinstance(item, pd.DataFrame):
+                    self.assertTrue(result.equals(item))
+                else:
+                    self.assertEqual(result, item)
+        # projection also works for pickled entries
+        backend = make_backend(CacheMLStoreBackend, dataframe_format=DATAFRAME_PICKLE)
+        df = make_df()
+        backend.dump_item(['func', 'df'], df, verbose=0)
+        self.assertTrue(backend.load_item(['func', 'df'], verbose=0, columns=['b']).equals(df[['b']]))
+
+    def test_nested_values(self):
+        """Object columns of lists, tuples or dicts are pickled, so they come back as they were"""
+        items = [pd.DataFrame({'l':[[1, 2], [3]]}),
+                 pd.DataFrame({'t':[(1, 2), (3,)]}),
+                 pd.DataFrame({'d':[{'a':1}, {'b':2}]}),
+                 pd.Series([{'a':1}, {'a':2, 'b':3}], name='s')]
+        for item in items:
+            self.assertIsNone(to_arrow_table(item))
+        for backend in self._backends():
+            for (i, item) in enumerate(items):
+                backend.dump_item(['func', str(i)], item, verbose=0)
+                result = backend.load_item(['func', str(i)], verbose=0)
+                self.assertTrue(result.equals(item))
+                column = lambda x: x.iloc[:, 0] if isinstance(x, pd.DataFrame) else x
+                for (value, expected) in zip(column(result), column(item)):
+                    self.assertIs(type(value), type(expected))
+                    self.assertEqual(value, expected)
+
+    def test_index_freq(self):
+        df = pd.DataFrame({'a':np.arange(10)}, index=pd.date_range('2021-01-01', periods=10, freq='W-WED'))
+        series = pd.Series(np.arange(5), index=pd.timedelta_range('1s', periods=5, freq='s'))
+        for backend in self._backends():
+            backend.dump_item(['func', 'df'], df, verbose=0)
+            result = backend.load_item(['func', 'df'], verbose=0)
+            self.assertTrue(result.equals(df))
+            self.assertEqual(result.index.freq, df.index.freq)
+            self.assertEqual(backend.load_item(['func', 'df'], verbose=0, columns=['a']).index.freq,
+                             df.index.freq)
+            backend.dump_item(['func', 'series'], series, verbose=0)
+            self.assertEqual(backend.load_item(['func', 'series'], verbose=0).index.freq, series.index.freq)
+
+    def test_mmap_mode(self):
+        df = make_df()
+        backend = make_backend(CacheMLStoreBackend, mmap_mode='r')
+        backend.dump_item(['func', 'df'], df, verbose=0)
+        self.assertTrue(backend.load_item(['func', 'df'], verbose=0).equals(df))
+
+
+@unittest.skipUnless(HAVE_ARROW, "pyarrow is not installed")
+class TestLoadColumns(unittest.TestCase):
+    def setUp(self):
+        init_test_cache()
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_load_columns(self):
+        for key_name in [None, 'default']:
+            cache = Cache(encryption_key_name=key_name, verbose=0, _config_base_dir=TEMPDIR)
+            calls = []
+            @cache.cache
+            def make(rows):
+                calls.append(rows)
+                return make_df(rows)
+            # not yet cached: computes and caches the whole frame
+            result = make.load_columns(['b'], 1000)
+            self.assertTrue(result.equals(make_df(1000)[['b']]))
+            self.assertEqual(calls, [1000])
+            result = make.load_columns(['d', 'a'], 1000)
+            self.assertTrue(result.equals(make_df(1000)[['d', 'a']]))
+            self.assertTrue(make(1000).equals(make_df(1000)))
+            self.assertEqual(calls, [1000])
+            cache.clear(warn=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
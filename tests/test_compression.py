@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import sys
+import os
+from os.path import join, getsize
+import io
+import tracemalloc
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key, encrypted_file_open
+from cacheml.compression import compressed_writer, decompressed_reader, is_compressed_file, \
+    available_codecs, CODEC_ZLIB
+from cacheml.columnar import HAVE_ARROW
+from cacheml.cache import CacheMLStoreBackend, EncryptedStoreBackend, CacheConfigError, \
+    LAYOUT_JOBLIB, LAYOUT_OOB
+
+DEBUG=False
+
+def make_df(rows=100000):
+    return pd.DataFrame({'a':np.arange(rows), 'b':np.arange(rows)%7*0.5,
+                         'c':[f'row {i%100}' for i in range(rows)]})
+
+
+class TestCompressedStreams(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.filename = join(TEMPDIR, 'output.pkl')
+        self.data = b''.join(f'line {i}\n'.encode('ascii') for i in range(200000))
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_roundtrip(self):
+        key = get_new_key()
+        for codec in available_codecs():
+            with encrypted_file_open(self.filename, 'wb', key) as f:
+                with compressed_writer(f, codec) as c:
+                    c.write(self.data)
+            self.assertLess(getsize(self.filename), len(self.data)//2)
+            with encrypted_file_open(self.filename, 'rb', key) as f:
+                self.assertTrue(is_compressed_file(f))
+                with decompressed_reader(f) as d:
+                    self.assertEqual(d.read(10), self.data[0:10])
+                    d.seek(100000)
+                    self.assertEqual(d.tell(), 100000)
+                    self.assertEqual(d.read(), self.data[100000:])
+                    self.assertRaises(io.UnsupportedOperation, d.seek, 0)
+
+    def test_truncated(self):
+        for codec in available_codecs():
+            with open(self.filename, 'wb') as f:
+                with compressed_writer(f, codec) as c:
+                    c.write(self.data)
+            for size in [getsize(self.filename)//2, getsize(self.filename)-1]:
+                with open(self.filename, 'rb+') as f:
+                    f.truncate(size)
+                with open(self.filename, 'rb') as f:
+                    with decompressed_reader(f) as d:
+                        self.assertRaises(ValueError, d.read)
+
+    def test_bounded_output(self):
+        """A highly compressible entry is decompressed a read at a time"""
+        for codec in available_codecs():
+            with open(self.filename, 'wb') as f:
+                with compressed_writer(f, codec) as c:
+                    for _ in range(64):
+                        c.write(bytes(1024*1024))
+            self.assertLess(getsize(self.filename), 1024*1024)
+            with open(self.filename, 'rb') as f:
+                with decompressed_reader(f, buf_size=65536) as d:
+                    buffer = bytearray(65536)
+                    total = 0
+                    tracemalloc.start()
+                    try:
+                        while True:
+                            n = d.readinto(buffer)
+                            if n==0:
+                                break
+                            total += n
+                        peak = tracemalloc.get_traced_memory()[1]
+                    finally:
+                        tracemalloc.stop()
+            self.assertEqual(total, 64*1024*1024)
+            self.assertLess(peak, 4*1024*1024, codec)
+
+
+class TestCompressedBackend(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.key = get_new_key()
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_layouts(self):
+        data = {'df':make_df(), 'array':np.zeros(100000)}
+        for (cls, options) in [(CacheMLStoreBackend, {}),
+                               (EncryptedStoreBackend, {'key':self.key})]:
+            for layout in [LAYOUT_JOBLIB, LAYOUT_OOB]:
+                backend = make_backend(cls, layout=layout, **options)
+                backend.dump_item(['func', 'none', layout], data, verbose=0)
+                uncompressed_size = getsize(join(TEMPDIR, 'joblib', 'func', 'none', layout, 'output.pkl'))
+                for codec in available_codecs():
+                    backend = make_backend(cls, layout=layout, compression=codec, **options)
+                    backend.dump_item(['func', codec, layout], data, verbose=0)
+                    size = getsize(join(TEMPDIR, 'joblib', 'func', codec, layout, 'output.pkl'))
+                    self.assertLess(size, uncompressed_size//2)
+                    result = backend.load_item(['func', codec, layout], verbose=0)
+                    self.assertTrue(result['df'].equals(data['df']))
+                    self.assertTrue((result['array']==data['array']).all())
+
+    @unittest.skipUnless(HAVE_ARROW, "pyarrow is not installed")
+    def test_arrow(self):
+        df = make_df()
+        for codec in available_codecs():
+            backend = make_backend(EncryptedStoreBackend, key=self.key, compression=codec)
+            backend.dump_item(['func', codec], df, verbose=0)
+            result = backend.load_item(['func', codec], verbose=0, columns=['c'])
+            self.assertTrue(result.equals(df[['c']]))
+
+    def test_mmap_mode(self):
+        """Compressed entries cannot be memory-mapped, so they are just loaded"""
+        data = np.zeros(100000)
+        backend = make_backend(CacheMLStoreBackend, compression=CODEC_ZLIB, mmap_mode='r')
+        backend.dump_item(['func', 'x'], data, verbose=0)
+        self.assertTrue((backend.load_item(['func', 'x'], verbose=0)==data).all())
+
+    def test_invalid_codec(self):
+        self.assertRaises(CacheConfigError, make_backend, CacheMLStoreBackend,
+                          compression='snappy')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,7 +11,8 @@ import numpy as np
 
 from utils_for_tests import *
 sys.path.append(get_module_path())
-from cacheml.crypto import get_new_key, encrypted_file_open
+from cacheml.crypto import get_new_key, encrypted_file_open, get_file_format, \
+    FORMAT_CTR, FORMAT_GCM
 from cacheml.cache import LocalFile, init_cache, Cache
 
 DEBUG=False
@@ -116,6 +117,203 @@ class TestFileReadWrite(unittest.TestCase):
                 read_data = pickle.load(g)
             self.assertTrue((data==read_data).all())
 
+    def test_seek_and_tell(self):
+        key = get_new_key()
+        data = bytes(range(256))*40
+        filename = join(TEMPDIR, 'test_data.pkl')
+        for file_format in [FORMAT_CTR, FORMAT_GCM]:
+            with encrypted_file_open(filename, 'wb', key, buf_size=1000, file_format=file_format) as f:
+                f.write(data)
+            for buf_size in [4096, 256, 31]:
+                with encrypted_file_open(filename, 'rb', key, buf_size=buf_size) as f:
+                    self.assertEqual(f.read(100), data[0:100])
+                    self.assertEqual(f.tell(), 100)
+                    f.seek(5000)
+                    self.assertEqual(f.tell(), 5000)
+                    self.assertEqual(f.read(37), data[5000:5037])
+                    f.seek(-20, os.SEEK_CUR)
+                    self.assertEqual(f.read(50), data[5017:5067])
+                    f.seek(-33, os.SEEK_END)
+                    self.assertEqual(f.read(), data[-33:])
+                    self.assertEqual(f.tell(), len(data))
+                    f.seek(3)
+                    self.assertEqual(f.readline(), data[3:11])
+                    f.seek(0)
+                    self.assertEqual(f.read(), data)
+                print(f"  Subtest for format {file_format}, buffer size {buf_size} OK.")
+
+    def test_random_reads(self):
+        key = get_new_key()
+        data = np.random.default_rng(12).bytes(100000)
+        filename = join(TEMPDIR, 'test_data.pkl')
+        for file_format in [FORMAT_CTR, FORMAT_GCM]:
+            with encrypted_file_open(filename, 'wb', key, buf_size=1000, file_format=file_format) as f:
+                f.write(data)
+            rng = np.random.default_rng(42)
+            with encrypted_file_open(filename, 'rb', key, buf_size=1000) as f:
+                for i in range(200):
+                    offset = int(rng.integers(0, len(data)))
+                    size = int(rng.integers(1, 3000))
+                    f.seek(offset)
+                    self.assertEqual(f.read(size), data[offset:offset+size],
+                                     f"Mismatch for read of {size} bytes at {offset} ({file_format})")
+
+    def test_read_ahead(self):
+        key = get_new_key()
+        data = np.random.default_rng(7).bytes(50000)
+        filename = join(TEMPDIR, 'test_data.pkl')
+        with encrypted_file_open(filename, 'wb', key, file_format=FORMAT_CTR) as f:
+            f.write(data)
+        for decrypt_ahead in [False, True]:
+            for buf_size in [4096, 1000, 31]:
+                with encrypted_file_open(filename, 'rb', key, buf_size=buf_size, read_ahead=3,
+                                         decrypt_ahead=decrypt_ahead) as f:
+                    self.assertEqual(f.read(10), data[0:10])
+                    self.assertEqual(f.read(20000), data[10:20010])
+                    f.seek(40000)
+                    self.assertEqual(f.read(100), data[40000:40100])
+                    f.seek(-100, os.SEEK_CUR)
+                    self.assertEqual(f.read(), data[40000:])
+                    f.seek(0)
+                    self.assertEqual(f.read(), data)
+                with encrypted_file_open(filename, 'rb', key, buf_size=buf_size, read_ahead=2,
+                                         decrypt_ahead=decrypt_ahead) as f:
+                    read_bytes = bytes()
+                    while True:
+                        line = f.readline()
+                        if len(line)==0:
+                            break
+                        read_bytes += line
+                    self.assertEqual(read_bytes, data)
+
+    def test_read_ahead_with_pickle(self):
+        key = get_new_key()
+        data = np.arange(0, 1000000)
+        filename = join(TEMPDIR, 'test_data.pkl')
+        with encrypted_file_open(filename, 'wb', key, file_format=FORMAT_CTR) as f:
+            pickle.dump(data, f)
+        with encrypted_file_open(filename, 'rb', key, buf_size=64*1024, read_ahead=4,
+                                 decrypt_ahead=True) as g:
+            read_data = pickle.load(g)
+        self.assertTrue((data==read_data).all())
+
+    def test_write_behind(self):
+        key = get_new_key()
+        data = np.random.default_rng(3).bytes(50000)
+        filename = join(TEMPDIR, 'test_data.pkl')
+        for buf_size in [4096, 1000, 31]:
+            with encrypted_file_open(filename, 'wb', key, buf_size=buf_size, write_behind=3,
+                                     file_format=FORMAT_CTR) as f:
+                cnt = f.write(data[0:7])
+                cnt += f.write(data[7:30000])
+                f.flush()
+                cnt += f.write(data[30000:])
+                self.assertEqual(cnt, len(data))
+            self.assertEqual(os.stat(filename).st_size, len(data))
+            with encrypted_file_open(filename, 'rb', key) as f:
+                self.assertEqual(f.read(), data)
+
+    def test_write_behind_with_pickle(self):
+        key = get_new_key()
+        data = np.arange(0, 1000000)
+        filename = join(TEMPDIR, 'test_data.pkl')
+        with encrypted_file_open(filename, 'wb', key, buf_size=64*1024, write_behind=2,
+                                 file_format=FORMAT_CTR) as f:
+            pickle.dump(data, f)
+        with encrypted_file_open(filename, 'rb', key) as g:
+            read_data = pickle.load(g)
+        self.assertTrue((data==read_data).all())
+
+    def test_readinto(self):
+        key = get_new_key()
+        data = np.arange(0, 100000, dtype=np.int64)
+        filename = join(TEMPDIR, 'test_data.pkl')
+        with encrypted_file_open(filename, 'wb', key, buf_size=4096, file_format=FORMAT_CTR) as f:
+            f.write(b'header\n')
+            f.write(data)
+        for read_ahead in [0, 2]:
+            with encrypted_file_open(filename, 'rb', key, buf_size=4096, read_ahead=read_ahead) as f:
+                self.assertEqual(f.peek(6)[0:6], b'header')
+                self.assertEqual(f.readline(), b'header\n')
+                read_data = np.empty(len(data), dtype=np.int64)
+                cnt = f.readinto(read_data)
+                self.assertEqual(cnt, data.nbytes)
+                self.assertEqual(f.read(), b'')
+            self.assertTrue((data==read_data).all())
+
+    def test_formats(self):
+        key = get_new_key()
+        data = test_string.encode('utf-8')
+        filename = join(TEMPDIR, 'test_data.pkl')
+        for file_format in [FORMAT_CTR, FORMAT_GCM]:
+            with encrypted_file_open(filename, 'wb', key, file_format=file_format) as f:
+                f.write(data)
+            self.assertEqual(get_file_format(filename), file_format)
+            with encrypted_file_open(filename, 'rb', key) as f:
+                self.assertEqual(f.read(), data)
+        with encrypted_file_open(filename, 'wb', key) as f:
+            pass
+        with encrypted_file_open(filename, 'rb', key) as f:
+            self.assertEqual(f.read(), b'')
+
+    def test_gcm_parallel_read(self):
+        key = get_new_key()
+        data = np.arange(0, 1000000, dtype=np.int64)
+        filename = join(TEMPDIR, 'test_data.pkl')
+        with encrypted_file_open(filename, 'wb', key, buf_size=4096) as f:
+            f.write(b'0123')
+            f.write(data)
+        with encrypted_file_open(filename, 'rb', key, buf_size=4096) as f:
+            self.assertEqual(f.read(4), b'0123')
+            read_data = np.empty(len(data), dtype=np.int64)
+            self.assertEqual(f.readinto(read_data), data.nbytes)
+        self.assertTrue((data==read_data).all())
+        with encrypted_file_open(filename, 'rb', key, buf_size=4096) as f:
+            self.assertEqual(f.read(), b'0123'+data.tobytes())
+
+    def test_gcm_seek_mid_frame(self):
+        key = get_new_key()
+        data = np.random.default_rng(7).bytes(10000)
+        filename = join(TEMPDIR, 'test_data.pkl')
+        with encrypted_file_open(filename, 'wb', key, buf_size=1000) as f:
+            f.write(data)
+        with encrypted_file_open(filename, 'rb', key, buf_size=1000) as f:
+            f.seek(500)
+            self.assertEqual(f.read(), data[500:])
+            self.assertEqual(f.tell(), len(data))
+            # the raw reader reads across the frames as well
+            f.raw.seek(2500)
+            self.assertEqual(f.raw.readall(), data[2500:])
+            self.assertEqual(f.raw.tell(), len(data))
+
+    def test_gcm_authentication(self):
+        key = get_new_key()
+        data = np.random.default_rng(5).bytes(10000)
+        filename = join(TEMPDIR, 'test_data.pkl')
+        def write():
+            with encrypted_file_open(filename, 'wb', key, buf_size=1000) as f:
+                f.write(data)
+        def read(read_key=key):
+            with encrypted_file_open(filename, 'rb', read_key, buf_size=1000) as f:
+                return f.read()
+        # flip a bit in the middle of the file
+        write()
+        with open(filename, 'r+b') as f:
+            f.seek(5000)
+            b = f.read(1)
+            f.seek(5000)
+            f.write(bytes([b[0]^1]))
+        self.assertRaises(ValueError, read)
+        # truncate at a frame boundary
+        write()
+        with open(filename, 'r+b') as f:
+            f.truncate(os.stat(filename).st_size - 1016)
+        self.assertRaises(ValueError, read)
+        # wrong key
+        write()
+        self.assertRaises(ValueError, read, get_new_key())
+        self.assertEqual(read(), data)
+
 
 class TestCachingWithEncryption(unittest.TestCase):
     def setUp(self):
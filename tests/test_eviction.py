@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Tests for the eviction policies."""
+import sys
+import os
+from os.path import join
+import unittest
+import time
+
+import numpy as np
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.eviction import get_policy, LRUPolicy, LFUPolicy, GreedyDualSizePolicy
+from cacheml.cache import Cache, CacheConfigError
+
+DEBUG=False
+
+
+def entry(path, size, last_access, hits=0, duration=None, pinned=0, inflation=0.0):
+    return {'path':path, 'size':size, 'last_access':last_access, 'hits':hits,
+            'duration':duration, 'pinned':pinned, 'inflation':inflation}
+
+
+class TestPolicies(unittest.TestCase):
+    def setUp(self):
+        # an expensive big entry, used long ago, and cheap small ones used more recently
+        self.entries = [entry('f/big', 1000, 1.0, hits=1, duration=600.0),
+                        entry('f/a', 100, 2.0, hits=5, duration=0.1),
+                        entry('f/b', 100, 3.0, hits=0, duration=0.1),
+                        entry('f/c', 100, 4.0, hits=2, duration=None)]
+
+    def _select(self, policy, bytes_to_free, inflation=0.0):
+        (victims, inflation) = policy.select(self.entries, bytes_to_free, inflation)
+        return ([e['path'] for e in victims], inflation)
+
+    def test_lru(self):
+        self.assertEqual(self._select(LRUPolicy(), 50), (['f/big'], 0.0))
+        self.assertEqual(self._select(LRUPolicy(), 1050), (['f/big', 'f/a'], 0.0))
+        self.assertEqual(self._select(LRUPolicy(), 0), ([], 0.0))
+
+    def test_lfu(self):
+        self.assertEqual(self._select(LFUPolicy(), 150)[0], ['f/b', 'f/big'])
+
+    def test_gds(self):
+        (victims, inflation) = self._select(GreedyDualSizePolicy(), 150)
+        # no known cost first, then the cheapest per byte
+        self.assertEqual(victims, ['f/c', 'f/a'])
+        self.assertAlmostEqual(inflation, 0.1/100)
+        # an old inflation value ages the entries that were not used since
+        self.entries[0]['inflation'] = 0.0
+        for e in self.entries[1:]:
+            e['inflation'] = 1.0
+        self.assertEqual(self._select(GreedyDualSizePolicy(), 50, inflation=1.0)[0], ['f/big'])
+
+    def test_pinned(self):
+        self.entries[0]['pinned'] = 1
+        self.assertEqual(self._select(LRUPolicy(), 50)[0], ['f/a'])
+        # cannot free more than the unpinned entries
+        self.assertEqual(self._select(LRUPolicy(), 10000)[0], ['f/a', 'f/b', 'f/c'])
+
+    def test_get_policy(self):
+        self.assertIsInstance(get_policy('gds'), GreedyDualSizePolicy)
+        with self.assertRaises(ValueError):
+            get_policy('random')
+
+
+class TestCacheEviction(unittest.TestCase):
+    def setUp(self):
+        init_test_cache()
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def _make_cache(self, policy):
+        write_cache_config(max_size_in_mb=1, eviction_policy=policy)
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        cache.clear(warn=False)
+        @cache.cache
+        def expensive(n):
+            time.sleep(0.2)
+            return np.arange(n)
+        @cache.cache
+        def cheap(n):
+            return np.arange(n)
+        return (cache, expensive, cheap)
+
+    def _fill(self, cache, expensive, cheap):
+        """Four 320KB entries do not fit in 1MB"""
+        expensive(40000)
+        for i in range(3):
+            cheap(40000 + i)
+        manifest = cache.store_backend.manifest
+        # evicted after the writes, without calling reduce_size()
+        self.assertLessEqual(manifest.total_size(), 1024*1024)
+        self.assertEqual(len(manifest), 2)
+        return {os.path.basename(e['func_id']) for e in manifest.entries()}
+
+    def test_policies(self):
+        self.assertEqual(self._fill(*self._make_cache('lru')), {'cheap'})
+        self.assertEqual(self._fill(*self._make_cache('gds')), {'expensive', 'cheap'})
+
+    def test_pin(self):
+        (cache, expensive, cheap) = self._make_cache('lru')
+        self.assertEqual(expensive.pin(40000).sum(), np.arange(40000).sum())
+        self.assertEqual(self._fill(cache, expensive, cheap), {'expensive', 'cheap'})
+        expensive.unpin(40000)
+        cheap(60000)
+        self.assertEqual({os.path.basename(e['func_id']) for e in cache.store_backend.manifest.entries()},
+                         {'cheap'})
+
+    def test_invalid_policy(self):
+        write_cache_config(max_size_in_mb=1, eviction_policy='random')
+        with self.assertRaises(CacheConfigError):
+            Cache(verbose=0, _config_base_dir=TEMPDIR)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Tests for the validation of LocalFile arguments: the per-call stat memo and
+content fingerprints.
+"""
+import sys
+import os
+from os.path import join
+import unittest
+import shutil
+import time
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key
+import cacheml.local_stats as local_stats
+from cacheml.local_stats import configure_local_validation, local_validation_scope, \
+    get_fingerprint_index, HASH_NAME
+from cacheml.cache import LocalFile, Cache
+
+DEBUG=False
+
+
+class TestLocalValidation(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        configure_local_validation(fingerprint=False, index_path=join(TEMPDIR, 'fingerprints.db'))
+        self.hashed = []
+        self.saved_hash_file = local_stats.hash_file
+        def counting_hash_file(path, size=None):
+            self.hashed.append(path)
+            return self.saved_hash_file(path, size)
+        local_stats.hash_file = counting_hash_file
+        self.data_file = join(TEMPDIR, 'data.csv')
+        with open(self.data_file, 'w') as f:
+            f.write('a,b\n1,2\n3,4\n')
+
+    def tearDown(self):
+        local_stats.hash_file = self.saved_hash_file
+        configure_local_validation(fingerprint=False, index_path=local_stats.DEFAULT_INDEX_PATH)
+        clear_tempdir(DEBUG)
+
+    def _touch(self, path):
+        t = time.time() + 10
+        os.utime(path, (t, t))
+
+    def test_stat_memo(self):
+        f = LocalFile(self.data_file)
+        state = f.__getstate__()
+        with local_validation_scope():
+            self.assertEqual(f.__getstate__(), state)
+            # within the scope, the file is not stat'ed again
+            self._touch(self.data_file)
+            self.assertEqual(f.__getstate__(), state)
+        self.assertNotEqual(f.__getstate__(), state)
+
+    def test_fingerprint(self):
+        configure_local_validation(fingerprint=True)
+        f = LocalFile(self.data_file)
+        (path, fingerprint, size) = f.__getstate__()
+        self.assertTrue(fingerprint.startswith(HASH_NAME + ':'))
+        self.assertEqual(size, os.path.getsize(self.data_file))
+        self.assertEqual(len(self.hashed), 1)
+        # touching the file changes the index key, but not the fingerprint
+        self._touch(self.data_file)
+        self.assertEqual(f.__getstate__(), (path, fingerprint, size))
+        self.assertEqual(len(self.hashed), 2)
+        # a copy has the same fingerprint
+        copy = join(TEMPDIR, 'copy.csv')
+        shutil.copy(self.data_file, copy)
+        self.assertEqual(LocalFile(copy).stats, (fingerprint, size))
+        # different content
+        with open(self.data_file, 'a') as g:
+            g.write('5,6\n')
+        self.assertNotEqual(LocalFile(self.data_file).stats[0], fingerprint)
+
+    def test_persistent_index(self):
+        configure_local_validation(fingerprint=True)
+        stats = LocalFile(self.data_file).stats
+        LocalFile(self.data_file).stats
+        self.assertEqual(len(self.hashed), 1)
+        # a new process would start with an empty memo, and get the fingerprint
+        # from the database
+        get_fingerprint_index().clear_memo()
+        self.assertEqual(LocalFile(self.data_file).stats, stats)
+        self.assertEqual(len(self.hashed), 1)
+        configure_local_validation(index_path=join(TEMPDIR, 'other.db'))
+        self.assertEqual(LocalFile(self.data_file).stats, stats)
+        self.assertEqual(len(self.hashed), 2)
+
+    def test_cached_function(self):
+        write_cache_config(local_fingerprint=True)
+        write_cache_credentials(get_new_key())
+        cache = Cache(verbose=0, _config_base_dir=TEMPDIR)
+        calls = []
+        @cache.cache
+        def read(f):
+            calls.append(f.path)
+            with f.open('r') as g:
+                return g.read()
+        expected = read(LocalFile(self.data_file))
+        self._touch(self.data_file)
+        self.assertEqual(read(LocalFile(self.data_file)), expected)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(os.path.exists(join(TEMPDIR, '.dml', 'fingerprints.db')))
+        # a cache created later without the setting does not use fingerprints
+        write_cache_config(cache_dir=join(TEMPDIR, 'cache2'))
+        Cache(verbose=0, _config_base_dir=TEMPDIR)
+        (mtime, size) = LocalFile(self.data_file).stats
+        self.assertEqual(mtime, os.stat(self.data_file).st_mtime)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Tests for the per-entry single-flight locks."""
+import sys
+import os
+from os.path import join
+import unittest
+import json
+import threading
+import subprocess
+import time
+from unittest import mock
+
+from joblib import Memory
+from joblib.memory import MemorizedFunc
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.locks import EntryLock
+from cacheml.cache import Cache
+
+DEBUG=False
+
+SLOW_MODULE = '''
+import os
+import time
+def slow_square(x, log_file):
+    with open(log_file, 'a') as f:
+        f.write(f'{os.getpid()}\\n')
+    time.sleep(1)
+    return x*x
+'''
+
+WORKER_SCRIPT = '''
+import sys
+sys.path.append({module_path!r})
+sys.path.append({tempdir!r})
+from cacheml.cache import Cache
+from slow_module import slow_square
+cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir={tempdir!r})
+print(cache.cache(slow_square)(7, {log_file!r}))
+'''
+
+
+class TestEntryLock(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.path = join(TEMPDIR, 'func', '0123.lock')
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_acquire(self):
+        first = EntryLock(self.path)
+        self.assertTrue(first.acquire())
+        self.assertFalse(first.contended)
+        second = EntryLock(self.path)
+        self.assertFalse(second.acquire(timeout=0.1))
+        self.assertTrue(second.contended)
+        threading.Timer(0.2, first.release).start()
+        self.assertTrue(second.acquire(timeout=5))
+        self.assertTrue(second.contended)
+        second.release()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_stale(self):
+        # the holder no longer exists
+        proc = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                              capture_output=True, check=True)
+        import socket
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump({'host':socket.gethostname(), 'pid':int(proc.stdout), 'thread':0, 'token':'x'}, f)
+        lock = EntryLock(self.path)
+        self.assertTrue(lock.is_stale())
+        self.assertTrue(lock.acquire(timeout=1))
+        lock.release()
+        # the holder stopped updating the lock
+        with open(self.path, 'w') as f:
+            json.dump({'host':'another-host', 'pid':1, 'thread':0, 'token':'x'}, f)
+        lock = EntryLock(self.path, stale_after=5)
+        self.assertFalse(lock.is_stale())
+        old = time.time() - 10
+        os.utime(self.path, (old, old))
+        self.assertTrue(lock.is_stale())
+        self.assertTrue(lock.acquire(timeout=1))
+        lock.release()
+
+    def test_heartbeat(self):
+        lock = EntryLock(self.path, stale_after=0.4)
+        lock.acquire()
+        time.sleep(1)
+        self.assertFalse(lock.is_stale())
+        lock.release()
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        init_test_cache(single_flight=True)
+        with open(join(TEMPDIR, 'slow_module.py'), 'w') as f:
+            f.write(SLOW_MODULE)
+        self.log_file = join(TEMPDIR, 'calls.log')
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def _num_calls(self):
+        with open(self.log_file, 'r') as f:
+            return len(f.readlines())
+
+    def test_threads(self):
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        calls = []
+        @cache.cache
+        def slow_square(x):
+            calls.append(x)
+            time.sleep(0.5)
+            return x*x
+        slow_square(1) # so that the function code is written
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow_square(3))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [9]*4)
+        self.assertEqual(calls, [1, 3])
+        self.assertEqual([name for name in os.listdir(TEMPDIR) if name.endswith('.lock')], [])
+
+    def test_processes(self):
+        script = WORKER_SCRIPT.format(module_path=get_module_path(), tempdir=TEMPDIR,
+                                      log_file=self.log_file)
+        procs = [subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE) for _ in range(3)]
+        outputs = [p.communicate()[0].decode('utf-8').strip().split('\n')[-1] for p in procs]
+        self.assertEqual(outputs, ['49']*3)
+        self.assertEqual(self._num_calls(), 1)
+
+    def test_hashes_per_miss(self):
+        """A miss hashes the arguments as many times as with joblib's Memory"""
+        def square(x):
+            return x*x
+        hashes = []
+        original = MemorizedFunc._get_argument_hash
+        def counting_hash(func, *args, **kwargs):
+            hashes.append(args)
+            return original(func, *args, **kwargs)
+        with mock.patch.object(MemorizedFunc, '_get_argument_hash', counting_hash):
+            Memory(join(TEMPDIR, 'joblib'), verbose=0).cache(square)(2)
+            expected = len(hashes)
+            for single_flight in [True, False]:
+                write_cache_config(cache_dir=join(TEMPDIR, f'cache-{single_flight}'),
+                                   single_flight=single_flight)
+                cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+                del hashes[:]
+                self.assertEqual(cache.cache(square)(3), 9)
+                self.assertEqual(len(hashes), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
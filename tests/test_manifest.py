@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Tests for the manifest of cache entries."""
+import sys
+import os
+from os.path import join, exists
+import unittest
+
+import numpy as np
+from joblib._store_backends import FileSystemStoreBackend
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.manifest import Manifest
+from cacheml.cache import Cache, CacheConfigError
+
+DEBUG=False
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.manifest = Manifest(join(TEMPDIR, 'manifest.db'))
+
+    def tearDown(self):
+        self.manifest.close()
+        clear_tempdir(DEBUG)
+
+    def test_entries(self):
+        m = self.manifest
+        m.record_entry(join('mod-f', 'a'*32), 100)
+        m.record_entry(join('mod-f', 'a'*32), 150, 2.5) # the metadata was written
+        m.record_entry(join('mod-g_1', 'b'*32), 50)
+        m.record_entry(join('mod-g%1', 'c'*32), 10)
+        self.assertEqual(len(m), 3)
+        self.assertEqual(m.total_size(), 210)
+        (f,) = m.entries(func_id='mod-f')
+        self.assertEqual((f['args_id'], f['size'], f['duration'], f['hits']), ('a'*32, 150, 2.5, 0))
+        m.record_hit(join('mod-f', 'a'*32))
+        m.record_hit(join('mod-f', 'a'*32))
+        entries = m.entries()
+        self.assertEqual(entries[0]['path'], join('mod-f', 'a'*32))
+        self.assertEqual(entries[0]['hits'], 2)
+        # '_' and '%' are not wildcards
+        m.remove('mod-g_1')
+        self.assertEqual(sorted(e['func_id'] for e in m.entries()), ['mod-f', 'mod-g%1'])
+        m.remove('')
+        self.assertEqual(len(m), 0)
+
+    def test_rebuild(self):
+        self.manifest.record_entry(join('mod-f', 'a'*32), 100)
+        self.manifest.rebuild([{'path':join('mod-g', 'b'*32), 'size':5, 'created':1.0,
+                                'last_access':2.0, 'duration':0.1}])
+        self.assertEqual([(e['path'], e['size'], e['last_access']) for e in self.manifest.entries()],
+                         [(join('mod-g', 'b'*32), 5, 2.0)])
+
+
+class TestCacheWithManifest(unittest.TestCase):
+    def setUp(self):
+        init_test_cache(manifest=True)
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def _walk(self, backend):
+        return sorted((item.path, item.size) for item in FileSystemStoreBackend.get_items(backend))
+
+    def test_cache(self):
+        for key_name in [None, 'default']:
+            cache = Cache(encryption_key_name=key_name, verbose=0, _config_base_dir=TEMPDIR)
+            backend = cache.store_backend
+            @cache.cache
+            def make_array(n):
+                return np.arange(n)
+            for n in (1000, 2000, 3000):
+                make_array(n)
+            make_array(1000)
+            items = backend.get_items()
+            self.assertEqual(len(items), 3)
+            # the same as walking the cache directory
+            self.assertEqual(sorted((item.path, item.size) for item in items), self._walk(backend))
+            entries = backend.manifest.entries()
+            self.assertEqual(sum(e['hits'] for e in entries), 1)
+            self.assertTrue(all(e['duration'] is not None for e in entries))
+            # evicts the least recently used entries
+            cache.bytes_limit = max(item.size for item in items) + 1
+            cache.reduce_size()
+            self.assertEqual([e['hits'] for e in backend.manifest.entries()], [1])
+            self.assertEqual(len(self._walk(backend)), 1)
+            make_array.clear()
+            self.assertEqual(len(backend.manifest), 0)
+            cache.clear(warn=False)
+
+    def test_rebuild(self):
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        @cache.cache
+        def make_array(n):
+            return np.arange(n)
+        for n in (1000, 2000):
+            make_array(n)
+        backend = cache.store_backend
+        db_path = backend.manifest.db_path
+        self.assertTrue(exists(db_path))
+        backend.manifest.close()
+        for suffix in ('', '-wal', '-shm'):
+            if exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        # lost, so it starts empty
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        self.assertEqual(len(cache.store_backend.get_items()), 0)
+        self.assertEqual(cache.rebuild_manifest(), 2)
+        self.assertEqual(sorted((item.path, item.size) for item in cache.store_backend.get_items()),
+                         self._walk(cache.store_backend))
+        self.assertTrue(all(e['duration'] is not None for e in cache.store_backend.manifest.entries()))
+
+    def test_not_enabled(self):
+        write_cache_config()
+        cache = Cache(verbose=0, _config_base_dir=TEMPDIR)
+        self.assertIsNone(cache.store_backend.manifest)
+        with self.assertRaises(CacheConfigError):
+            cache.rebuild_manifest()
+
+
+if __name__ == '__main__':
+    unittest.main()
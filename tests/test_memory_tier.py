@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import sys
+import os
+from os.path import join
+import unittest
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.memory_tier import MemoryTier, estimate_size
+from cacheml.cache import Cache, LocalFile
+
+DEBUG=False
+
+
+class TestMemoryTier(unittest.TestCase):
+    def test_estimate_size(self):
+        array = np.zeros(100000)
+        self.assertGreaterEqual(estimate_size(array), array.nbytes)
+        df = pd.DataFrame({'a':np.arange(100000), 'b':[f'row {i}' for i in range(100000)]})
+        self.assertGreater(estimate_size(df), 800000 + 100000*10)
+        self.assertGreater(estimate_size({'x':array, 'y':[array, array]}), array.nbytes)
+        self.assertLess(estimate_size({'x':array, 'y':[array, array]}), 2*array.nbytes)
+
+    def test_shallow_estimate(self):
+        arrays = [np.zeros(1000) for _ in range(10000)]
+        self.assertAlmostEqual(estimate_size(arrays, deep=False)/estimate_size(arrays), 1.0, places=2)
+        self.assertGreater(estimate_size({i:np.zeros(100) for i in range(1000)}, deep=False), 800000)
+        df = pd.DataFrame({'a':np.arange(100000), 'b':[f'row {i}' for i in range(100000)]})
+        self.assertGreater(estimate_size(df, deep=False), 800000)
+        self.assertLessEqual(estimate_size(df, deep=False), estimate_size(df))
+
+    def test_lru(self):
+        tier = MemoryTier(3*80000 + 1000)
+        for i in range(4):
+            tier.put(f'f/{i}', np.zeros(10000))
+        self.assertEqual(len(tier), 3)
+        self.assertEqual(tier.get('f/0'), (False, None))
+        tier.get('f/1') # now 2 is the least recently used
+        tier.put('f/4', np.zeros(10000))
+        self.assertFalse(tier.get('f/2')[0])
+        self.assertTrue(tier.get('f/1')[0])
+        self.assertLessEqual(tier.current_bytes, tier.bytes_limit)
+        # too big to keep
+        tier.put('f/big', np.zeros(100000))
+        self.assertFalse(tier.get('f/big')[0])
+        tier.discard_prefix('f')
+        self.assertEqual(len(tier), 0)
+        self.assertEqual(tier.current_bytes, 0)
+
+
+class TestCacheWithMemoryTier(unittest.TestCase):
+    def setUp(self):
+        init_test_cache()
+        self.data_file = join(TEMPDIR, 'data.csv')
+        with open(self.data_file, 'w') as f:
+            f.write('a,b\n1,2\n3,4\n')
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_hits(self):
+        for key_name in [None, 'default']:
+            cache = Cache(encryption_key_name=key_name, verbose=0, _config_base_dir=TEMPDIR,
+                          memory_limit_in_mb=10)
+            tier = cache.store_backend.memory_tier
+            @cache.cache
+            def read(f):
+                return pd.read_csv(f.path)
+            df = read(LocalFile(self.data_file))
+            rows = len(df)
+            df2 = read(LocalFile(self.data_file))
+            self.assertIs(df2, df)
+            self.assertEqual(tier.hits, 1)
+            # the file stats are part of the key, so a change is a miss
+            with open(self.data_file, 'a') as f:
+                f.write('5,6\n')
+            os.utime(self.data_file, (time.time()+10, time.time()+10))
+            self.assertEqual(len(read(LocalFile(self.data_file))), rows+1)
+            self.assertEqual(tier.hits, 1)
+            # clearing the function clears it from memory
+            read.clear(warn=False)
+            self.assertEqual(len(tier), 0)
+            cache.clear(warn=False)
+
+    def test_disabled(self):
+        cache = Cache(verbose=0, _config_base_dir=TEMPDIR)
+        self.assertIsNone(cache.store_backend.memory_tier)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Tests for the cache metrics and their exporters."""
+import sys
+import os
+from os.path import join
+import unittest
+import json
+import logging
+
+import numpy as np
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.cache import Cache, LocalFile
+from cacheml.metrics import CacheMetrics, PrometheusTextfileExporter, JSONExporter, \
+    PHASE_HASH, PHASE_LOOKUP, PHASE_READ, PHASE_DECRYPT, PHASE_DESERIALIZE, PHASE_COMPUTE, \
+    PHASE_WRITE, LATENCY_BUCKETS
+
+DEBUG=False
+
+
+class TestCacheMetrics(unittest.TestCase):
+    def test_histogram(self):
+        metrics = CacheMetrics()
+        for seconds in [0.0005, 0.002, 0.002, 1000.0]:
+            metrics.observe('f', PHASE_READ, seconds)
+        metrics.count('f', 'hits')
+        metrics.count('f', 'bytes_read', 100)
+        snapshot = metrics.snapshot()['functions']['f']
+        self.assertEqual((snapshot['hits'], snapshot['misses'], snapshot['bytes_read']), (1, 0, 100))
+        histogram = snapshot['phases'][PHASE_READ]
+        self.assertEqual(histogram['count'], 4)
+        self.assertAlmostEqual(histogram['sum'], 1000.0045)
+        self.assertEqual(histogram['buckets'][0], [LATENCY_BUCKETS[0], 1])
+        self.assertEqual(histogram['buckets'][1], [LATENCY_BUCKETS[1], 3])
+        # the last observation is only in +Inf
+        self.assertEqual(histogram['buckets'][-1], [LATENCY_BUCKETS[-1], 3])
+
+    def test_exclusive_timer(self):
+        metrics = CacheMetrics()
+        with metrics.timer('f', PHASE_COMPUTE, exclusive=True):
+            with metrics.timer('f', PHASE_WRITE):
+                time.sleep(0.05)
+        phases = metrics.snapshot()['functions']['f']['phases']
+        self.assertGreaterEqual(phases[PHASE_WRITE]['sum'], 0.05)
+        self.assertLess(phases[PHASE_COMPUTE]['sum'], 0.05)
+
+    def test_exporters(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        try:
+            metrics = CacheMetrics()
+            metrics.count('mod/f"x', 'misses')
+            metrics.observe('mod/f"x', PHASE_COMPUTE, 0.2)
+            snapshots = []
+            metrics.add_exporter(snapshots.append)
+            metrics.add_exporter(PrometheusTextfileExporter(join(TEMPDIR, 'cacheml.prom')))
+            metrics.add_exporter(JSONExporter(join(TEMPDIR, 'metrics.json')))
+            metrics.export()
+            self.assertEqual(snapshots[0]['functions']['mod/f"x']['misses'], 1)
+            with open(join(TEMPDIR, 'cacheml.prom'), 'r') as f:
+                text = f.read()
+            self.assertIn('# TYPE cacheml_misses_total counter', text)
+            self.assertIn('cacheml_misses_total{function="mod/f\\"x"} 1', text)
+            self.assertIn('cacheml_phase_seconds_bucket{function="mod/f\\"x",phase="compute",le="0.5"} 1', text)
+            self.assertIn('cacheml_phase_seconds_count{function="mod/f\\"x",phase="compute"} 1', text)
+            with open(join(TEMPDIR, 'metrics.json'), 'r') as f:
+                self.assertEqual(json.load(f)['functions'], snapshots[0]['functions'])
+            self.assertEqual(sorted(os.listdir(TEMPDIR)), ['cacheml.prom', 'metrics.json'])
+        finally:
+            clear_tempdir(DEBUG)
+
+
+class TestCachedFunctionMetrics(unittest.TestCase):
+    def setUp(self):
+        init_test_cache()
+        self.data_file = join(TEMPDIR, 'data.txt')
+        with open(self.data_file, 'w') as f:
+            f.write('1000\n')
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def _cache(self, encryption_key_name=None, **config):
+        write_cache_config(**dict(config, metrics=True))
+        return Cache(encryption_key_name=encryption_key_name, verbose=0, _config_base_dir=TEMPDIR)
+
+    def _run(self, cache):
+        @cache.cache
+        def make_array(data_file):
+            with data_file.open('r') as f:
+                return np.arange(int(f.read()))
+        make_array(LocalFile(self.data_file))
+        make_array(LocalFile(self.data_file))
+        make_array(LocalFile(self.data_file))
+        ((func_id, snapshot),) = cache.metrics.snapshot()['functions'].items()
+        self.assertTrue(func_id.endswith('make_array'))
+        return snapshot
+
+    def test_cleartext(self):
+        snapshot = self._run(self._cache())
+        self.assertEqual((snapshot['hits'], snapshot['misses']), (2, 1))
+        self.assertGreater(snapshot['bytes_written'], 8000)
+        self.assertEqual(snapshot['bytes_read'], 2*snapshot['bytes_written'])
+        phases = snapshot['phases']
+        self.assertEqual(sorted(phases.keys()),
+                         sorted([PHASE_HASH, PHASE_LOOKUP, PHASE_READ, PHASE_DESERIALIZE,
+                                 PHASE_COMPUTE, PHASE_WRITE]))
+        self.assertEqual(phases[PHASE_COMPUTE]['count'], 1)
+        self.assertEqual(phases[PHASE_WRITE]['count'], 1)
+        self.assertEqual(phases[PHASE_READ]['count'], 2)
+        self.assertGreaterEqual(phases[PHASE_HASH]['count'], 3)
+
+    def test_encrypted(self):
+        snapshot = self._run(self._cache('default', memory_limit_in_mb=10))
+        # the hits come from the memory tier
+        self.assertEqual((snapshot['hits'], snapshot['misses']), (2, 1))
+        self.assertEqual(snapshot['bytes_read'], 0)
+        self.assertNotIn(PHASE_DECRYPT, snapshot['phases'])
+        cache = self._cache('default')
+        snapshot = self._run(cache)
+        self.assertEqual((snapshot['hits'], snapshot['misses']), (3, 0))
+        self.assertEqual(snapshot['phases'][PHASE_DECRYPT]['count'], 3)
+        self.assertNotIn(PHASE_READ, snapshot['phases'])
+
+    def test_evictions(self):
+        cache = self._cache(manifest=True)
+        cache.store_backend._bytes_limit = 100000
+        @cache.cache
+        def make_array(n):
+            return np.arange(n)
+        for i in range(4):
+            make_array(5000+i)
+        ((func_id, snapshot),) = cache.metrics.snapshot()['functions'].items()
+        self.assertEqual(snapshot['misses'], 4)
+        self.assertGreaterEqual(snapshot['evictions'], 1)
+
+    def test_failed_loads_are_not_hits(self):
+        cache = self._cache(manifest=True)
+        @cache.cache
+        def make_array(n):
+            return np.arange(n)
+        make_array(1000)
+        backend = cache.store_backend
+        (entry,) = backend.manifest.entries()
+        path = entry['path'].split(os.sep)
+        self.assertRaises(KeyError, backend.load_item, [path[0], 'missing'], verbose=0)
+        with open(join(backend.location, entry['path'], 'output.pkl'), 'r+b') as f:
+            f.truncate(100)
+        self.assertRaises(Exception, backend.load_item, path, verbose=0)
+        ((func_id, snapshot),) = cache.metrics.snapshot()['functions'].items()
+        self.assertEqual((snapshot['hits'], snapshot['misses']), (0, 1))
+        self.assertEqual(backend.manifest.entries()[0]['hits'], 0)
+
+    def test_disabled(self):
+        write_cache_config()
+        cache = Cache(verbose=0, _config_base_dir=TEMPDIR)
+        self.assertIsNone(cache.metrics)
+
+    def test_configure_does_not_log_key(self):
+        with self.assertLogs('cacheml.cache', level=logging.DEBUG) as logs:
+            cache = self._cache('default')
+        key = cache.store_backend._key
+        self.assertTrue(any('Configuring encrypted cache' in line for line in logs.output))
+        for record in logs.records:
+            self.assertNotIn(key, str(record.__dict__))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Tests for the dataset input types (LocalDirectory and S3Prefix) and
+per-partition caching.
+"""
+import sys
+import os
+from os.path import join
+import unittest
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key
+from cacheml.s3_pool import clear_s3_filesystems
+from cacheml.s3_stats import clear_s3_stats
+from cacheml.partitions import concat_results
+from cacheml.cache import LocalDirectory, S3Prefix, LocalFile, S3File, Cache
+
+DEBUG=False
+BUCKET='cacheml-partitions-test'
+PORT=5126
+ENDPOINT=f'http://127.0.0.1:{PORT}'
+
+
+def write_partition(path, day):
+    pd.DataFrame({'day':[day]*3, 'value':np.arange(3)+10*day}).to_csv(path, index=False)
+
+
+def make_cache():
+    write_cache_config()
+    write_cache_credentials(get_new_key())
+    return Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+
+
+class TestLocalDirectory(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.data_dir = join(TEMPDIR, 'data')
+        os.mkdir(self.data_dir)
+        for day in range(5):
+            write_partition(join(self.data_dir, f'day-{day:02d}.csv'), day)
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_stats(self):
+        d = LocalDirectory(self.data_dir, '*.csv')
+        files = d.files()
+        self.assertEqual([f.path for f in files],
+                         [join(self.data_dir, f'day-{day:02d}.csv') for day in range(5)])
+        self.assertEqual(files[0].stats, LocalFile(files[0].path).stats)
+        state = d.__getstate__()
+        with open(join(self.data_dir, 'README'), 'w') as f:
+            f.write('not matched by the pattern')
+        self.assertEqual(d.__getstate__(), state)
+        write_partition(join(self.data_dir, 'day-05.csv'), 5)
+        self.assertNotEqual(d.__getstate__(), state)
+        self.assertEqual(len(LocalDirectory(self.data_dir).stats), 7)
+        # nested partitions
+        os.mkdir(join(self.data_dir, 'month=2'))
+        write_partition(join(self.data_dir, 'month=2', 'day-01.csv'), 31)
+        self.assertEqual(LocalDirectory(self.data_dir, '**/*.csv').stats[-1][0],
+                         join('month=2', 'day-01.csv'))
+
+    def test_partitioned_cache(self):
+        cache = make_cache()
+        parsed = []
+        @cache.cache_partitions
+        def parse(f, scale=1):
+            parsed.append(os.path.basename(f.path))
+            df = pd.read_csv(f.path)
+            df['value'] *= scale
+            return df
+        expected = pd.concat([pd.read_csv(f.path) for f in LocalDirectory(self.data_dir).files()])
+        result = parse(LocalDirectory(self.data_dir, '*.csv'))
+        self.assertTrue(result.equals(expected))
+        self.assertEqual(len(parsed), 5)
+        # a new partition only parses that partition
+        write_partition(join(self.data_dir, 'day-05.csv'), 5)
+        result = parse(LocalDirectory(self.data_dir, '*.csv'))
+        self.assertEqual(len(result), 18)
+        self.assertEqual(parsed[5:], ['day-05.csv'])
+        # as does a changed partition
+        time.sleep(0.01)
+        write_partition(join(self.data_dir, 'day-02.csv'), 20)
+        result = parse(LocalDirectory(self.data_dir, '*.csv'))
+        self.assertEqual(parsed[6:], ['day-02.csv'])
+        self.assertEqual(list(result['day'].unique()), [0, 1, 20, 3, 4, 5])
+        # other arguments are part of each partition's key
+        self.assertEqual(parse(LocalDirectory(self.data_dir, '*.csv'), scale=2)['value'].sum(),
+                         2*result['value'].sum())
+        self.assertEqual(len(parsed), 13)
+        self.assertEqual(len(parse.call_partitions(LocalDirectory(self.data_dir, '*.csv'))), 6)
+        self.assertEqual(len(parsed), 13)
+
+    def test_combine(self):
+        cache = make_cache()
+        @cache.cache_partitions(combine=sum)
+        def count_rows(f):
+            return len(pd.read_csv(f.path))
+        self.assertEqual(count_rows(LocalDirectory(self.data_dir)), 15)
+        self.assertEqual(concat_results([[1], [2, 3]]), [1, 2, 3])
+        self.assertTrue(np.array_equal(concat_results([np.arange(2), np.arange(1)]),
+                                       np.array([0, 1, 0])))
+        self.assertEqual(concat_results([1, 2]), [1, 2])
+
+
+class TestS3Prefix(MotoTestCase):
+    port = PORT
+    bucket = BUCKET
+
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        clear_s3_filesystems()
+        clear_s3_stats()
+        for day in range(3):
+            self._put(f'data/day-{day:02d}.csv', day)
+        self._put('data/2021/day-00.csv', 100)
+
+    def tearDown(self):
+        self.empty_bucket()
+        clear_tempdir(DEBUG)
+
+    def _put(self, key, day):
+        body = pd.DataFrame({'day':[day]*3, 'value':np.arange(3)}).to_csv(index=False)
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=body.encode('ascii'))
+
+    def test_stats(self):
+        prefix = S3Prefix(f's3://{BUCKET}/data', suffix='.csv', endpoint_url=ENDPOINT)
+        self.assertEqual([name for (name, _) in prefix.stats],
+                         ['day-00.csv', 'day-01.csv', 'day-02.csv'])
+        files = prefix.files()
+        self.assertEqual(files[0].path, f's3://{BUCKET}/data/day-00.csv')
+        self.assertEqual(files[0].stats, S3File(files[0].path, endpoint_url=ENDPOINT).stats)
+        recursive = S3Prefix(f'{BUCKET}/data/', recursive=True, endpoint_url=ENDPOINT)
+        self.assertEqual([name for (name, _) in recursive.stats],
+                         ['2021/day-00.csv', 'day-00.csv', 'day-01.csv', 'day-02.csv'])
+
+    def test_partitioned_cache(self):
+        cache = make_cache()
+        parsed = []
+        @cache.cache_partitions
+        def parse(f):
+            parsed.append(f.path)
+            with f.open('rb') as g:
+                return pd.read_csv(g)
+        prefix = S3Prefix(f's3://{BUCKET}/data', suffix='.csv', endpoint_url=ENDPOINT)
+        self.assertEqual(len(parse(prefix)), 9)
+        self._put('data/day-03.csv', 3)
+        self.assertEqual(len(parse(prefix)), 12)
+        self.assertEqual(parsed[3:], [f's3://{BUCKET}/data/day-03.csv'])
+
+
+if __name__ == '__main__':
+    unittest.main()
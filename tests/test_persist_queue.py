@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Tests for persisting cache entries in the background."""
+import sys
+import os
+from os.path import join, exists
+import unittest
+import threading
+import subprocess
+import glob
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key
+from cacheml.persist_queue import PersistQueue
+from cacheml.cache import Cache, EncryptedStoreBackend
+
+DEBUG=False
+ARGS_ID='0123456789abcdef0123456789abcdef'
+
+
+class TestPersistQueue(unittest.TestCase):
+    def test_backpressure(self):
+        queue = PersistQueue(bytes_limit=1000)
+        release = threading.Event()
+        written = []
+        def write(key):
+            release.wait()
+            written.append(key)
+        queue.submit('a', b'x'*600, lambda: write('a'))
+        self.assertEqual(queue.get('a'), (True, b'x'*600))
+        # over budget, so this must wait for the first write
+        submitted = threading.Event()
+        def submit_b():
+            queue.submit('b', b'y'*600, lambda: write('b'))
+            submitted.set()
+        threading.Thread(target=submit_b).start()
+        self.assertFalse(submitted.wait(0.2))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        self.assertTrue(queue.flush(timeout=5))
+        self.assertEqual(written, ['a', 'b'])
+        self.assertEqual(queue.get('a'), (False, None))
+        self.assertEqual(queue.pending_bytes, 0)
+
+    def test_errors(self):
+        queue = PersistQueue()
+        def fail():
+            raise IOError("disk full")
+        with self.assertWarns(UserWarning):
+            queue.submit('a', 1, fail)
+            queue.flush()
+        done = []
+        queue.submit('b', 2, lambda: done.append(True))
+        queue.flush()
+        self.assertEqual(done, [True])
+
+
+class TestBackgroundPersistence(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_backend(self):
+        backend = make_backend(EncryptedStoreBackend, join(TEMPDIR, 'cache'), key=get_new_key(),
+                               persist_in_background=True)
+        data = pd.DataFrame({'a':np.arange(1000)})
+        release = threading.Event()
+        dump = backend._dump_item
+        def slow_dump(*args):
+            release.wait()
+            dump(*args)
+        backend._dump_item = slow_dump
+        backend.dump_item(['func', ARGS_ID], data, verbose=0)
+        # served from the queue until written
+        self.assertFalse(exists(join(TEMPDIR, 'cache', 'func', ARGS_ID, 'output.pkl')))
+        self.assertTrue(backend.contains_item(['func', ARGS_ID]))
+        self.assertIs(backend.load_item(['func', ARGS_ID], verbose=0), data)
+        release.set()
+        self.assertTrue(backend.flush(timeout=10))
+        self.assertTrue(exists(join(TEMPDIR, 'cache', 'func', ARGS_ID, 'output.pkl')))
+        self.assertTrue(backend.load_item(['func', ARGS_ID], verbose=0).equals(data))
+
+    def test_flush_at_exit(self):
+        """A process that exits right after the call still writes the entry"""
+        key = init_test_cache(persist_in_background=True, persist_queue_limit_in_mb=64)
+        script = f'''
+import sys
+sys.path.append({get_module_path()!r})
+import numpy as np
+from cacheml.cache import Cache
+cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir={TEMPDIR!r})
+def make_array(n):
+    return np.arange(n)
+print(cache.cache(make_array)(1000000).sum())
+'''
+        subprocess.run([sys.executable, '-c', script], check=True, capture_output=True)
+        entries = glob.glob(join(TEMPDIR, 'cache', 'joblib', '*', 'make_array', '*', 'output.pkl'))
+        self.assertEqual(len(entries), 1)
+        backend = make_backend(EncryptedStoreBackend, join(TEMPDIR, 'cache', 'joblib'), key=key)
+        path = os.path.relpath(os.path.dirname(entries[0]), backend.location).split(os.sep)
+        self.assertTrue(np.array_equal(backend.load_item(path, verbose=0), np.arange(1000000)))
+
+
+if __name__ == '__main__':
+    unittest.main()
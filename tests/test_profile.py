@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Tests for profiling cached calls with Cache.profile()."""
+import sys
+import os
+from os.path import join
+import unittest
+import json
+import tracemalloc
+
+import numpy as np
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.cache import Cache, LocalFile
+from cacheml.metrics import PHASE_HASH, PHASE_LOOKUP, PHASE_READ, PHASE_DECRYPT, \
+    PHASE_DESERIALIZE, PHASE_COMPUTE, PHASE_WRITE
+from cacheml.profile import PHASE_STAT, PHASE_CALL
+
+DEBUG=False
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        init_test_cache()
+        self.data_file = join(TEMPDIR, 'data.txt')
+        with open(self.data_file, 'w') as f:
+            f.write('100000\n')
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def _cache(self, encryption_key_name=None, **config):
+        write_cache_config(**config)
+        return Cache(encryption_key_name=encryption_key_name, verbose=0, _config_base_dir=TEMPDIR)
+
+    def _make_array(self, cache):
+        @cache.cache
+        def make_array(data_file):
+            with data_file.open('r') as f:
+                return np.arange(int(f.read()))
+        return make_array
+
+    def test_miss_and_hit(self):
+        cache = self._cache('default')
+        make_array = self._make_array(cache)
+        with cache.profile() as p:
+            make_array(LocalFile(self.data_file))
+            make_array(LocalFile(self.data_file))
+        (miss, hit) = p.calls
+        self.assertTrue(miss['function'].endswith('make_array'))
+        self.assertEqual((miss['hit'], hit['hit']), (False, True))
+        self.assertTrue({PHASE_HASH, PHASE_STAT, PHASE_COMPUTE, PHASE_WRITE} <= set(p.phase_seconds(miss)))
+        self.assertEqual(set(p.phase_seconds(hit)),
+                         {PHASE_HASH, PHASE_STAT, PHASE_LOOKUP, PHASE_DECRYPT, PHASE_DESERIALIZE})
+        self.assertGreater(miss['bytes_written'], 800000)
+        self.assertGreater(hit['bytes_read'], 800000)
+        self.assertGreater(hit['read_calls'], 0)
+        self.assertEqual(sum(hit['read_sizes'].values()), hit['read_calls'])
+        self.assertGreater(hit['peak_memory'], 800000)
+        self.assertEqual(miss['read_calls'], 0)
+        self.assertFalse(tracemalloc.is_tracing())
+        table = p.table().split('\n')
+        self.assertEqual(len(table), 3)
+        self.assertIn('decrypt', table[0])
+        self.assertIn('miss', table[1])
+        self.assertIn('hit', table[2])
+        # the cache is back to no metrics
+        self.assertIsNone(cache.store_backend._metrics)
+
+    def test_without_reset_peak(self):
+        """tracemalloc.reset_peak() is new in Python 3.9"""
+        cache = self._cache()
+        make_array = self._make_array(cache)
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        if reset_peak is not None:
+            del tracemalloc.reset_peak
+        try:
+            with cache.profile() as p:
+                make_array(LocalFile(self.data_file))
+                make_array(LocalFile(self.data_file))
+        finally:
+            if reset_peak is not None:
+                tracemalloc.reset_peak = reset_peak
+        (miss, hit) = p.calls
+        self.assertGreater(miss['peak_memory'], 800000)
+        self.assertIsNotNone(hit['peak_memory'])
+
+    def test_chrome_trace(self):
+        cache = self._cache()
+        make_array = self._make_array(cache)
+        @cache.cache
+        def total(data_file):
+            return int(make_array(data_file).sum())
+        data_file = LocalFile(self.data_file)
+        with cache.profile(trace_memory=False) as p:
+            total(data_file)
+        (call,) = p.calls
+        self.assertIsNone(call['peak_memory'])
+        # the nested cached call is an event of the outer one
+        self.assertEqual([e['function'].split('/')[-1] for e in call['events'] if e['phase']==PHASE_CALL],
+                         ['make_array'])
+        trace_file = join(TEMPDIR, 'trace.json')
+        p.save_chrome_trace(trace_file)
+        with open(trace_file, 'r') as f:
+            events = json.load(f)['traceEvents']
+        names = [e['name'] for e in events]
+        self.assertEqual(len([n for n in names if n.endswith('total') or n.endswith('make_array')]), 2)
+        self.assertIn(PHASE_COMPUTE, names)
+        for e in events:
+            self.assertEqual(e['ph'], 'X')
+            self.assertGreaterEqual(e['dur'], 0)
+        # the calls contain their phases
+        (outer,) = [e for e in events if e['name'].endswith('total')]
+        for e in events:
+            self.assertGreaterEqual(e['ts'], outer['ts'])
+            self.assertLessEqual(e['ts']+e['dur'], outer['ts']+outer['dur']+1)
+
+    def test_metrics_and_background_writes(self):
+        cache = self._cache(metrics=True, persist_in_background=True)
+        make_array = self._make_array(cache)
+        with cache.profile() as p:
+            make_array(LocalFile(self.data_file))
+            cache.flush()
+        (call,) = p.calls
+        self.assertNotIn(PHASE_WRITE, p.phase_seconds(call))
+        # LocalFile() checks the file before the call
+        self.assertEqual([e['phase'] for e in p.events], [PHASE_STAT, PHASE_WRITE])
+        # the metrics of the cache were still recorded
+        self.assertIs(cache.store_backend._metrics, cache.metrics)
+        ((func_id, snapshot),) = cache.metrics.snapshot()['functions'].items()
+        self.assertEqual(snapshot['misses'], 1)
+        self.assertEqual(snapshot['phases'][PHASE_WRITE]['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Tests for the rotation of the encryption key of a cache."""
+import sys
+import os
+from os.path import join, exists
+import unittest
+import json
+
+import numpy as np
+from click.testing import CliRunner
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.cml import cli
+from cacheml.cache import Cache, CacheConfigError
+from cacheml.crypto import get_new_key, encrypted_file_open, key_matches, FORMAT_CTR
+from cacheml.rotation import rotate_file, rotate_cache_key
+
+DEBUG=False
+
+
+class TestRotateFile(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def _write(self, filename, key, data, **kwargs):
+        with encrypted_file_open(filename, 'wb', key, **kwargs) as f:
+            f.write(data)
+
+    def _read(self, filename, key):
+        with encrypted_file_open(filename, 'rb', key) as f:
+            return f.read()
+
+    def test_rotate_file(self):
+        (old_key, new_key) = (get_new_key(), get_new_key())
+        data = os.urandom(200000)
+        for (name, kwargs) in [('gcm.pkl', {}), ('ctr.pkl', {'file_format':FORMAT_CTR})]:
+            filename = join(TEMPDIR, name)
+            self._write(filename, old_key, data, **kwargs)
+            self.assertTrue(rotate_file(filename, old_key, new_key))
+            self.assertEqual(self._read(filename, new_key), data)
+            self.assertTrue(key_matches(filename, new_key))
+            self.assertFalse(key_matches(filename, old_key))
+            # already rotated
+            self.assertFalse(rotate_file(filename, old_key, new_key))
+        self.assertEqual(sorted(os.listdir(TEMPDIR)), ['ctr.pkl', 'gcm.pkl'])
+
+    def test_damaged_file(self):
+        (old_key, new_key) = (get_new_key(), get_new_key())
+        filename = join(TEMPDIR, 'output.pkl')
+        self._write(filename, get_new_key(), b'x'*1000)
+        self.assertRaises(ValueError, rotate_file, filename, old_key, new_key)
+        self.assertTrue(exists(filename))
+        self.assertIsNone(rotate_file(filename, old_key, new_key, remove_damaged=True))
+        self.assertFalse(exists(filename))
+
+    def _write_entries(self, key, n):
+        for i in range(n):
+            os.mkdir(join(TEMPDIR, f'entry{i}'))
+            self._write(join(TEMPDIR, f'entry{i}', 'output.pkl'), key, os.urandom(1000+i))
+
+    def test_damaged_files_in_cache(self):
+        (old_key, new_key) = (get_new_key(), get_new_key())
+        self._write_entries(old_key, 4)
+        damaged = join(TEMPDIR, 'entry2', 'output.pkl')
+        self._write(damaged, get_new_key(), b'x'*1000)
+        (rotated, skipped, removed, errors) = rotate_cache_key(TEMPDIR, old_key, new_key, workers=1)
+        self.assertEqual((rotated, skipped, removed), (3, 0, []))
+        self.assertEqual([filename for (filename, e) in errors], [damaged])
+        self.assertTrue(exists(damaged))
+        self.assertEqual(rotate_cache_key(TEMPDIR, old_key, new_key, workers=1, remove_damaged=True),
+                         (0, 3, [damaged], []))
+        self.assertFalse(exists(damaged))
+
+    def test_wrong_old_key(self):
+        (old_key, new_key) = (get_new_key(), get_new_key())
+        self._write_entries(old_key, 20)
+        self.assertRaises(ValueError, rotate_cache_key, TEMPDIR, get_new_key(), new_key,
+                          workers=2, remove_damaged=True)
+        # nothing was changed
+        for i in range(20):
+            self.assertTrue(key_matches(join(TEMPDIR, f'entry{i}', 'output.pkl'), old_key))
+
+    def test_resume(self):
+        (old_key, new_key) = (get_new_key(), get_new_key())
+        self._write_entries(old_key, 40)
+        # an interrupted rotation
+        rotate_file(join(TEMPDIR, 'entry3', 'output.pkl'), old_key, new_key)
+        with open(join(TEMPDIR, 'entry5', 'output.pkl.rotate-pid-1'), 'wb') as f:
+            f.write(b'partial')
+        (rotated, skipped, removed, errors) = rotate_cache_key(TEMPDIR, old_key, new_key, workers=2)
+        self.assertEqual((rotated, skipped, removed, errors), (39, 1, [], []))
+        self.assertFalse(exists(join(TEMPDIR, 'entry5', 'output.pkl.rotate-pid-1')))
+        self.assertEqual(rotate_cache_key(TEMPDIR, old_key, new_key, workers=2), (0, 40, [], []))
+
+
+class TestCacheRotation(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.runner = CliRunner()
+        result = self.runner.invoke(cli, ['--config-base-dir', TEMPDIR, 'init', join(TEMPDIR, 'cache')])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.calls = 0
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def _set_config(self, **config):
+        cfg_file = join(TEMPDIR, '.dml', 'config')
+        with open(cfg_file, 'r') as f:
+            cfg_data = json.load(f)
+        cfg_data.update(config)
+        with open(cfg_file, 'w') as f:
+            json.dump(cfg_data, f)
+
+    def _cached_func(self, cache):
+        @cache.cache
+        def make_array(n):
+            self.calls += 1
+            return np.arange(n)
+        return make_array
+
+    def _fill(self):
+        # entries in both encryption formats
+        self._set_config(encryption_format='ctr')
+        make_array = self._cached_func(Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR))
+        make_array(1000)
+        self._set_config(encryption_format='gcm')
+        make_array = self._cached_func(Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR))
+        make_array(2000)
+        self.assertEqual(self.calls, 2)
+
+    def test_cache_rotate_key(self):
+        self._fill()
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        old_key = cache.store_backend._key
+        new_key = get_new_key()
+        (rotated, skipped, removed, errors) = cache.rotate_key(new_key, workers=1)
+        self.assertEqual((skipped, removed, errors), (0, [], []))
+        self.assertGreaterEqual(rotated, 4) # the two outputs, metadata and function code
+        make_array = self._cached_func(cache)
+        self.assertEqual(make_array(1000).sum(), np.arange(1000).sum())
+        self.assertEqual(make_array(2000).sum(), np.arange(2000).sum())
+        self.assertEqual(self.calls, 2)
+        # the old key can no longer read the entries
+        output = join(cache.store_backend.location, cache.store_backend.get_items()[0].path, 'output.pkl')
+        self.assertFalse(key_matches(output, old_key))
+
+    def test_unencrypted_cache(self):
+        cache = Cache(verbose=0, _config_base_dir=TEMPDIR)
+        with self.assertRaises(CacheConfigError):
+            cache.rotate_key(get_new_key())
+
+    def test_cli(self):
+        self._fill()
+        cred_file = join(TEMPDIR, '.dml', 'credentials')
+        with open(cred_file, 'r') as f:
+            old_key = json.load(f)['cache_keys']['default']
+        result = self.runner.invoke(cli, ['--config-base-dir', TEMPDIR, 'rotate-key', '-j', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Key default replaced', result.output)
+        with open(cred_file, 'r') as f:
+            cache_keys = json.load(f)['cache_keys']
+        self.assertEqual(sorted(cache_keys.keys()), ['default', 'default.previous'])
+        self.assertEqual(cache_keys['default.previous'], old_key)
+        self.assertNotEqual(cache_keys['default'], old_key)
+        make_array = self._cached_func(Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR))
+        make_array(1000)
+        make_array(2000)
+        self.assertEqual(self.calls, 2)
+
+    def test_cli_wrong_key(self):
+        self._fill()
+        cred_file = join(TEMPDIR, '.dml', 'credentials')
+        with open(cred_file, 'r') as f:
+            cred_data = json.load(f)
+        cred_data['cache_keys']['default'] = get_new_key()
+        with open(cred_file, 'w') as f:
+            json.dump(cred_data, f)
+        result = self.runner.invoke(cli, ['--config-base-dir', TEMPDIR, 'rotate-key',
+                                          '--remove-damaged'])
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn('old key does not match', result.output)
+        cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=TEMPDIR)
+        self.assertEqual(len(cache.store_backend.get_items()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
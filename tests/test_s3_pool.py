@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Tests for the S3FileSystem pool, against a local moto server."""
+import sys
+import os
+import unittest
+import multiprocessing
+import pickle
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.s3_pool import get_s3_filesystem, clear_s3_filesystems, num_s3_filesystems
+from cacheml.cache import S3File
+
+BUCKET='cacheml-pool-test'
+PORT=5124
+ENDPOINT=f'http://127.0.0.1:{PORT}'
+NUM_FILES=200
+
+
+def _pool_in_child(queue):
+    before = num_s3_filesystems()
+    get_s3_filesystem(endpoint_url=ENDPOINT)
+    queue.put((before, num_s3_filesystems()))
+
+
+class TestS3Pool(MotoTestCase):
+    port = PORT
+    bucket = BUCKET
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        for i in range(10):
+            cls.s3.put_object(Bucket=BUCKET, Key=f'data/part-{i}.csv', Body=b'a,b\n1,2\n')
+
+    def setUp(self):
+        clear_s3_filesystems()
+
+    def test_shared(self):
+        files = [S3File(f's3://{BUCKET}/data/part-{i%10}.csv', endpoint_url=ENDPOINT)
+                 for i in range(NUM_FILES)]
+        for f in files:
+            hash(f)
+        self.assertEqual(num_s3_filesystems(), 1)
+        self.assertIs(files[0].fs, files[-1].fs)
+        # unpickling does not create clients
+        copies = pickle.loads(pickle.dumps(files))
+        self.assertEqual(num_s3_filesystems(), 1)
+        self.assertIs(copies[0].fs, files[0].fs)
+        self.assertEqual(copies[0].s3_options, {'endpoint_url':ENDPOINT})
+        with copies[3].open('rb') as f:
+            self.assertEqual(f.read(), b'a,b\n1,2\n')
+        # different options get a different filesystem
+        self.assertIsNot(get_s3_filesystem(endpoint_url=ENDPOINT, anon=True), files[0].fs)
+        self.assertEqual(num_s3_filesystems(), 2)
+
+    def test_state_without_options(self):
+        """The pickled state is unchanged when there are no options, so existing
+        cache entries still match"""
+        f = S3File.__new__(S3File)
+        f.__setstate__((f's3://{BUCKET}/data/part-0.csv', 'modtime', 8))
+        self.assertEqual(f.s3_options, {})
+
+    def test_fork(self):
+        get_s3_filesystem(endpoint_url=ENDPOINT)
+        self.assertEqual(num_s3_filesystems(), 1)
+        ctx = multiprocessing.get_context('fork')
+        queue = ctx.Queue()
+        p = ctx.Process(target=_pool_in_child, args=(queue,))
+        p.start()
+        (before, after) = queue.get(timeout=60)
+        p.join()
+        # the child does not use the parent's filesystem, it builds its own
+        self.assertEqual(before, 0)
+        self.assertEqual(after, 1)
+        self.assertEqual(num_s3_filesystems(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
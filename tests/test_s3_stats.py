@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Tests for the batched validation of S3File arguments, against a local moto server."""
+import sys
+import os
+from os.path import join
+import unittest
+import time
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key
+from cacheml.s3_pool import get_s3_filesystem, clear_s3_filesystems
+from cacheml.s3_stats import configure_s3_validation, clear_s3_stats, DEFAULT_TTL
+from cacheml.cache import S3File, Cache
+
+DEBUG=False
+BUCKET='cacheml-stats-test'
+PORT=5125
+ENDPOINT=f'http://127.0.0.1:{PORT}'
+NUM_PARTS=20
+
+
+class CountingFS:
+    """Count the info and ls calls made on the pooled filesystem"""
+    def __init__(self, fs):
+        self.counts = {'info':0, 'ls':0}
+        for name in self.counts.keys():
+            setattr(fs, name, self._wrap(name, getattr(fs, name)))
+
+    def _wrap(self, name, method):
+        def wrapper(*args, **kwargs):
+            self.counts[name] += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+
+class TestS3Validation(MotoTestCase):
+    port = PORT
+    bucket = BUCKET
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        for i in range(NUM_PARTS):
+            cls.s3.put_object(Bucket=BUCKET, Key=f'data/part-{i:02d}.csv', Body=f'a\n{i}\n'.encode('ascii'))
+        cls.s3.put_object(Bucket=BUCKET, Key='data/README', Body=b'not data')
+
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        clear_s3_filesystems()
+        clear_s3_stats()
+        configure_s3_validation(ttl=DEFAULT_TTL, use_etag=False)
+        self.counter = CountingFS(get_s3_filesystem(endpoint_url=ENDPOINT))
+
+    def tearDown(self):
+        configure_s3_validation(ttl=DEFAULT_TTL, use_etag=False)
+        clear_tempdir(DEBUG)
+
+    def test_list(self):
+        files = S3File.list(f's3://{BUCKET}/data', suffix='.csv', endpoint_url=ENDPOINT)
+        self.assertEqual(len(files), NUM_PARTS)
+        self.assertEqual(files[0].path, f's3://{BUCKET}/data/part-00.csv')
+        self.assertEqual(self.counter.counts, {'info':0, 'ls':1})
+
+    def test_cached_function(self):
+        write_cache_config()
+        write_cache_credentials(get_new_key())
+        cache = Cache(verbose=0, _config_base_dir=TEMPDIR)
+        @cache.cache
+        def read_all(files):
+            return sum(len(f.open('rb').read()) for f in files)
+        files = S3File.list(f's3://{BUCKET}/data', suffix='.csv', endpoint_url=ENDPOINT)
+        self.counter.counts.update(info=0, ls=0)
+        # joblib hashes the arguments several times on a miss, but the files are
+        # only validated once (reading them is not a validation)
+        expected = read_all(files)
+        self.assertEqual(self.counter.counts['ls'], 1)
+        self.counter.counts.update(info=0, ls=0)
+        # each call validates all the files with a single listing
+        self.assertEqual(read_all(files), expected)
+        self.assertEqual(self.counter.counts, {'info':0, 'ls':1})
+        # with a TTL, there is no need to check again
+        configure_s3_validation(ttl=60)
+        self.assertEqual(read_all(files), expected)
+        self.assertEqual(self.counter.counts, {'info':0, 'ls':1})
+        # a cache created later without the setting checks the files again
+        write_cache_config(cache_dir=join(TEMPDIR, 'cache2'))
+        Cache(verbose=0, _config_base_dir=TEMPDIR)
+        self.assertEqual(read_all(files), expected)
+        self.assertEqual(self.counter.counts, {'info':0, 'ls':2})
+
+    def test_ttl(self):
+        f = S3File(f's3://{BUCKET}/data/part-00.csv', endpoint_url=ENDPOINT)
+        hash(f)
+        self.assertEqual(self.counter.counts['info'], 2)
+        # the last check is recent enough, so there are no more requests
+        configure_s3_validation(ttl=60)
+        hash(f)
+        f.__getstate__()
+        self.assertEqual(self.counter.counts['info'], 2)
+        clear_s3_stats()
+        hash(f)
+        self.assertEqual(self.counter.counts['info'], 3)
+
+    def test_etag(self):
+        path = f's3://{BUCKET}/data/part-01.csv'
+        configure_s3_validation(use_etag=True)
+        stats = S3File(path, endpoint_url=ENDPOINT).stats
+        time.sleep(1.1) # so that LastModified changes
+        self.s3.put_object(Bucket=BUCKET, Key='data/part-01.csv', Body=b'a\n1\n')
+        # same content, so same ETag
+        self.assertEqual(S3File(path, endpoint_url=ENDPOINT).__getstate__()[1:3], stats)
+        configure_s3_validation(use_etag=False)
+        modified_stats = S3File(path, endpoint_url=ENDPOINT).stats
+        self.assertNotEqual(modified_stats[0], stats[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Tests for the S3 store backend. These run against a local moto server,
+so they do not need AWS credentials.
+"""
+import sys
+import os
+from os.path import join, exists
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key
+from cacheml.cache import S3StoreBackend, EncryptedS3StoreBackend, Cache
+
+DEBUG=False
+BUCKET='cacheml-test'
+PORT=5123
+ARGS_ID='0123456789abcdef0123456789abcdef'
+ENDPOINT=f'http://127.0.0.1:{PORT}'
+S3_OPTIONS={'key':'testing', 'secret':'testing', 'endpoint_url':ENDPOINT}
+
+
+class TestS3StoreBackend(MotoTestCase):
+    port = PORT
+    bucket = BUCKET
+
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.key = get_new_key()
+
+    def tearDown(self):
+        self.empty_bucket()
+        clear_tempdir(DEBUG)
+
+    def _s3_keys(self):
+        return sorted(obj['Key'] for obj in self.s3.list_objects_v2(Bucket=BUCKET).get('Contents', []))
+
+    def _make_backend(self, cls, node, **options):
+        return make_backend(cls, join(TEMPDIR, node), s3_url=f's3://{BUCKET}/cache', s3_options=S3_OPTIONS,
+                            **options)
+
+    def test_shared_entries(self):
+        data = pd.DataFrame({'a':np.arange(1000), 'b':np.arange(1000)*0.5})
+        for (cls, options) in [(S3StoreBackend, {}), (EncryptedS3StoreBackend, {'key':self.key})]:
+            node1 = self._make_backend(cls, 'node1', **options)
+            node2 = self._make_backend(cls, 'node2', **options)
+            node1.store_cached_func_code(['func'], 'def func(): pass')
+            node1.dump_item(['func', ARGS_ID], data, verbose=0)
+            node1.store_metadata(['func', ARGS_ID], {'duration':1.0})
+            self.assertEqual(self._s3_keys(), [f'cache/func/{ARGS_ID}/metadata.json',
+                                               f'cache/func/{ARGS_ID}/output.pkl',
+                                               'cache/func/func_code.py'])
+            # node2 gets the entry from S3 and promotes it to its local cache
+            self.assertFalse(node2.contains_item(['func', 'missing']))
+            self.assertTrue(node2.contains_item(['func', ARGS_ID]))
+            self.assertTrue(exists(join(TEMPDIR, 'node2', 'func', ARGS_ID, 'output.pkl')))
+            self.assertTrue(node2.load_item(['func', ARGS_ID], verbose=0).equals(data))
+            self.assertEqual(node2.get_metadata(['func', ARGS_ID]), {'duration':1.0})
+            self.assertEqual(node2.get_cached_func_code(['func']), 'def func(): pass')
+            # reducing the size of the local cache does not remove entries from S3
+            node2.reduce_store_size(0)
+            self.assertFalse(exists(join(TEMPDIR, 'node2', 'func', ARGS_ID, 'output.pkl')))
+            self.assertIn(f'cache/func/{ARGS_ID}/output.pkl', self._s3_keys())
+            # clearing does
+            node2.clear_path(['func'])
+            self.assertEqual(self._s3_keys(), [])
+            self.assertFalse(exists(join(TEMPDIR, 'node2', 'func')))
+            node1.clear()
+
+    def test_cache(self):
+        """Two caches with different local directories share results through S3"""
+        calls = []
+        def read(rows):
+            calls.append(rows)
+            return pd.DataFrame({'a':np.arange(rows)})
+        for node in ['node1', 'node2']:
+            write_cache_config(join(TEMPDIR, node), s3_cache_url=f's3://{BUCKET}/shared',
+                               s3_options=S3_OPTIONS)
+            write_cache_credentials(self.key, join(TEMPDIR, node))
+            cache = Cache(encryption_key_name='default', verbose=0, _config_base_dir=join(TEMPDIR, node))
+            self.assertIsInstance(cache.store_backend, EncryptedS3StoreBackend)
+            self.assertTrue(cache.cache(read)(100).equals(pd.DataFrame({'a':np.arange(100)})))
+        self.assertEqual(calls, [100])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import sys
+import os
+from os.path import join
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils_for_tests import *
+sys.path.append(get_module_path())
+from cacheml.crypto import get_new_key, encrypted_file_open
+from cacheml.serialize import dump_oob, load_oob, load_oob_mmap, is_oob_file, ALIGNMENT
+from cacheml.cache import CacheMLStoreBackend, EncryptedStoreBackend, LAYOUT_JOBLIB, LAYOUT_OOB
+
+DEBUG=False
+
+def make_df(rows=10000):
+    return pd.DataFrame({'a':np.arange(rows), 'b':np.arange(rows)*0.5,
+                         'c':[f'row {i}' for i in range(rows)]})
+
+
+class TestOutOfBand(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+        self.filename = join(TEMPDIR, 'output.pkl')
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_roundtrip(self):
+        data = {'array':np.arange(100000), 'small':np.ones(3), 'df':make_df(),
+                'fortran':np.asfortranarray(np.ones((300, 200))), 'text':'hello'}
+        with open(self.filename, 'wb') as f:
+            dump_oob(data, f)
+        with open(self.filename, 'rb') as f:
+            self.assertTrue(is_oob_file(f))
+            result = load_oob(f)
+        self.assertTrue((result['array']==data['array']).all())
+        self.assertTrue(result['array'].flags.writeable)
+        self.assertTrue((result['small']==data['small']).all())
+        self.assertTrue(result['df'].equals(data['df']))
+        self.assertTrue((result['fortran']==data['fortran']).all())
+        self.assertEqual(result['text'], 'hello')
+
+    def test_mmap(self):
+        data = np.arange(100000)
+        with open(self.filename, 'wb') as f:
+            dump_oob(data, f)
+        result = load_oob_mmap(self.filename, 'r')
+        self.assertTrue((result==data).all())
+        self.assertFalse(result.flags.writeable)
+        self.assertEqual(result.ctypes.data % ALIGNMENT, 0)
+
+    def test_mmap_modes(self):
+        data = np.arange(100000)
+        def load(mmap_mode):
+            result = load_oob_mmap(self.filename, mmap_mode)
+            self.assertTrue((result==data).all())
+            return result
+        with open(self.filename, 'wb') as f:
+            dump_oob(data, f)
+        # copy on write: the file is not changed
+        result = load('c')
+        self.assertTrue(result.flags.writeable)
+        result[0] = -1
+        del result
+        load('r')
+        # the changes are written to the file
+        for mmap_mode in ['r+', 'w+']:
+            result = load(mmap_mode)
+            self.assertTrue(result.flags.writeable)
+            result[0] = -1
+            del result
+            self.assertEqual(load_oob_mmap(self.filename, 'r')[0], -1)
+            with open(self.filename, 'wb') as f:
+                dump_oob(data, f)
+        self.assertRaises(ValueError, load_oob_mmap, self.filename, 'x')
+
+    def test_encrypted(self):
+        key = get_new_key()
+        data = make_df(100000)
+        with encrypted_file_open(self.filename, 'wb', key) as f:
+            dump_oob(data, f)
+        with encrypted_file_open(self.filename, 'rb', key) as f:
+            self.assertTrue(is_oob_file(f))
+            result = load_oob(f)
+        self.assertTrue(result.equals(data))
+
+
+class TestStoreBackendLayouts(unittest.TestCase):
+    def setUp(self):
+        clear_tempdir()
+        os.mkdir(TEMPDIR)
+
+    def tearDown(self):
+        clear_tempdir(DEBUG)
+
+    def test_layouts(self):
+        data = make_df()
+        key = get_new_key()
+        for (cls, options) in [(CacheMLStoreBackend, {}),
+                               (EncryptedStoreBackend, {'key':key})]:
+            for layout in [LAYOUT_JOBLIB, LAYOUT_OOB]:
+                writer = make_backend(cls, layout=layout, **options)
+                writer.dump_item(['func', layout], data, verbose=0)
+                # the reader can always read both layouts
+                reader = make_backend(cls, layout=LAYOUT_OOB, **options)
+                self.assertTrue(reader.load_item(['func', layout], verbose=0).equals(data))
+
+    def test_mmap_mode(self):
+        data = np.arange(100000)
+        for layout in [LAYOUT_JOBLIB, LAYOUT_OOB]:
+            backend = make_backend(CacheMLStoreBackend, layout=layout, mmap_mode='r')
+            backend.dump_item(['func', layout], data, verbose=0)
+            result = backend.load_item(['func', layout], verbose=0)
+            self.assertTrue((result==data).all())
+            self.assertFalse(result.flags.writeable)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 import time
 import os
+import json
 from os.path import dirname, abspath, expanduser, join, exists
 import shutil
+import unittest
 from typing import Optional, List
 from datetime import datetime
 import pandas as pd
 import pandas.core.dtypes
 from pathlib import Path
 
+try:
+    from moto.server import ThreadedMotoServer
+    import boto3
+    HAVE_MOTO=True
+except ImportError:
+    HAVE_MOTO=False
+
 def timeit(f, *args, **kwargs):
     st = time.time()
     rv = f(*args, **kwargs)
@@ -63,6 +72,79 @@ def clear_tempdir(DEBUG=False):
         else:
             print(f"Skipping removal of TEMPDIR at {TEMPDIR}, as DEBUG is True")
 
+def write_cache_config(base_dir=TEMPDIR, **config):
+    """Write the configuration file of a test cache in base_dir/.dml. The cache
+    directory is base_dir/cache, without a size limit, unless config overrides them.
+    """
+    os.makedirs(join(base_dir, '.dml'), exist_ok=True)
+    cfg_data = {'cache_dir':join(base_dir, 'cache'), 'max_size_in_mb':None}
+    cfg_data.update(config)
+    with open(join(base_dir, '.dml', 'config'), 'w') as f:
+        json.dump(cfg_data, f)
+
+def write_cache_credentials(key, base_dir=TEMPDIR):
+    """Write the credentials file of a test cache in base_dir/.dml, with key as
+    the 'default' key.
+    """
+    os.makedirs(join(base_dir, '.dml'), exist_ok=True)
+    with open(join(base_dir, '.dml', 'credentials'), 'w') as f:
+        json.dump({'cache_keys':{'default':key}}, f)
+
+def init_test_cache(**config):
+    """Clear TEMPDIR, and create the configuration (see write_cache_config()) and
+    the credentials of a test cache in it. Returns the new 'default' key.
+    """
+    from cacheml.crypto import get_new_key
+    clear_tempdir()
+    key = get_new_key()
+    write_cache_config(**config)
+    write_cache_credentials(key)
+    return key
+
+def make_backend(cls, location=None, **options):
+    """Configure a store backend of class cls in location (default: the joblib
+    directory in TEMPDIR), with options as its backend options.
+    """
+    backend = cls()
+    backend.configure(location if location is not None else join(TEMPDIR, 'joblib'), verbose=0,
+                      backend_options=options)
+    return backend
+
+class MotoTestCase(unittest.TestCase):
+    """Base class of the tests against a local moto S3 server, which is started
+    for the class on port, with an empty bucket. While it runs, the AWS credentials
+    in the environment are dummy ones. Subclasses set port and bucket, and are
+    skipped if moto is not installed.
+    """
+    port = None
+    bucket = None
+
+    @classmethod
+    def setUpClass(cls):
+        if not HAVE_MOTO:
+            raise unittest.SkipTest("moto is not installed")
+        cls.server = ThreadedMotoServer(port=cls.port, verbose=False)
+        cls.server.start()
+        cls.saved_env = {k:os.environ.get(k) for k in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']}
+        os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+        os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+        cls.s3 = boto3.client('s3', endpoint_url=f'http://127.0.0.1:{cls.port}', region_name='us-east-1')
+        cls.s3.create_bucket(Bucket=cls.bucket)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        for (k, v) in cls.saved_env.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+    def empty_bucket(self):
+        for obj in self.s3.list_objects_v2(Bucket=self.bucket).get('Contents', []):
+            self.s3.delete_object(Bucket=self.bucket, Key=obj['Key'])
+
+
 def get_local_data_file():
     return join(get_module_path(), 'test_data/commits.csv.gz')
 